@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Request, Form, File, UploadFile, Depends, HTTPException, status
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from typing import Optional, List
 import json
 import os
@@ -10,11 +10,21 @@ from datetime import datetime
 from config import settings
 
 from database import get_db
+from db_router import get_read_db
 from models import Device as DeviceModel, Content as ContentModel, Todo as TodoModel
 from database import Song as SongModel
 from schemas import DeviceCreate, ContentCreate, TodoCreate, TodoUpdate, SongCreate
 from image_processor import image_processor
-from mqtt_manager import mqtt_manager
+from mqtt_manager import mqtt_manager, RESERVED_DEVICE_IDS
+from dependencies import load_device, get_active_devices
+from device_registry import device_registry
+from song_codec import parse_song, set_song_notes, detach_library_song
+from song_library import ensure_default_library, assign_library_songs
+from stats import dashboard_stats
+from pagination import fetch_page
+from device_state import heartbeat_buffer
+from presence import presence_tracker
+from repository import get_todo
 
 # 创建模板对象
 templates = Jinja2Templates(directory="templates")
@@ -27,11 +37,28 @@ def from_json_filter(value):
     except (json.JSONDecodeError, TypeError):
         return []
 
+def song_notes_filter(song):
+    """获取歌曲解析后的音符列表（带缓存）"""
+    return parse_song(song)[1]
+
+def song_notes_json_filter(song):
+    """获取歌曲音符的JSON文本，用于编辑和展示"""
+    return json.dumps(parse_song(song)[1])
+
 templates.env.filters['from_json'] = from_json_filter
+templates.env.filters['song_notes'] = song_notes_filter
+templates.env.filters['song_notes_json'] = song_notes_json_filter
 
 # 创建管理后台路由
 admin_router = APIRouter()
 
+
+def get_device_choices(db: Session):
+    """
+    获取筛选下拉框用的设备列表，只查询ID和名称两列
+    """
+    return db.query(DeviceModel.device_id, DeviceModel.name).order_by(DeviceModel.device_id).all()
+
 # 登录页面
 @admin_router.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request, next: Optional[str] = None):
@@ -96,77 +123,39 @@ async def logout(request: Request):
 
 # 管理后台路由
 @admin_router.get("/", response_class=HTMLResponse)
-async def admin_dashboard(request: Request, db: Session = Depends(get_db)):
+async def admin_dashboard(request: Request, db: Session = Depends(get_read_db)):
     """
     管理后台首页
     """
-    # 获取设备数量
-    device_count = db.query(DeviceModel).count()
-    active_device_count = db.query(DeviceModel).filter(DeviceModel.is_active == True).count()
-    
-    # 获取内容数量
-    content_count = db.query(ContentModel).count()
-    
-    # 获取待办事项数量
-    todo_count = db.query(TodoModel).count()
-    completed_todo_count = db.query(TodoModel).filter(TodoModel.is_completed == True).count()
-    pending_todo_count = todo_count - completed_todo_count
-    
-    # 获取歌曲数量
-    song_count = db.query(SongModel).count()
-    
-    # 获取最近上线的设备
-    recent_devices = db.query(DeviceModel).order_by(DeviceModel.last_online.desc()).limit(5).all()
-    
-    # 获取最近创建的待办事项
-    recent_todos_query = db.query(TodoModel, DeviceModel).join(
-        DeviceModel, TodoModel.device_id == DeviceModel.device_id
-    ).order_by(TodoModel.created_at.desc()).limit(5).all()
-    
-    # 转换为包含todo和device的对象列表
-    recent_todos = [{"todo": todo, "device": device} for todo, device in recent_todos_query]
-    
-    # 获取最近创建的歌曲
-    recent_songs_query = db.query(SongModel, DeviceModel).join(
-        DeviceModel, SongModel.device_id == DeviceModel.device_id
-    ).order_by(SongModel.created_at.desc()).limit(5).all()
-    
-    # 转换为包含song和device的对象列表
-    recent_songs = [{"song": song, "device": device} for song, device in recent_songs_query]
+    # 统计数据来自缓存快照（一条聚合查询计算，短TTL内复用）
+    snapshot = dashboard_stats.get(db)
     
     return templates.TemplateResponse("admin/dashboard.html", {
         "request": request,
-        "device_count": device_count,
-        "active_device_count": active_device_count,
-        "content_count": content_count,
-        "todo_count": todo_count,
-        "completed_todo_count": completed_todo_count,
-        "pending_todo_count": pending_todo_count,
-        "song_count": song_count,
-        "recent_devices": recent_devices,
-        "recent_todos": recent_todos,
-        "recent_songs": recent_songs
+        **snapshot
     })
 
 @admin_router.get("/devices", response_class=HTMLResponse)
-async def devices_list(request: Request, db: Session = Depends(get_db)):
+async def devices_list(request: Request, db: Session = Depends(get_read_db)):
     """
     设备列表页面
     """
     devices = db.query(DeviceModel).order_by(DeviceModel.created_at.desc()).all()
+    heartbeat_buffer.apply(devices)
     return templates.TemplateResponse("admin/devices.html", {
         "request": request,
         "devices": devices
     })
 
 @admin_router.get("/devices/{device_id}", response_class=HTMLResponse)
-async def device_detail(request: Request, device_id: str, db: Session = Depends(get_db)):
+async def device_detail(request: Request, device_id: str, db: Session = Depends(get_read_db)):
     """
     设备详情页面
     """
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="设备不存在")
+    heartbeat_buffer.apply([device])
     
     # 获取设备的内容
     contents = db.query(ContentModel).filter(ContentModel.device_id == device_id).order_by(ContentModel.version.desc()).all()
@@ -192,8 +181,14 @@ async def add_device(request: Request, db: Session = Depends(get_db)):
     name = form.get("name")
     scene = form.get("scene")
     
+    if device_id in RESERVED_DEVICE_IDS:
+        return templates.TemplateResponse("admin/add_device.html", {
+            "request": request,
+            "error": "设备ID与MQTT分组主题冲突，不能使用"
+        })
+    
     # 检查设备ID是否已存在
-    existing_device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    existing_device = load_device(request, db, device_id)
     if existing_device:
         return templates.TemplateResponse("admin/add_device.html", {
             "request": request,
@@ -211,57 +206,67 @@ async def add_device(request: Request, db: Session = Depends(get_db)):
     
     db.add(new_device)
     db.commit()
-    
-    # 订阅设备状态
-    mqtt_manager.subscribe_to_device_status(device_id)
+    device_registry.invalidate(device_id)
+    presence_tracker.add(device_id)
     
     return RedirectResponse(url="/admin/devices", status_code=303)
 
 @admin_router.get("/contents", response_class=HTMLResponse)
-async def contents_list(request: Request, device_id: Optional[str] = None, db: Session = Depends(get_db)):
+async def contents_list(
+    request: Request,
+    device_id: Optional[str] = None,
+    content_type: Optional[str] = None,
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
     """
-    内容列表页面
+    内容列表页面（分页，设备信息随内容一次查询加载）
     """
+    query = db.query(ContentModel).options(joinedload(ContentModel.device))
+
     if device_id:
         # 获取特定设备的内容
-        device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+        device = load_device(request, db, device_id)
         if not device:
             raise HTTPException(status_code=404, detail="设备不存在")
-        
-        contents = db.query(ContentModel).filter(ContentModel.device_id == device_id).order_by(ContentModel.version.desc()).all()
-        return templates.TemplateResponse("admin/contents.html", {
-            "request": request,
-            "contents": contents,
-            "device": device,
-            "filtered": True
-        })
-    else:
-        # 获取所有内容
-        contents = db.query(ContentModel).order_by(ContentModel.created_at.desc()).all()
-        devices = db.query(DeviceModel).all()
-        
-        # 为每个内容添加设备信息
-        content_list = []
-        for content in contents:
-            device = db.query(DeviceModel).filter(DeviceModel.device_id == content.device_id).first()
-            content_list.append({
-                "content": content,
-                "device": device
-            })
-        
-        return templates.TemplateResponse("admin/contents.html", {
-            "request": request,
-            "content_list": content_list,
-            "devices": devices,
-            "filtered": False
-        })
+        query = query.filter(ContentModel.device_id == device_id)
+
+    if content_type == "image":
+        query = query.filter(ContentModel.image_path.isnot(None))
+    elif content_type == "text":
+        query = query.filter(ContentModel.image_path.is_(None))
+
+    if status == "active":
+        query = query.filter(ContentModel.is_active == True)
+    elif status == "inactive":
+        query = query.filter(ContentModel.is_active == False)
+
+    contents, next_cursor = fetch_page(
+        query,
+        [ContentModel.created_at, ContentModel.id],
+        cursor=cursor,
+        limit=settings.admin_page_size
+    )
+
+    return templates.TemplateResponse("admin/contents.html", {
+        "request": request,
+        "content_list": [{"content": content, "device": content.device} for content in contents],
+        "devices": get_device_choices(db),
+        "device_id": device_id,
+        "content_type": content_type,
+        "status": status,
+        "filtered": bool(device_id),
+        "cursor": cursor,
+        "next_cursor": next_cursor
+    })
 
 @admin_router.get("/contents/{device_id}/{version}", response_class=HTMLResponse)
-async def content_detail(request: Request, device_id: str, version: int, db: Session = Depends(get_db)):
+async def content_detail(request: Request, device_id: str, version: int, db: Session = Depends(get_read_db)):
     """
     内容详情页面
     """
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="设备不存在")
     
@@ -295,7 +300,7 @@ async def add_content(request: Request, device_id: Optional[str] = None, db: Ses
     添加内容页面和处理
     """
     if request.method == "GET":
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/add_content.html", {
             "request": request,
             "devices": devices,
@@ -311,9 +316,9 @@ async def add_content(request: Request, device_id: Optional[str] = None, db: Ses
     time_format = form.get("time_format", "%Y-%m-%d %H:%M")
     
     # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/add_content.html", {
             "request": request,
             "devices": devices,
@@ -339,6 +344,7 @@ async def add_content(request: Request, device_id: Optional[str] = None, db: Ses
     
     db.add(new_content)
     db.commit()
+    device_registry.invalidate(device_id)
     
     # 发送MQTT更新通知
     mqtt_manager.send_update_command(device_id, new_content.version)
@@ -352,7 +358,7 @@ async def upload_image(request: Request, db: Session = Depends(get_db)):
     图片上传页面和处理
     """
     if request.method == "GET":
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/upload_image.html", {
             "request": request,
             "devices": devices
@@ -365,9 +371,9 @@ async def upload_image(request: Request, db: Session = Depends(get_db)):
     file: UploadFile = form.get("image")
     
     # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/upload_image.html", {
             "request": request,
             "devices": devices,
@@ -376,7 +382,7 @@ async def upload_image(request: Request, db: Session = Depends(get_db)):
     
     # 检查文件类型
     if not file.content_type.startswith("image/"):
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/upload_image.html", {
             "request": request,
             "devices": devices,
@@ -399,7 +405,7 @@ async def upload_image(request: Request, db: Session = Depends(get_db)):
             ).first()
             
             if not content:
-                devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+                devices = get_active_devices(request, db)
                 return templates.TemplateResponse("admin/upload_image.html", {
                     "request": request,
                     "devices": devices,
@@ -408,6 +414,7 @@ async def upload_image(request: Request, db: Session = Depends(get_db)):
             
             content.image_path = processed_path
             db.commit()
+            device_registry.invalidate(device_id)
             
             # 发送MQTT更新通知
             mqtt_manager.send_update_command(device_id, int(version))
@@ -428,6 +435,7 @@ async def upload_image(request: Request, db: Session = Depends(get_db)):
             
             db.add(content)
             db.commit()
+            device_registry.invalidate(device_id)
             
             # 发送MQTT更新通知
             mqtt_manager.send_update_command(device_id, content.version)
@@ -435,7 +443,7 @@ async def upload_image(request: Request, db: Session = Depends(get_db)):
         return RedirectResponse(url=f"/admin/devices/{device_id}", status_code=303)
         
     except Exception as e:
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/upload_image.html", {
             "request": request,
             "devices": devices,
@@ -444,42 +452,63 @@ async def upload_image(request: Request, db: Session = Depends(get_db)):
 
 # 待办事项管理路由
 @admin_router.get("/todos", response_class=HTMLResponse)
-async def todos_list(request: Request, device_id: Optional[str] = None, db: Session = Depends(get_db)):
+async def todos_list(
+    request: Request,
+    device_id: Optional[str] = None,
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
     """
-    待办事项列表页面
+    待办事项列表页面（分页，设备信息随待办事项一次查询加载）
     """
+    query = db.query(TodoModel)
+
+    if status == "completed":
+        query = query.filter(TodoModel.is_completed == True)
+    elif status == "pending":
+        query = query.filter(TodoModel.is_completed == False)
+
+    keys = [TodoModel.created_at, TodoModel.id]
+
     if device_id:
         # 获取特定设备的待办事项
-        device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+        device = load_device(request, db, device_id)
         if not device:
             raise HTTPException(status_code=404, detail="设备不存在")
-        
-        todos = db.query(TodoModel).filter(TodoModel.device_id == device_id).order_by(TodoModel.created_at.desc()).all()
+
+        todos, next_cursor = fetch_page(
+            query.filter(TodoModel.device_id == device_id),
+            keys,
+            cursor=cursor,
+            limit=settings.admin_page_size
+        )
         return templates.TemplateResponse("admin/todos.html", {
             "request": request,
             "todos": todos,
             "device": device,
-            "filtered": True
+            "status": status,
+            "filtered": True,
+            "cursor": cursor,
+            "next_cursor": next_cursor
         })
     else:
-        # 获取所有待办事项
-        todos = db.query(TodoModel).order_by(TodoModel.created_at.desc()).all()
-        devices = db.query(DeviceModel).all()
-        
-        # 为每个待办事项添加设备信息
-        todo_list = []
-        for todo in todos:
-            device = db.query(DeviceModel).filter(DeviceModel.device_id == todo.device_id).first()
-            todo_list.append({
-                "todo": todo,
-                "device": device
-            })
-        
+        # 获取所有待办事项，设备信息通过连接一并加载
+        todos, next_cursor = fetch_page(
+            query.options(joinedload(TodoModel.device)),
+            keys,
+            cursor=cursor,
+            limit=settings.admin_page_size
+        )
+
         return templates.TemplateResponse("admin/todos.html", {
             "request": request,
-            "todo_list": todo_list,
-            "devices": devices,
-            "filtered": False
+            "todo_list": [{"todo": todo, "device": todo.device} for todo in todos],
+            "devices": get_device_choices(db),
+            "status": status,
+            "filtered": False,
+            "cursor": cursor,
+            "next_cursor": next_cursor
         })
 
 @admin_router.get("/todos/add", response_class=HTMLResponse)
@@ -489,7 +518,7 @@ async def add_todo(request: Request, device_id: Optional[str] = None, db: Sessio
     添加待办事项页面和处理
     """
     if request.method == "GET":
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/todo_add.html", {
             "request": request,
             "devices": devices,
@@ -504,9 +533,9 @@ async def add_todo(request: Request, device_id: Optional[str] = None, db: Sessio
     due_date_str = form.get("due_date")
     
     # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/todo_add.html", {
             "request": request,
             "devices": devices,
@@ -520,7 +549,7 @@ async def add_todo(request: Request, device_id: Optional[str] = None, db: Sessio
             from datetime import datetime
             due_date = datetime.strptime(due_date_str, "%Y-%m-%dT%H:%M")
         except ValueError:
-            devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+            devices = get_active_devices(request, db)
             return templates.TemplateResponse("admin/todo_add.html", {
                 "request": request,
                 "devices": devices,
@@ -537,6 +566,7 @@ async def add_todo(request: Request, device_id: Optional[str] = None, db: Sessio
     
     db.add(new_todo)
     db.commit()
+    device_registry.invalidate(device_id)
     
     # 发送MQTT通知给设备
     mqtt_manager.send_todo_command(device_id, "create", {
@@ -549,11 +579,11 @@ async def add_todo(request: Request, device_id: Optional[str] = None, db: Sessio
     return RedirectResponse(url="/admin/todos", status_code=303)
 
 @admin_router.get("/todos/{todo_id}", response_class=HTMLResponse)
-async def todo_detail(request: Request, todo_id: int, db: Session = Depends(get_db)):
+async def todo_detail(request: Request, todo_id: int, db: Session = Depends(get_read_db)):
     """
     待办事项详情页面
     """
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = get_todo(db, todo_id)
     if not todo:
         raise HTTPException(status_code=404, detail="待办事项不存在")
     
@@ -571,7 +601,7 @@ async def toggle_todo_status(todo_id: int, db: Session = Depends(get_db)):
     """
     切换待办事项完成状态
     """
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = get_todo(db, todo_id)
     if not todo:
         raise HTTPException(status_code=404, detail="待办事项不存在")
     
@@ -584,6 +614,7 @@ async def toggle_todo_status(todo_id: int, db: Session = Depends(get_db)):
     
     todo.updated_at = datetime.utcnow()
     db.commit()
+    device_registry.invalidate(todo.device_id)
     
     # 发送MQTT通知给设备
     mqtt_manager.send_todo_command(todo.device_id, "update", {
@@ -596,7 +627,7 @@ async def toggle_todo_status(todo_id: int, db: Session = Depends(get_db)):
 
 @admin_router.get("/todos/{todo_id}/edit", response_class=HTMLResponse)
 async def edit_todo_page(request: Request, todo_id: int, db: Session = Depends(get_db)):
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = get_todo(db, todo_id)
     if not todo:
         raise HTTPException(status_code=404, detail="待办事项不存在")
     
@@ -619,14 +650,16 @@ async def edit_todo(
     is_completed: bool = Form(False),
     db: Session = Depends(get_db)
 ):
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = get_todo(db, todo_id)
     if not todo:
         raise HTTPException(status_code=404, detail="待办事项不存在")
     
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="设备不存在")
     
+    previous_device_id = todo.device_id
+    
     # 更新待办事项
     todo.title = title
     todo.description = description if description else None
@@ -647,6 +680,9 @@ async def edit_todo(
     todo.updated_at = datetime.utcnow()
     
     db.commit()
+    device_registry.invalidate(device_id)
+    if previous_device_id != device_id:
+        device_registry.invalidate(previous_device_id)
     
     # 发送MQTT通知到设备
     if hasattr(request.app.state, 'mqtt_manager') and request.app.state.mqtt_manager:
@@ -676,7 +712,7 @@ async def delete_todo(
     """
     删除待办事项
     """
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = get_todo(db, todo_id)
     if not todo:
         raise HTTPException(status_code=404, detail="待办事项不存在")
     
@@ -697,47 +733,59 @@ async def delete_todo(
     
     db.delete(todo)
     db.commit()
+    device_registry.invalidate(device_id)
     
     return RedirectResponse(url=f"/admin/todos?device_id={device_id}", status_code=303)
 
 # 歌曲管理路由
 @admin_router.get("/songs", response_class=HTMLResponse)
-async def songs_list(request: Request, device_id: Optional[str] = None, db: Session = Depends(get_db)):
+async def songs_list(
+    request: Request,
+    device_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
     """
-    歌曲列表页面
+    歌曲列表页面（分页，设备信息随歌曲一次查询加载）
     """
+    keys = [SongModel.created_at, SongModel.id]
+
     if device_id:
         # 获取特定设备的歌曲
-        device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+        device = load_device(request, db, device_id)
         if not device:
             raise HTTPException(status_code=404, detail="设备不存在")
-        
-        songs = db.query(SongModel).filter(SongModel.device_id == device_id).order_by(SongModel.created_at.desc()).all()
+
+        songs, next_cursor = fetch_page(
+            db.query(SongModel).filter(SongModel.device_id == device_id),
+            keys,
+            cursor=cursor,
+            limit=settings.admin_page_size
+        )
         return templates.TemplateResponse("admin/songs.html", {
             "request": request,
             "songs": songs,
             "device": device,
-            "filtered": True
+            "filtered": True,
+            "cursor": cursor,
+            "next_cursor": next_cursor
         })
     else:
-        # 获取所有歌曲
-        songs = db.query(SongModel).order_by(SongModel.created_at.desc()).all()
-        devices = db.query(DeviceModel).all()
-        
-        # 为每个歌曲添加设备信息
-        song_list = []
-        for song in songs:
-            device = db.query(DeviceModel).filter(DeviceModel.device_id == song.device_id).first()
-            song_list.append({
-                "song": song,
-                "device": device
-            })
-        
+        # 获取所有歌曲，设备信息通过连接一并加载
+        songs, next_cursor = fetch_page(
+            db.query(SongModel).options(joinedload(SongModel.device)),
+            keys,
+            cursor=cursor,
+            limit=settings.admin_page_size
+        )
+
         return templates.TemplateResponse("admin/songs.html", {
             "request": request,
-            "song_list": song_list,
-            "devices": devices,
-            "filtered": False
+            "song_list": [{"song": song, "device": song.device} for song in songs],
+            "devices": get_device_choices(db),
+            "filtered": False,
+            "cursor": cursor,
+            "next_cursor": next_cursor
         })
 
 @admin_router.get("/songs/add", response_class=HTMLResponse)
@@ -747,7 +795,7 @@ async def add_song(request: Request, device_id: Optional[str] = None, db: Sessio
     添加歌曲页面和处理
     """
     if request.method == "GET":
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/song_add.html", {
             "request": request,
             "devices": devices,
@@ -763,9 +811,9 @@ async def add_song(request: Request, device_id: Optional[str] = None, db: Sessio
     notes_json = form.get("notes")
     
     # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/song_add.html", {
             "request": request,
             "devices": devices,
@@ -778,7 +826,7 @@ async def add_song(request: Request, device_id: Optional[str] = None, db: Sessio
         SongModel.song_id == int(song_id)
     ).first()
     if existing_song:
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/song_add.html", {
             "request": request,
             "devices": devices,
@@ -794,24 +842,25 @@ async def add_song(request: Request, device_id: Optional[str] = None, db: Sessio
             device_id=device_id,
             song_id=int(song_id),
             name=name,
-            tempo=str(tempo),
-            notes=notes_json
+            tempo=str(tempo)
         )
+        set_song_notes(new_song, notes)
         
         db.add(new_song)
         db.commit()
+        device_registry.invalidate(device_id)
         
         return RedirectResponse(url="/admin/songs", status_code=303)
         
     except json.JSONDecodeError:
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/song_add.html", {
             "request": request,
             "devices": devices,
             "error": "音符数据格式不正确，请输入有效的JSON格式"
         })
     except ValueError:
-        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        devices = get_active_devices(request, db)
         return templates.TemplateResponse("admin/song_add.html", {
             "request": request,
             "devices": devices,
@@ -819,7 +868,7 @@ async def add_song(request: Request, device_id: Optional[str] = None, db: Sessio
         })
 
 @admin_router.get("/songs/{song_id}", response_class=HTMLResponse)
-async def song_detail(request: Request, song_id: int, db: Session = Depends(get_db)):
+async def song_detail(request: Request, song_id: int, db: Session = Depends(get_read_db)):
     """
     歌曲详情页面
     """
@@ -830,12 +879,8 @@ async def song_detail(request: Request, song_id: int, db: Session = Depends(get_
     # 获取设备信息
     device = db.query(DeviceModel).filter(DeviceModel.device_id == song.device_id).first()
     
-    # 解析音符数据
-    notes = []
-    try:
-        notes = json.loads(song.notes)
-    except json.JSONDecodeError:
-        notes = []
+    # 解析音符数据（带缓存）
+    notes = parse_song(song)[1]
     
     return templates.TemplateResponse("admin/song_detail.html", {
         "request": request,
@@ -879,13 +924,13 @@ async def edit_song(
     if not song:
         raise HTTPException(status_code=404, detail="歌曲不存在")
     
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="设备不存在")
     
     try:
         # 验证JSON格式
-        json.loads(notes)
+        parsed_notes = json.loads(notes)
         
         # 检查歌曲ID冲突（如果改变了歌曲ID）
         if song.song_id != song_number:
@@ -903,15 +948,20 @@ async def edit_song(
                     "error": "歌曲ID已存在"
                 })
         
-        # 更新歌曲
+        # 更新歌曲（引用曲库的歌曲转为设备独立副本）
+        previous_device_id = song.device_id
+        detach_library_song(song)
         song.device_id = device_id
         song.song_id = song_number
         song.name = name
         song.tempo = str(tempo)
-        song.notes = notes
+        set_song_notes(song, parsed_notes)
         song.updated_at = datetime.utcnow()
         
         db.commit()
+        device_registry.invalidate(device_id)
+        if previous_device_id != device_id:
+            device_registry.invalidate(previous_device_id)
         
         return RedirectResponse(url=f"/admin/songs/{song_id}", status_code=303)
         
@@ -941,66 +991,26 @@ async def delete_song(
     
     db.delete(song)
     db.commit()
+    device_registry.invalidate(device_id)
     
     return RedirectResponse(url=f"/admin/songs?device_id={device_id}", status_code=303)
 
 @admin_router.post("/songs/batch", response_class=HTMLResponse)
 async def create_batch_songs(request: Request, db: Session = Depends(get_db)):
     """
-    批量创建预定义歌曲
+    为设备分配预定义歌曲（引用共享曲库）
     """
     form = await request.form()
     device_id = form.get("device_id")
     
     # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
+    device = load_device(request, db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="设备不存在")
     
-    # 预定义歌曲数据
-    SONGS_EXT = {
-        1: {
-            "name": "Super Mario Theme",
-            "tempo": 1.2,
-            "notes": [['E5', 100], ['E5', 100], ['REST', 100], ['E5', 100],
-                     ['REST', 100], ['C5', 100], ['E5', 100], ['REST', 100],
-                     ['G5', 100], ['REST', 300], ['G4', 100], ['REST', 300],
-                     ['C5', 150], ['REST', 50], ['G4', 150], ['REST', 150],
-                     ['E4', 150], ['REST', 100], ['A4', 100], ['B4', 100],
-                     ['AS4', 50], ['A4', 100], ['G4', 100], ['E5', 100], ['G5', 100],
-                     ['A5', 100], ['F5', 100], ['G5', 100], ['REST', 50],
-                     ['E5', 100], ['C5', 100], ['D5', 100], ['B4', 100]]
-        },
-        2: {
-            "name": "Star Wars - Imperial March",
-            "tempo": 1.0,
-            "notes": [['A3', 500], ['A3', 500], ['A3', 500], ['F3', 350], ['C4', 150],
-                     ['A3', 500], ['F3', 350], ['C4', 150], ['A3', 1000],
-                     ['E4', 500], ['E4', 500], ['E4', 500], ['F4', 350], ['C4', 150],
-                     ['GS3', 500], ['F3', 350], ['C4', 150], ['A3', 1000]]
-        }
-    }
-    
-    created_count = 0
-    for song_id, song_data in SONGS_EXT.items():
-        # 检查歌曲是否已存在
-        existing_song = db.query(SongModel).filter(
-            SongModel.device_id == device_id,
-            SongModel.song_id == song_id
-        ).first()
-        
-        if not existing_song:
-            # 创建新歌曲
-            new_song = SongModel(
-                device_id=device_id,
-                song_id=song_id,
-                name=song_data["name"],
-                tempo=str(song_data["tempo"]),
-                notes=json.dumps(song_data["notes"])
-            )
-            db.add(new_song)
-            created_count += 1
-    
+    library = ensure_default_library(db)
+    assign_library_songs(db, [device_id], library)
     db.commit()
+    device_registry.invalidate(device_id)
     
-    return RedirectResponse(url=f"/admin/songs?device_id={device_id}", status_code=303)
\ No newline at end of file
+    return RedirectResponse(url=f"/admin/songs?device_id={device_id}", status_code=303)
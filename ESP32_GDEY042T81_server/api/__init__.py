@@ -1,9 +1,13 @@
 from fastapi import APIRouter
-from api import devices, contents, todos
+from api import devices, contents, todos, songs, retention, telemetry, commands
 
 api_router = APIRouter()
 
 # 注册所有路由，并添加全局安全要求
 api_router.include_router(devices.router, prefix="/devices")
 api_router.include_router(contents.router, prefix="/contents")
-api_router.include_router(todos.router, prefix="/todos")
\ No newline at end of file
+api_router.include_router(todos.router, prefix="/todos")
+api_router.include_router(songs.router, prefix="/songs")
+api_router.include_router(retention.router, prefix="/retention")
+api_router.include_router(telemetry.router, prefix="/telemetry")
+api_router.include_router(commands.router, prefix="/commands")
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import Session
+
+from config import settings
+from database import get_db
+from models import Device as DeviceModel, Content as ContentModel
+from schemas import CommandPush, CommandPushResult, MQTTCommand
+from auth import get_api_key
+from mqtt_manager import mqtt_manager, group_command_topic, device_command_topic
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    tags=["commands"]
+)
+
+
+async def publish_and_wait(messages) -> float:
+    """
+    直接发布消息并等待全部确认
+
+    Args:
+        messages: (主题, 消息内容) 列表
+
+    Returns:
+        单条消息的最长确认耗时（秒）
+    """
+    try:
+        latencies = await asyncio.gather(*[
+            mqtt_manager.publish_async(
+                topic, payload, qos=settings.mqtt_command_qos, timeout=settings.mqtt_outbound_ack_timeout
+            )
+            for topic, payload in messages
+        ])
+    except ConnectionError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"MQTT发布失败: {str(e)}"
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="等待MQTT代理确认超时"
+        )
+    return max(latencies)
+
+
+@router.post("/push", response_model=CommandPushResult, dependencies=[Depends(get_api_key)])
+async def push_command(push: CommandPush, db: Session = Depends(get_db)):
+    """
+    向场景、指定设备或全部设备推送命令
+
+    命令内容对所有设备相同且目标为场景或全部设备时，通过分组主题一次发布；
+    需要按设备区分内容（未指定版本的update命令）或目标为设备列表时，
+    一次查询出目标设备后全部加入发送队列，由发送线程流水线发布。
+    wait为true时直接发布并等待代理确认所有消息后返回（等待前先归还数据库连接）。
+    """
+    if sum([push.scene is not None, push.device_ids is not None, push.all_devices]) != 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="scene、device_ids、all_devices 必须且只能指定一个"
+        )
+    if push.device_ids is not None and not push.device_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="设备列表不能为空"
+        )
+
+    personalized = push.type == "update" and push.content_version is None
+    timestamp = int(time.time())
+    started = time.perf_counter()
+
+    if push.device_ids is None and not personalized:
+        # 命令内容相同：一次分组发布
+        query = db.query(func.count(DeviceModel.id)).filter(DeviceModel.is_active == True)
+        if push.scene is not None:
+            query = query.filter(DeviceModel.scene == push.scene)
+        target_count = query.scalar()
+        if not target_count:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="没有可推送的设备"
+            )
+        resolved = time.perf_counter()
+        # 目标已查询完毕，归还连接（SQLite模式下只有一个写连接，等待确认期间不能占用）
+        db.close()
+
+        command = MQTTCommand(type=push.type, content_version=push.content_version, timestamp=timestamp)
+        topic = group_command_topic(push.scene)
+        delivery = None
+        if push.wait:
+            delivery = await publish_and_wait([(topic, command.model_dump_json())])
+        else:
+            mqtt_manager.publish_group_command(command, push.scene)
+        finished = time.perf_counter()
+
+        logger.info(f"分组推送 {push.type} 命令到 {topic}，目标 {target_count} 个设备")
+        return {
+            "mode": "group",
+            "topic": topic,
+            "target_count": target_count,
+            "publish_count": 1,
+            "resolve_ms": round((resolved - started) * 1000, 2),
+            "fanout_ms": round((finished - resolved) * 1000, 2),
+            "delivery_ms": round(delivery * 1000, 2) if delivery is not None else None
+        }
+
+    # 逐设备发布：一次查询目标设备及各自的最新活跃版本
+    query = select(DeviceModel.device_id, func.max(ContentModel.version)).outerjoin(
+        ContentModel,
+        and_(
+            ContentModel.device_id == DeviceModel.device_id,
+            ContentModel.is_active == True
+        )
+    ).where(DeviceModel.is_active == True)
+    if push.scene is not None:
+        query = query.where(DeviceModel.scene == push.scene)
+    if push.device_ids is not None:
+        query = query.where(DeviceModel.device_id.in_(set(push.device_ids)))
+    rows = db.execute(query.group_by(DeviceModel.device_id)).all()
+
+    commands = []
+    skipped = []
+    for device_id, latest_version in rows:
+        if personalized and latest_version is None:
+            skipped.append(device_id)
+            continue
+        version = latest_version if personalized else push.content_version
+        commands.append((device_id, MQTTCommand(type=push.type, content_version=version, timestamp=timestamp)))
+    if push.device_ids is not None:
+        found = {device_id for device_id, _ in rows}
+        skipped.extend(device_id for device_id in dict.fromkeys(push.device_ids) if device_id not in found)
+    if not commands:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="没有可推送的设备"
+        )
+    resolved = time.perf_counter()
+    db.close()
+
+    delivery = None
+    if push.wait:
+        delivery = await publish_and_wait([
+            (device_command_topic(device_id), command.model_dump_json()) for device_id, command in commands
+        ])
+        publish_count = len(commands)
+    elif push.type == "update":
+        # 开启了帧缓冲推送的设备直接推送画面
+        publish_count = mqtt_manager.send_update_commands({
+            device_id: command.content_version for device_id, command in commands
+        })
+    else:
+        publish_count = mqtt_manager.publish_commands(commands)
+    finished = time.perf_counter()
+
+    logger.info(
+        f"逐设备推送 {push.type} 命令 {publish_count} 条，"
+        f"加入发送队列耗时 {(finished - resolved) * 1000:.1f}ms"
+    )
+    return {
+        "mode": "per_device",
+        "target_count": len(commands),
+        "publish_count": publish_count,
+        "skipped": skipped,
+        "resolve_ms": round((resolved - started) * 1000, 2),
+        "fanout_ms": round((finished - resolved) * 1000, 2),
+        "delivery_ms": round(delivery * 1000, 2) if delivery is not None else None
+    }
@@ -1,6 +1,6 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query, File, UploadFile, Security, Response
+from fastapi import APIRouter, Depends, HTTPException, status, Query, File, UploadFile, Security, Response, Request
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, insert
 from typing import List, Optional
 import json
 import os
@@ -9,12 +9,24 @@ import tempfile
 import importlib.util
 
 from database import get_db
-from schemas import Content as ContentSchema, ContentCreate, ContentUpdate, ContentResponse
+from db_router import get_read_db
+from schemas import Content as ContentSchema, ContentCreate, ContentUpdate, ContentResponse, BulkItemResult
 from models import Content as ContentModel, Device as DeviceModel
 from mqtt_manager import mqtt_manager
 from image_processor import image_processor
 from config import settings
 from auth import get_api_key
+from device_registry import device_registry, MISSING
+from pagination import fetch_page, set_next_cursor
+from framebuffer_cache import framebuffer_cache, image_fingerprint
+from device_state import heartbeat_buffer
+from repository import get_content_by_version, get_max_version
+from dependencies import (
+    require_device,
+    get_device_with_content,
+    get_device_with_latest_content,
+    ensure_device_exists
+)
 
 router = APIRouter(
     tags=["contents"]
@@ -24,23 +36,15 @@ router = APIRouter(
 async def create_content(
     device_id: str, 
     content: ContentCreate, 
+    device: DeviceModel = Depends(require_device),
     db: Session = Depends(get_db)
 ):
     """
     为设备创建新内容版本
     """
-    # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
     
     # 获取当前最大版本号
-    max_version = db.query(func.max(ContentModel.version)).filter(
-        ContentModel.device_id == device_id
-    ).scalar() or 0
+    max_version = get_max_version(db, device_id)
     
     # 创建新内容
     db_content = ContentModel(
@@ -57,60 +61,159 @@ async def create_content(
     db.add(db_content)
     db.commit()
     db.refresh(db_content)
+    device_registry.invalidate(device_id)
     
     # 发送MQTT更新通知
     mqtt_manager.send_update_command(device_id, db_content.version)
     
     return db_content
 
+@router.post("/bulk", response_model=List[BulkItemResult], dependencies=[Depends(get_api_key)])
+async def create_contents_bulk(contents: List[ContentCreate], db: Session = Depends(get_db)):
+    """
+    批量创建内容版本（单个事务）
+    
+    一次查询校验设备并获取各设备当前最大版本号，一次批量插入，
+    每个设备只发送一条携带最终版本的更新通知
+    """
+    results: List[Optional[BulkItemResult]] = [None] * len(contents)
+    
+    # 一次查询获取设备是否存在以及当前最大版本号
+    requested_ids = {content.device_id for content in contents}
+    max_versions = {
+        device_id: max_version or 0
+        for device_id, max_version in db.query(
+            DeviceModel.device_id, func.max(ContentModel.version)
+        ).outerjoin(
+            ContentModel, ContentModel.device_id == DeviceModel.device_id
+        ).filter(
+            DeviceModel.device_id.in_(requested_ids)
+        ).group_by(DeviceModel.device_id).all()
+    } if requested_ids else {}
+    
+    rows = []
+    row_indexes = []
+    for index, content in enumerate(contents):
+        if content.device_id not in max_versions:
+            results[index] = BulkItemResult(
+                index=index, success=False, device_id=content.device_id, error="设备不存在"
+            )
+            continue
+        
+        max_versions[content.device_id] += 1
+        rows.append({
+            "device_id": content.device_id,
+            "version": max_versions[content.device_id],
+            "title": content.title,
+            "description": content.description,
+            "image_path": content.image_path,
+            "layout_config": content.layout_config,
+            "timezone": content.timezone,
+            "time_format": content.time_format
+        })
+        row_indexes.append(index)
+    
+    if rows:
+        # RETURNING的行顺序与插入参数顺序一致
+        inserted_ids = db.execute(insert(ContentModel).returning(ContentModel.id, sort_by_parameter_order=True), rows).scalars().all()
+        db.commit()
+        
+        latest_versions = {}
+        for index, row, content_id in zip(row_indexes, rows, inserted_ids):
+            results[index] = BulkItemResult(
+                index=index, success=True, id=content_id, device_id=row["device_id"], version=row["version"]
+            )
+            latest_versions[row["device_id"]] = row["version"]
+        
+        # 每个设备只发送一条更新通知，携带最终版本（一次加入发送队列）
+        for device_id in latest_versions:
+            device_registry.invalidate(device_id)
+        mqtt_manager.send_update_commands(latest_versions)
+    
+    return results
+
 @router.get("/devices/{device_id}/content", response_model=List[ContentSchema], dependencies=[Depends(get_api_key)])
 async def list_content(
+    request: Request,
+    response: Response,
     device_id: str,
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,
     is_active: Optional[bool] = None,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取设备内容列表
+    
+    提供cursor时按版本号游标分页，下一页游标通过X-Next-Cursor响应头返回
+    """
+    query = db.query(ContentModel).filter(ContentModel.device_id == device_id)
+    
+    if is_active is not None:
+        query = query.filter(ContentModel.is_active == is_active)
+    
+    contents, next_cursor = fetch_page(
+        query, [ContentModel.version], cursor=cursor, skip=skip, limit=limit
+    )
+    set_next_cursor(response, next_cursor)
+    
+    # 结果为空时才需要区分"设备不存在"和"没有内容"
+    return ensure_device_exists(request, db, device_id, contents)
+
+@router.get("/devices/{device_id}/content/latest", response_model=ContentResponse)
+async def get_latest_content(request: Request, device_id: str, db: Session = Depends(get_read_db)):
+    """
+    获取设备的最新活跃内容
     """
-    # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
+    # 一次查询同时校验设备并获取最新的活跃内容
+    device, content = get_device_with_latest_content(request, db, device_id)
+    heartbeat_buffer.record(device_id)
+    
+    if not content:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
+            detail="设备没有活跃内容"
         )
     
-    query = db.query(ContentModel).filter(ContentModel.device_id == device_id)
+    # 构建图片URL
+    image_url = None
+    if content.image_path:
+        # 确保路径是相对路径
+        rel_path = os.path.relpath(content.image_path)
+        image_url = f"/static/{rel_path}"
     
-    if is_active is not None:
-        query = query.filter(ContentModel.is_active == is_active)
+    # 解析布局配置
+    layout_config = None
+    if content.layout_config:
+        try:
+            layout_config = json.loads(content.layout_config)
+        except json.JSONDecodeError:
+            layout_config = None
     
-    contents = query.order_by(ContentModel.version.desc()).offset(skip).limit(limit).all()
-    return contents
+    return ContentResponse(
+        version=content.version,
+        title=content.title,
+        description=content.description,
+        image_url=image_url,
+        layout_config=layout_config,
+        timezone=content.timezone,
+        time_format=content.time_format,
+        created_at=content.created_at
+    )
 
 @router.get("/devices/{device_id}/content/{version}", response_model=ContentResponse, dependencies=[Depends(get_api_key)])
 async def get_content(
+    request: Request,
     device_id: str,
     version: int,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取特定版本的内容详情
     """
-    # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
-    
-    content = db.query(ContentModel).filter(
-        ContentModel.device_id == device_id,
-        ContentModel.version == version
-    ).first()
+    # 一次查询同时校验设备并获取内容
+    device, content = get_device_with_content(request, db, device_id, version)
     
     if not content:
         raise HTTPException(
@@ -154,10 +257,7 @@ async def update_content(
     """
     更新内容
     """
-    content = db.query(ContentModel).filter(
-        ContentModel.device_id == device_id,
-        ContentModel.version == version
-    ).first()
+    content = get_content_by_version(db, device_id, version)
     
     if not content:
         raise HTTPException(
@@ -172,6 +272,7 @@ async def update_content(
     
     db.commit()
     db.refresh(content)
+    device_registry.invalidate(device_id)
     
     # 如果内容被激活，发送MQTT更新通知
     if content.is_active:
@@ -188,10 +289,7 @@ async def delete_content(
     """
     删除内容
     """
-    content = db.query(ContentModel).filter(
-        ContentModel.device_id == device_id,
-        ContentModel.version == version
-    ).first()
+    content = get_content_by_version(db, device_id, version)
     
     if not content:
         raise HTTPException(
@@ -201,75 +299,20 @@ async def delete_content(
     
     db.delete(content)
     db.commit()
-
-@router.get("/devices/{device_id}/content/latest", response_model=ContentResponse)
-async def get_latest_content(device_id: str, db: Session = Depends(get_db)):
-    """
-    获取设备的最新活跃内容
-    """
-    # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
-    
-    # 获取最新的活跃内容
-    content = db.query(ContentModel).filter(
-        ContentModel.device_id == device_id,
-        ContentModel.is_active == True
-    ).order_by(ContentModel.version.desc()).first()
-    
-    if not content:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备没有活跃内容"
-        )
-    
-    # 构建图片URL
-    image_url = None
-    if content.image_path:
-        # 确保路径是相对路径
-        rel_path = os.path.relpath(content.image_path)
-        image_url = f"/static/{rel_path}"
-    
-    # 解析布局配置
-    layout_config = None
-    if content.layout_config:
-        try:
-            layout_config = json.loads(content.layout_config)
-        except json.JSONDecodeError:
-            layout_config = None
-    
-    return ContentResponse(
-        version=content.version,
-        title=content.title,
-        description=content.description,
-        image_url=image_url,
-        layout_config=layout_config,
-        timezone=content.timezone,
-        time_format=content.time_format,
-        created_at=content.created_at
-    )
+    device_registry.invalidate(device_id)
+    framebuffer_cache.remove_version(device_id, version)
 
 @router.post("/upload", dependencies=[Depends(get_api_key)])
 async def upload_image(
     device_id: str = Query(..., description="设备ID"),
     version: Optional[int] = Query(None, description="内容版本，如果提供则更新指定版本"),
     file: UploadFile = File(...),
+    device: DeviceModel = Depends(require_device),
     db: Session = Depends(get_db)
 ):
     """
     上传图片并处理为墨水屏兼容格式
     """
-    # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
     
     # 检查文件类型
     if not file.content_type.startswith("image/"):
@@ -288,10 +331,7 @@ async def upload_image(
         
         # 如果提供了版本号，更新指定版本
         if version:
-            content = db.query(ContentModel).filter(
-                ContentModel.device_id == device_id,
-                ContentModel.version == version
-            ).first()
+            content = get_content_by_version(db, device_id, version)
             
             if not content:
                 raise HTTPException(
@@ -301,14 +341,13 @@ async def upload_image(
             
             content.image_path = processed_path
             db.commit()
+            device_registry.invalidate(device_id)
             
             # 发送MQTT更新通知
             mqtt_manager.send_update_command(device_id, version)
         else:
             # 创建新内容版本
-            max_version = db.query(func.max(ContentModel.version)).filter(
-                ContentModel.device_id == device_id
-            ).scalar() or 0
+            max_version = get_max_version(db, device_id)
             
             content = ContentModel(
                 device_id=device_id,
@@ -321,6 +360,7 @@ async def upload_image(
             db.add(content)
             db.commit()
             db.refresh(content)
+            device_registry.invalidate(device_id)
             
             # 发送MQTT更新通知
             mqtt_manager.send_update_command(device_id, content.version)
@@ -341,6 +381,21 @@ async def upload_image(
             detail=f"图片处理失败: {str(e)}"
         )
 
+def content_etag(
+    device_id: str,
+    version: int,
+    invert: bool,
+    rotate: bool,
+    dither: bool,
+    image_path: Optional[str] = None
+) -> str:
+    """
+    生成内容二进制数据的ETag（由设备、版本、图片和转换参数唯一确定）
+
+    上传接口和内容更新可以原地替换某个版本的图片，图片指纹保证替换后ETag随之变化
+    """
+    return f'"{device_id}-v{version}-{image_fingerprint(image_path)}-{int(invert)}{int(rotate)}{int(dither)}"'
+
 def convert_to_binary_data(image_path: str, width: int = 400, height: int = 300, invert: bool = False, rotate: bool = False, dither: bool = True) -> bytes:
     """
     使用image_converter.py工具将图片转换为二进制数据
@@ -422,28 +477,19 @@ def convert_to_binary_data(image_path: str, width: int = 400, height: int = 300,
 
 @router.get("/devices/{device_id}/content/latest/binary", dependencies=[Depends(get_api_key)])
 async def get_latest_content_binary(
+    request: Request,
     device_id: str,
     invert: bool = Query(False, description="是否反转颜色"),
     rotate: bool = Query(False, description="是否旋转90度"),
     dither: bool = Query(True, description="是否使用抖动算法"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取设备最新活跃内容的二进制数据，适用于墨水屏显示
     """
-    # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
-    
-    # 获取最新的活跃内容
-    content = db.query(ContentModel).filter(
-        ContentModel.device_id == device_id,
-        ContentModel.is_active == True
-    ).order_by(ContentModel.version.desc()).first()
+    # 一次查询同时校验设备并获取最新的活跃内容
+    device, content = get_device_with_latest_content(request, db, device_id)
+    heartbeat_buffer.record(device_id)
     
     if not content:
         raise HTTPException(
@@ -478,13 +524,19 @@ async def get_latest_content_binary(
             )
         
         # 转换为二进制数据
-        binary_data = convert_to_binary_data(
-            image_path,
-            width=settings.ink_width,
-            height=settings.ink_height,
-            invert=invert,
-            rotate=rotate,
-            dither=dither
+        binary_data = framebuffer_cache.get_or_build(
+            device_id,
+            content.version,
+            content.image_path,
+            (invert, rotate, dither),
+            lambda: convert_to_binary_data(
+                image_path,
+                width=settings.ink_width,
+                height=settings.ink_height,
+                invert=invert,
+                rotate=rotate,
+                dither=dither
+            )
         )
         
         # 返回二进制数据
@@ -505,28 +557,44 @@ async def get_latest_content_binary(
 
 @router.get("/public/devices/{device_id}/content/latest/binary")
 async def get_latest_content_binary_public(
+    request: Request,
     device_id: str,
     invert: bool = Query(False, description="是否反转颜色"),
     rotate: bool = Query(False, description="是否旋转90度"),
     dither: bool = Query(True, description="是否使用抖动算法"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取设备最新活跃内容的二进制数据，适用于墨水屏显示（无需鉴权）
     """
-    # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
+    # 先查设备注册表，命中时404/304无需访问数据库
+    entry = device_registry.get(device_id)
+    if entry is not None:
+        if not entry.exists:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="设备不存在"
+            )
+        heartbeat_buffer.record(device_id)
+        if entry.current_version is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="设备没有活跃内容"
+            )
+        etag = content_etag(device_id, entry.current_version, invert, rotate, dither, entry.current_image)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
     
-    # 获取最新的活跃内容
-    content = db.query(ContentModel).filter(
-        ContentModel.device_id == device_id,
-        ContentModel.is_active == True
-    ).order_by(ContentModel.version.desc()).first()
+    # 一次查询同时校验设备并获取最新的活跃内容
+    generation = device_registry.session_generation(db, device_id)
+    try:
+        device, content = get_device_with_latest_content(request, db, device_id)
+    except HTTPException:
+        device_registry.put(device_id, MISSING, generation)
+        raise
+    
+    device_registry.remember(device, content, generation)
+    heartbeat_buffer.record(device_id)
     
     if not content:
         raise HTTPException(
@@ -534,6 +602,10 @@ async def get_latest_content_binary_public(
             detail="设备没有活跃内容"
         )
     
+    etag = content_etag(device_id, content.version, invert, rotate, dither, content.image_path)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    
     if not content.image_path:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -561,13 +633,19 @@ async def get_latest_content_binary_public(
             )
         
         # 转换为二进制数据
-        binary_data = convert_to_binary_data(
-            image_path,
-            width=settings.ink_width,
-            height=settings.ink_height,
-            invert=invert,
-            rotate=rotate,
-            dither=dither
+        binary_data = framebuffer_cache.get_or_build(
+            device_id,
+            content.version,
+            content.image_path,
+            (invert, rotate, dither),
+            lambda: convert_to_binary_data(
+                image_path,
+                width=settings.ink_width,
+                height=settings.ink_height,
+                invert=invert,
+                rotate=rotate,
+                dither=dither
+            )
         )
         
         # 返回二进制数据
@@ -576,7 +654,8 @@ async def get_latest_content_binary_public(
             media_type="application/octet-stream",
             headers={
                 "Content-Disposition": f"attachment; filename={device_id}_latest.bin",
-                "Content-Length": str(len(binary_data))
+                "Content-Length": str(len(binary_data)),
+                "ETag": etag
             }
         )
         
@@ -588,29 +667,20 @@ async def get_latest_content_binary_public(
 
 @router.get("/devices/{device_id}/content/{version}/binary", dependencies=[Depends(get_api_key)])
 async def get_content_binary(
+    request: Request,
     device_id: str,
     version: int,
     invert: bool = Query(False, description="是否反转颜色"),
     rotate: bool = Query(False, description="是否旋转90度"),
     dither: bool = Query(True, description="是否使用抖动算法"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取内容的二进制数据，适用于墨水屏显示
     """
-    # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
-    
-    # 获取内容
-    content = db.query(ContentModel).filter(
-        ContentModel.device_id == device_id,
-        ContentModel.version == version
-    ).first()
+    # 一次查询同时校验设备并获取内容
+    device, content = get_device_with_content(request, db, device_id, version)
+    heartbeat_buffer.record(device_id)
     
     if not content:
         raise HTTPException(
@@ -645,13 +715,19 @@ async def get_content_binary(
             )
         
         # 转换为二进制数据
-        binary_data = convert_to_binary_data(
-            image_path,
-            width=settings.ink_width,
-            height=settings.ink_height,
-            invert=invert,
-            rotate=rotate,
-            dither=dither
+        binary_data = framebuffer_cache.get_or_build(
+            device_id,
+            content.version,
+            content.image_path,
+            (invert, rotate, dither),
+            lambda: convert_to_binary_data(
+                image_path,
+                width=settings.ink_width,
+                height=settings.ink_height,
+                invert=invert,
+                rotate=rotate,
+                dither=dither
+            )
         )
         
         # 返回二进制数据
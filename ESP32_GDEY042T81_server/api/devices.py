@@ -1,16 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Security
+from fastapi import APIRouter, Depends, HTTPException, status, Security, Request, Response
 from sqlalchemy.orm import Session
+from sqlalchemy import insert
 from typing import List, Optional
 from datetime import datetime
 import secrets
 import json
 
 from database import get_db
-from schemas import Device as DeviceSchema, DeviceCreate, DeviceUpdate, BootstrapResponse, Song, SongCreate, SongUpdate
+from db_router import get_read_db
+from schemas import Device as DeviceSchema, DeviceCreate, DeviceUpdate, BootstrapResponse, Song, SongCreate, SongUpdate, BulkItemResult, PresenceSummary
 from models import Device as DeviceModel
 from database import Content as ContentModel, Song as SongModel
-from mqtt_manager import mqtt_manager
+from mqtt_manager import mqtt_manager, RESERVED_DEVICE_IDS
 from auth import get_api_key
+from device_registry import device_registry
+from pagination import fetch_page, set_next_cursor
+from framebuffer_cache import framebuffer_cache
+from device_state import heartbeat_buffer
+from presence import presence_tracker
+from bootstrap import bootstrap_cache
+from song_codec import set_song_notes, song_to_dict, detach_library_song
+from song_compiler import compile_song
+from song_library import ensure_default_library, assign_library_songs
+from dependencies import require_device, require_read_device, get_device_or_404, ensure_device_exists
 
 router = APIRouter(
     tags=["devices"]
@@ -21,6 +33,12 @@ async def create_device(device: DeviceCreate, db: Session = Depends(get_db)):
     """
     注册新设备
     """
+    if device.device_id in RESERVED_DEVICE_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="设备ID与MQTT分组主题冲突，不能使用"
+        )
+    
     # 检查设备ID是否已存在
     db_device = db.query(DeviceModel).filter(DeviceModel.device_id == device.device_id).first()
     if db_device:
@@ -41,22 +59,83 @@ async def create_device(device: DeviceCreate, db: Session = Depends(get_db)):
     db.add(db_device)
     db.commit()
     db.refresh(db_device)
-    
-    # 订阅设备状态
-    mqtt_manager.subscribe_to_device_status(device.device_id)
+    presence_tracker.add(device.device_id)
+    device_registry.invalidate(device.device_id)
     
     return db_device
 
+@router.post("/bulk", response_model=List[BulkItemResult], dependencies=[Depends(get_api_key)])
+async def create_devices_bulk(devices: List[DeviceCreate], db: Session = Depends(get_db)):
+    """
+    批量注册设备（单个事务）
+    
+    一次查询校验所有设备ID，一次批量插入，逐项返回结果
+    """
+    results: List[Optional[BulkItemResult]] = [None] * len(devices)
+    
+    # 一次查询找出已存在的设备ID
+    requested_ids = {device.device_id for device in devices}
+    existing_ids = {
+        row[0] for row in db.query(DeviceModel.device_id).filter(
+            DeviceModel.device_id.in_(requested_ids)
+        ).all()
+    } if requested_ids else set()
+    
+    rows = []
+    row_indexes = []
+    seen_ids = set()
+    for index, device in enumerate(devices):
+        if device.device_id in RESERVED_DEVICE_IDS:
+            results[index] = BulkItemResult(
+                index=index, success=False, device_id=device.device_id, error="设备ID与MQTT分组主题冲突，不能使用"
+            )
+            continue
+        if device.device_id in existing_ids or device.device_id in seen_ids:
+            results[index] = BulkItemResult(
+                index=index, success=False, device_id=device.device_id, error="设备ID已存在"
+            )
+            continue
+        
+        seen_ids.add(device.device_id)
+        rows.append({
+            "device_id": device.device_id,
+            "secret": device.secret if device.secret else secrets.token_urlsafe(32),
+            "name": device.name,
+            "scene": device.scene
+        })
+        row_indexes.append(index)
+    
+    if rows:
+        inserted = db.execute(
+            insert(DeviceModel).returning(DeviceModel.id, DeviceModel.device_id),
+            rows
+        ).all()
+        db.commit()
+        
+        ids = {device_id: device_pk for device_pk, device_id in inserted}
+        for index, row in zip(row_indexes, rows):
+            results[index] = BulkItemResult(
+                index=index, success=True, id=ids.get(row["device_id"]), device_id=row["device_id"]
+            )
+            device_registry.invalidate(row["device_id"])
+            presence_tracker.add(row["device_id"])
+    
+    return results
+
 @router.get("/", response_model=List[DeviceSchema], dependencies=[Depends(get_api_key)])
 async def list_devices(
+    response: Response,
     skip: int = 0, 
     limit: int = 100, 
+    cursor: Optional[str] = None,
     scene: Optional[str] = None,
     is_active: Optional[bool] = None,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取设备列表
+    
+    提供cursor时使用游标分页，下一页游标通过X-Next-Cursor响应头返回
     """
     query = db.query(DeviceModel)
     
@@ -66,37 +145,39 @@ async def list_devices(
     if is_active is not None:
         query = query.filter(DeviceModel.is_active == is_active)
     
-    devices = query.offset(skip).limit(limit).all()
+    devices, next_cursor = fetch_page(
+        query, [DeviceModel.created_at, DeviceModel.id], cursor=cursor, skip=skip, limit=limit
+    )
+    set_next_cursor(response, next_cursor)
+    heartbeat_buffer.apply(devices)
     return devices
 
+@router.get("/presence", response_model=PresenceSummary, dependencies=[Depends(get_api_key)])
+async def get_presence(online: Optional[bool] = None):
+    """
+    获取设备在线状态（在线、离线设备数和各设备最近活动时间）
+    
+    由内存中的在线状态表直接返回，不查询数据库；online为true/false时只返回在线/离线的设备
+    """
+    return presence_tracker.snapshot(online)
+
 @router.get("/{device_id}", response_model=DeviceSchema, dependencies=[Depends(get_api_key)])
-async def get_device(device_id: str, db: Session = Depends(get_db)):
+async def get_device(device: DeviceModel = Depends(require_read_device)):
     """
     获取设备详情
     """
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
+    heartbeat_buffer.apply([device])
     return device
 
 @router.put("/{device_id}", response_model=DeviceSchema, dependencies=[Depends(get_api_key)])
 async def update_device(
-    device_id: str, 
     device_update: DeviceUpdate, 
+    device: DeviceModel = Depends(require_device),
     db: Session = Depends(get_db)
 ):
     """
     更新设备信息
     """
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
     
     # 更新设备信息
     update_data = device_update.model_dump(exclude_unset=True)
@@ -106,70 +187,66 @@ async def update_device(
     device.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(device)
+    device_registry.invalidate(device.device_id)
     
     return device
 
 @router.delete("/{device_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(get_api_key)])
-async def delete_device(device_id: str, db: Session = Depends(get_db)):
+async def delete_device(device_id: str, device: DeviceModel = Depends(require_device), db: Session = Depends(get_db)):
     """
     删除设备
     """
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
-    
-    # 取消订阅设备状态
-    mqtt_manager.unsubscribe_from_device_status(device_id)
-    
     db.delete(device)
     db.commit()
+    device_registry.invalidate(device_id)
+    presence_tracker.remove(device_id)
+    framebuffer_cache.remove_device(device_id)
 
 @router.post("/{device_id}/bootstrap", response_model=BootstrapResponse, dependencies=[Depends(get_api_key)])
-async def bootstrap_device(device_id: str, db: Session = Depends(get_db)):
+async def bootstrap_device(request: Request, device_id: str, db: Session = Depends(get_db)):
     """
-    设备引导 - 获取设备配置和内容
+    设备引导 - 一次返回设备配置、显示配置、当前内容、未完成待办和歌曲列表
     """
-    # 验证设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
-    
-    # 获取设备场景的内容
-    contents = db.query(ContentModel).filter(ContentModel.scene == device.scene).all()
+    # 引导数据按设备缓存，只有服务器时间每次生成
+    payload = bootstrap_cache.get(request, db, device_id)
+    heartbeat_buffer.record(device_id)
     
-    # 构建响应
-    response = BootstrapResponse(
-        device_id=device_id,
-        scene=device.scene,
-        contents=contents
-    )
+    return {**payload, "server_time": datetime.utcnow()}
+
+@router.get("/{device_id}/bootstrap", response_model=BootstrapResponse, dependencies=[Depends(get_api_key)])
+async def get_bootstrap(request: Request, device_id: str, db: Session = Depends(get_read_db)):
+    """
+    设备引导（GET方式，可使用只读副本）
+    """
+    payload = bootstrap_cache.get(request, db, device_id)
+    heartbeat_buffer.record(device_id)
     
-    return response
+    return {**payload, "server_time": datetime.utcnow()}
 
 @router.get("/{device_id}/status", dependencies=[Depends(get_api_key)])
-async def get_device_status(device_id: str, db: Session = Depends(get_db)):
+async def get_device_status(device_id: str, device: DeviceModel = Depends(require_read_device)):
     """
     获取设备状态
     """
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
+    # 合并尚未写入数据库的心跳
+    last_online = heartbeat_buffer.last_online(device_id, device.last_online)
+    # 优先使用在线状态表（遗嘱消息和在线消息），不在表中时按心跳超时判断
+    online = presence_tracker.is_online(device_id)
+    if online is None:
+        online = heartbeat_buffer.is_online(last_online)
     
     return {
         "device_id": device_id,
         "name": device.name,
         "scene": device.scene,
         "is_active": device.is_active,
-        "last_online": device.last_online,
+        "last_online": last_online,
+        "online": online,
+        "applied_version": device.applied_version,
+        "last_event": device.last_event,
+        "last_error": device.last_error,
+        "last_error_at": device.last_error_at,
+        "status_updated_at": device.status_updated_at,
         "created_at": device.created_at,
         "updated_at": device.updated_at
     }
@@ -178,18 +255,12 @@ async def get_device_status(device_id: str, db: Session = Depends(get_db)):
 async def create_song(
     device_id: str, 
     song: SongCreate, 
+    device: DeviceModel = Depends(require_device),
     db: Session = Depends(get_db)
 ):
     """
     创建歌曲
     """
-    # 验证设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
     
     # 检查歌曲ID是否已存在
     existing_song = db.query(SongModel).filter(
@@ -207,102 +278,67 @@ async def create_song(
         device_id=device_id,
         song_id=song.song_id,
         name=song.name,
-        tempo=str(song.tempo),
-        notes=json.dumps(song.notes)
+        tempo=str(song.tempo)
     )
+    set_song_notes(db_song, song.notes)
     db.add(db_song)
     db.commit()
     db.refresh(db_song)
+    device_registry.invalidate(device_id)
     
     # 返回格式化的响应
-    return Song(
-        id=db_song.id,
-        device_id=db_song.device_id,
-        song_id=db_song.song_id,
-        name=db_song.name,
-        tempo=float(db_song.tempo),
-        notes=json.loads(db_song.notes),
-        created_at=db_song.created_at,
-        updated_at=db_song.updated_at
-    )
+    return song_to_dict(db_song)
 
 @router.get("/{device_id}/songs", response_model=List[Song], dependencies=[Depends(get_api_key)])
 async def list_songs(
+    request: Request,
+    response: Response,
     device_id: str, 
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db)
 ):
     """
     获取设备的歌曲列表
-    """
-    # 验证设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
     
-    songs = db.query(SongModel).filter(
-        SongModel.device_id == device_id
-    ).offset(skip).limit(limit).all()
+    提供cursor时使用游标分页，下一页游标通过X-Next-Cursor响应头返回
+    """
+    query = db.query(SongModel).filter(SongModel.device_id == device_id)
+    songs, next_cursor = fetch_page(
+        query, [SongModel.created_at, SongModel.id], cursor=cursor, skip=skip, limit=limit
+    )
+    set_next_cursor(response, next_cursor)
     
-    # 转换数据格式
-    result = []
-    for song in songs:
-        song_data = {
-            "id": song.id,
-            "device_id": song.device_id,
-            "song_id": song.song_id,
-            "name": song.name,
-            "tempo": float(song.tempo),
-            "notes": json.loads(song.notes),
-            "created_at": song.created_at,
-            "updated_at": song.updated_at
-        }
-        result.append(song_data)
+    # 结果为空时才需要区分"设备不存在"和"没有歌曲"
+    ensure_device_exists(request, db, device_id, songs)
     
-    return result
+    # 转换数据格式（解析结果按歌曲版本缓存）
+    return [song_to_dict(song) for song in songs]
 
 @router.get("/{device_id}/songs/latest", response_model=Song, dependencies=[Depends(get_api_key)])
-async def get_latest_song(device_id: str, db: Session = Depends(get_db)):
+async def get_latest_song(request: Request, device_id: str, db: Session = Depends(get_read_db)):
     """
     获取设备最新的歌曲
     """
-    # 验证设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
-    
     # 获取最新歌曲（按创建时间排序）
     song = db.query(SongModel).filter(
         SongModel.device_id == device_id
     ).order_by(SongModel.created_at.desc()).first()
     
     if not song:
+        # 验证设备是否存在
+        get_device_or_404(request, db, device_id)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="该设备没有歌曲"
         )
     
     # 转换数据格式
-    return {
-        "id": song.id,
-        "device_id": song.device_id,
-        "song_id": song.song_id,
-        "name": song.name,
-        "tempo": float(song.tempo),
-        "notes": json.loads(song.notes),
-        "created_at": song.created_at,
-        "updated_at": song.updated_at
-    }
+    return song_to_dict(song)
 
 @router.get("/{device_id}/songs/{song_id}", response_model=Song, dependencies=[Depends(get_api_key)])
-async def get_song(device_id: str, song_id: int, db: Session = Depends(get_db)):
+async def get_song(device_id: str, song_id: int, db: Session = Depends(get_read_db)):
     """
     获取指定歌曲详情
     """
@@ -317,16 +353,40 @@ async def get_song(device_id: str, song_id: int, db: Session = Depends(get_db)):
         )
     
     # 转换数据格式
-    return {
-        "id": song.id,
-        "device_id": song.device_id,
-        "song_id": song.song_id,
-        "name": song.name,
-        "tempo": float(song.tempo),
-        "notes": json.loads(song.notes),
-        "created_at": song.created_at,
-        "updated_at": song.updated_at
-    }
+    return song_to_dict(song)
+
+@router.get("/{device_id}/songs/{song_id}/binary", dependencies=[Depends(get_api_key)])
+async def get_song_binary(request: Request, device_id: str, song_id: int, db: Session = Depends(get_read_db)):
+    """
+    获取歌曲预编译的播放缓冲区，设备无需解析JSON和查表
+    
+    格式: 8字节头部 (b"LS", 版本, 保留, 音符数量, 节拍x100) + 每个音符 (频率Hz, 时长毫秒) uint16小端序
+    """
+    song = db.query(SongModel).filter(
+        SongModel.device_id == device_id,
+        SongModel.song_id == song_id
+    ).first()
+    if not song:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="歌曲不存在"
+        )
+    heartbeat_buffer.record(device_id)
+    
+    # 同一歌曲版本只编译一次
+    payload, etag = compile_song(song)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    
+    return Response(
+        content=payload,
+        media_type="application/octet-stream",
+        headers={
+            "Content-Disposition": f"attachment; filename={device_id}_song{song_id}.bin",
+            "Content-Length": str(len(payload)),
+            "ETag": etag
+        }
+    )
 
 @router.put("/{device_id}/songs/{song_id}", response_model=Song, dependencies=[Depends(get_api_key)])
 async def update_song(
@@ -348,31 +408,25 @@ async def update_song(
             detail="歌曲不存在"
         )
     
-    # 更新歌曲信息
+    # 更新歌曲信息（引用曲库的歌曲先转为设备独立副本）
     update_data = song_update.model_dump(exclude_unset=True)
+    if "tempo" in update_data or "notes" in update_data:
+        detach_library_song(song)
     for field, value in update_data.items():
         if field == "tempo":
             setattr(song, field, str(value))
         elif field == "notes":
-            setattr(song, field, json.dumps(value))
+            set_song_notes(song, value)
         else:
             setattr(song, field, value)
     
     song.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(song)
+    device_registry.invalidate(device_id)
     
     # 转换数据格式返回
-    return {
-        "id": song.id,
-        "device_id": song.device_id,
-        "song_id": song.song_id,
-        "name": song.name,
-        "tempo": float(song.tempo),
-        "notes": json.loads(song.notes),
-        "created_at": song.created_at,
-        "updated_at": song.updated_at
-    }
+    return song_to_dict(song)
 
 @router.delete("/{device_id}/songs/{song_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(get_api_key)])
 async def delete_song(device_id: str, song_id: int, db: Session = Depends(get_db)):
@@ -391,79 +445,23 @@ async def delete_song(device_id: str, song_id: int, db: Session = Depends(get_db
     
     db.delete(song)
     db.commit()
+    device_registry.invalidate(device_id)
 
 @router.post("/{device_id}/songs/batch", response_model=List[Song], dependencies=[Depends(get_api_key)])
 async def create_songs_batch(
     device_id: str,
+    device: DeviceModel = Depends(require_device),
     db: Session = Depends(get_db)
 ):
     """
-    批量创建预定义歌曲
+    为设备分配预定义歌曲（引用共享曲库，不复制音符数据）
     """
-    # 验证设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
+    library = ensure_default_library(db)
+    created_songs = assign_library_songs(db, [device_id], library)
     
-    # 预定义歌曲数据
-    SONGS_EXT = {
-        1: {
-            "name": "Super Mario Theme",
-            "tempo": 1.2,
-            "notes": [('E5', 100), ('E5', 100), ('REST', 100), ('E5', 100),
-                     ('REST', 100), ('C5', 100), ('E5', 100), ('REST', 100),
-                     ('G5', 100), ('REST', 300), ('G4', 100), ('REST', 300),
-                     ('C5', 150), ('REST', 50), ('G4', 150), ('REST', 150),
-                     ('E4', 150), ('REST', 100), ('A4', 100), ('B4', 100),
-                     ('AS4', 50), ('A4', 100), ('G4', 100), ('E5', 100), ('G5', 100),
-                     ('A5', 100), ('F5', 100), ('G5', 100), ('REST', 50),
-                     ('E5', 100), ('C5', 100), ('D5', 100), ('B4', 100)]
-        },
-        2: {
-            "name": "Star Wars - Imperial March",
-            "tempo": 1.0,
-            "notes": [('A3', 500), ('A3', 500), ('A3', 500), ('F3', 350), ('C4', 150),
-                     ('A3', 500), ('F3', 350), ('C4', 150), ('A3', 1000),
-                     ('E4', 500), ('E4', 500), ('E4', 500), ('F4', 350), ('C4', 150),
-                     ('GS3', 500), ('F3', 350), ('C4', 150), ('A3', 1000)]
-        }
-    }
+    # 提交前转换，避免提交后逐行刷新
+    result = [song_to_dict(song) for song in created_songs]
+    db.commit()
+    device_registry.invalidate(device_id)
     
-    created_songs = []
-    for song_id, song_data in SONGS_EXT.items():
-        # 检查歌曲是否已存在
-        existing_song = db.query(SongModel).filter(
-            SongModel.device_id == device_id,
-            SongModel.song_id == song_id
-        ).first()
-        
-        if not existing_song:
-            # 创建新歌曲
-            db_song = SongModel(
-                device_id=device_id,
-                song_id=song_id,
-                name=song_data["name"],
-                tempo=str(song_data["tempo"]),
-                notes=json.dumps(song_data["notes"])
-            )
-            db.add(db_song)
-            db.commit()
-            db.refresh(db_song)
-            
-            # 转换数据格式
-            song_result = {
-                "id": db_song.id,
-                "device_id": db_song.device_id,
-                "song_id": db_song.song_id,
-                "name": db_song.name,
-                "tempo": float(db_song.tempo),
-                "notes": json.loads(db_song.notes),
-                "created_at": db_song.created_at,
-                "updated_at": db_song.updated_at
-            }
-            created_songs.append(song_result)
-    
-    return created_songs
+    return result
@@ -0,0 +1,88 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from typing import List
+
+from database import get_db
+from db_router import get_read_db
+from schemas import RetentionPolicy, RetentionPolicyCreate
+from models import RetentionPolicy as RetentionPolicyModel
+from auth import get_api_key
+from retention import retention_job
+
+router = APIRouter(
+    tags=["retention"]
+)
+
+@router.get("/policies", response_model=List[RetentionPolicy], dependencies=[Depends(get_api_key)])
+async def list_retention_policies(db: Session = Depends(get_read_db)):
+    """
+    获取内容保留策略列表
+    """
+    return db.query(RetentionPolicyModel).order_by(RetentionPolicyModel.id).all()
+
+@router.put("/policies", response_model=RetentionPolicy, dependencies=[Depends(get_api_key)])
+async def set_retention_policy(policy: RetentionPolicyCreate, db: Session = Depends(get_db)):
+    """
+    设置设备或场景的内容保留策略（已存在时更新）
+    """
+    if bool(policy.device_id) == bool(policy.scene):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="必须且只能指定设备ID或场景之一"
+        )
+    
+    if policy.keep_last is None and policy.keep_days is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="至少需要指定保留版本数或保留天数"
+        )
+    
+    if policy.device_id:
+        db_policy = db.query(RetentionPolicyModel).filter(RetentionPolicyModel.device_id == policy.device_id).first()
+    else:
+        db_policy = db.query(RetentionPolicyModel).filter(RetentionPolicyModel.scene == policy.scene).first()
+    
+    if db_policy is None:
+        db_policy = RetentionPolicyModel(device_id=policy.device_id, scene=policy.scene)
+        db.add(db_policy)
+    
+    db_policy.keep_last = policy.keep_last
+    db_policy.keep_days = policy.keep_days
+    db.commit()
+    db.refresh(db_policy)
+    
+    return db_policy
+
+@router.delete("/policies/{policy_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(get_api_key)])
+async def delete_retention_policy(policy_id: int, db: Session = Depends(get_db)):
+    """
+    删除内容保留策略
+    """
+    db_policy = db.query(RetentionPolicyModel).filter(RetentionPolicyModel.id == policy_id).first()
+    
+    if not db_policy:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="保留策略不存在"
+        )
+    
+    db.delete(db_policy)
+    db.commit()
+
+@router.post("/run", dependencies=[Depends(get_api_key)])
+async def run_retention():
+    """
+    立即执行一轮内容保留任务
+    """
+    return await run_in_threadpool(retention_job.run_once)
+
+@router.get("/status", dependencies=[Depends(get_api_key)])
+async def get_retention_status():
+    """
+    获取内容保留任务最近一次的执行结果
+    """
+    return {
+        "interval": retention_job.interval,
+        "last_run": retention_job.last_run
+    }
@@ -0,0 +1,105 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from typing import List, Optional
+
+from database import get_db
+from db_router import get_read_db
+from schemas import SongLibrary, SongLibraryCreate, SongAssign, BulkItemResult
+from models import Device as DeviceModel, SongLibrary as SongLibraryModel
+from song_codec import parse_song
+from song_library import create_library_song, assign_library_songs
+from auth import get_api_key
+from device_registry import device_registry
+
+router = APIRouter(
+    tags=["songs"]
+)
+
+def library_song_to_dict(library_song: SongLibraryModel) -> dict:
+    """将曲库歌曲转换为API响应格式"""
+    tempo, notes = parse_song(library_song)
+    return {
+        "id": library_song.id,
+        "name": library_song.name,
+        "tempo": tempo,
+        "notes": notes,
+        "created_at": library_song.created_at,
+        "updated_at": library_song.updated_at
+    }
+
+@router.get("/library", response_model=List[SongLibrary], dependencies=[Depends(get_api_key)])
+async def list_library_songs(db: Session = Depends(get_read_db)):
+    """
+    获取曲库歌曲列表
+    """
+    library_songs = db.query(SongLibraryModel).order_by(SongLibraryModel.id).all()
+    return [library_song_to_dict(library_song) for library_song in library_songs]
+
+@router.post("/library", response_model=SongLibrary, status_code=status.HTTP_201_CREATED, dependencies=[Depends(get_api_key)])
+async def create_library_song_endpoint(song: SongLibraryCreate, db: Session = Depends(get_db)):
+    """
+    向曲库添加歌曲
+    """
+    try:
+        library_song = create_library_song(db, song.name, song.tempo, song.notes)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="曲库中已存在同名歌曲"
+        )
+    
+    db.refresh(library_song)
+    return library_song_to_dict(library_song)
+
+@router.post("/library/{library_song_id}/assign", response_model=List[BulkItemResult], dependencies=[Depends(get_api_key)])
+async def assign_library_song(library_song_id: int, assign: SongAssign, db: Session = Depends(get_db)):
+    """
+    将曲库歌曲分配给多个设备（一次批量插入，不复制音符数据）
+    """
+    library_song = db.query(SongLibraryModel).filter(SongLibraryModel.id == library_song_id).first()
+    if not library_song:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="曲库歌曲不存在"
+        )
+    
+    # 一次查询找出存在的设备
+    existing_ids = {
+        row[0] for row in db.query(DeviceModel.device_id).filter(
+            DeviceModel.device_id.in_(assign.device_ids)
+        ).all()
+    } if assign.device_ids else set()
+    
+    created_songs = assign_library_songs(
+        db,
+        [device_id for device_id in assign.device_ids if device_id in existing_ids],
+        {assign.song_id: library_song}
+    )
+    created = {song.device_id: song.id for song in created_songs}
+    db.commit()
+    for device_id in created:
+        device_registry.invalidate(device_id)
+    
+    results = []
+    for index, device_id in enumerate(assign.device_ids):
+        if device_id not in existing_ids:
+            error: Optional[str] = "设备不存在"
+        elif device_id not in created:
+            error = "歌曲ID已存在"
+        else:
+            error = None
+        results.append(BulkItemResult(
+            index=index,
+            success=error is None,
+            id=created.get(device_id),
+            device_id=device_id,
+            error=error
+        ))
+        if error is None:
+            # 同一设备在请求中重复出现时只记一次成功
+            created.pop(device_id)
+    
+    return results
@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from db_router import get_read_db
+from schemas import TelemetryEvent, TelemetrySeries
+from models import TelemetryEvent as TelemetryEventModel
+from auth import get_api_key
+from telemetry import PERIOD_DAY, PERIOD_HOUR, query_rollups, telemetry_rollup_job, telemetry_writer
+
+router = APIRouter(
+    tags=["telemetry"]
+)
+
+# 未指定汇总周期时，不超过该跨度的查询使用小时数据，否则使用天数据
+HOURLY_MAX_RANGE = timedelta(days=2)
+# 原始事件查询允许的最大时间跨度
+RAW_MAX_RANGE = timedelta(days=1)
+
+
+def resolve_range(start: Optional[datetime], end: Optional[datetime], default: timedelta):
+    """确定查询时间范围（UTC），默认查询截至当前的default时长"""
+    end = end or datetime.utcnow()
+    start = start or end - default
+    # 统一为不带时区的UTC时间，与数据库中的时间一致
+    if end.tzinfo is not None:
+        end = end.astimezone(timezone.utc).replace(tzinfo=None)
+    if start.tzinfo is not None:
+        start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    if start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="开始时间必须早于结束时间"
+        )
+    return start, end
+
+
+def resolve_period(period: Optional[str], start: datetime, end: datetime) -> str:
+    """确定汇总周期"""
+    if period is None:
+        return PERIOD_HOUR if end - start <= HOURLY_MAX_RANGE else PERIOD_DAY
+    if period not in (PERIOD_HOUR, PERIOD_DAY):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="汇总周期只能是 hour 或 day"
+        )
+    return period
+
+
+@router.get("/devices/{device_id}", response_model=TelemetrySeries, dependencies=[Depends(get_api_key)])
+async def get_device_telemetry(
+    device_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    period: Optional[str] = Query(None, description="hour 或 day，默认按时间跨度选择"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    获取设备的遥测汇总数据（只读取小时/天汇总表）
+    """
+    start, end = resolve_range(start, end, timedelta(days=1))
+    period = resolve_period(period, start, end)
+    return {
+        "device_id": device_id,
+        "period": period,
+        "start": start,
+        "end": end,
+        "buckets": query_rollups(db, device_id, period, start, end)
+    }
+
+
+@router.get("/devices/{device_id}/events", response_model=List[TelemetryEvent], dependencies=[Depends(get_api_key)])
+async def get_device_telemetry_events(
+    device_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    db: Session = Depends(get_read_db)
+):
+    """
+    获取设备的原始遥测事件（时间跨度不超过1天）
+    """
+    start, end = resolve_range(start, end, timedelta(hours=1))
+    if end - start > RAW_MAX_RANGE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="原始事件的查询跨度不能超过1天，请使用汇总数据"
+        )
+    return db.query(TelemetryEventModel).filter(
+        TelemetryEventModel.device_id == device_id,
+        TelemetryEventModel.created_at >= start,
+        TelemetryEventModel.created_at < end
+    ).order_by(TelemetryEventModel.created_at.desc()).limit(limit).all()
+
+
+@router.get("/fleet", response_model=TelemetrySeries, dependencies=[Depends(get_api_key)])
+async def get_fleet_telemetry(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    period: Optional[str] = Query(None, description="hour 或 day，默认按时间跨度选择"),
+    db: Session = Depends(get_read_db)
+):
+    """
+    获取全部设备按时间桶合计的遥测汇总数据
+    """
+    start, end = resolve_range(start, end, timedelta(days=7))
+    period = resolve_period(period, start, end)
+    return {
+        "period": period,
+        "start": start,
+        "end": end,
+        "buckets": query_rollups(db, None, period, start, end)
+    }
+
+
+@router.post("/rollup", dependencies=[Depends(get_api_key)])
+async def run_telemetry_rollup():
+    """
+    写入待处理的事件并立即执行一轮汇总
+    """
+    await run_in_threadpool(telemetry_writer.flush)
+    return await run_in_threadpool(telemetry_rollup_job.run_once)
+
+
+@router.get("/status", dependencies=[Depends(get_api_key)])
+async def get_telemetry_status():
+    """
+    获取遥测写入和汇总任务的状态
+    """
+    return {
+        "pending": telemetry_writer.pending_count(),
+        "written": telemetry_writer.written_total,
+        "dropped": telemetry_writer.dropped_total,
+        "rollup_interval": telemetry_rollup_job.interval,
+        "last_rollup": telemetry_rollup_job.last_run
+    }
@@ -1,30 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Security
+from fastapi import APIRouter, Depends, HTTPException, status, Security, Request, Response
 from sqlalchemy.orm import Session
+from sqlalchemy import insert
 from typing import List, Optional
 from datetime import datetime
 
 from database import get_db
-from schemas import Todo as TodoSchema, TodoCreate, TodoUpdate
+from db_router import get_read_db
+from schemas import Todo as TodoSchema, TodoCreate, TodoUpdate, BulkItemResult
 from models import Todo as TodoModel
 from database import Device as DeviceModel
 from auth import get_api_key
+from mqtt_manager import mqtt_manager
+from device_registry import device_registry
+from dependencies import get_device_or_404
+from pagination import fetch_page, set_next_cursor
+from repository import get_todo as fetch_todo
 
 router = APIRouter(
     tags=["todos"]
 )
 
 @router.post("/", response_model=TodoSchema, status_code=status.HTTP_201_CREATED, dependencies=[Depends(get_api_key)])
-async def create_todo(todo: TodoCreate, db: Session = Depends(get_db)):
+async def create_todo(request: Request, todo: TodoCreate, db: Session = Depends(get_db)):
     """
     创建新的待办事项
     """
     # 检查设备是否存在
-    device = db.query(DeviceModel).filter(DeviceModel.device_id == todo.device_id).first()
-    if not device:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="设备不存在"
-        )
+    get_device_or_404(request, db, todo.device_id)
     
     # 创建新的待办事项
     db_todo = TodoModel(
@@ -37,19 +39,82 @@ async def create_todo(todo: TodoCreate, db: Session = Depends(get_db)):
     db.add(db_todo)
     db.commit()
     db.refresh(db_todo)
+    device_registry.invalidate(todo.device_id)
     
     return db_todo
 
+@router.post("/bulk", response_model=List[BulkItemResult], dependencies=[Depends(get_api_key)])
+async def create_todos_bulk(todos: List[TodoCreate], db: Session = Depends(get_db)):
+    """
+    批量创建待办事项（单个事务）
+    
+    一次查询校验所有设备，一次批量插入，每个设备只发送一条合并的MQTT通知
+    """
+    results: List[Optional[BulkItemResult]] = [None] * len(todos)
+    
+    # 一次查询找出存在的设备
+    requested_ids = {todo.device_id for todo in todos}
+    existing_ids = {
+        row[0] for row in db.query(DeviceModel.device_id).filter(
+            DeviceModel.device_id.in_(requested_ids)
+        ).all()
+    } if requested_ids else set()
+    
+    rows = []
+    row_indexes = []
+    for index, todo in enumerate(todos):
+        if todo.device_id not in existing_ids:
+            results[index] = BulkItemResult(
+                index=index, success=False, device_id=todo.device_id, error="设备不存在"
+            )
+            continue
+        
+        rows.append({
+            "title": todo.title,
+            "description": todo.description,
+            "device_id": todo.device_id,
+            "due_date": todo.due_date
+        })
+        row_indexes.append(index)
+    
+    if rows:
+        # RETURNING的行顺序与插入参数顺序一致
+        inserted_ids = db.execute(insert(TodoModel).returning(TodoModel.id, sort_by_parameter_order=True), rows).scalars().all()
+        db.commit()
+        
+        notifications = {}
+        for index, row, todo_id in zip(row_indexes, rows, inserted_ids):
+            results[index] = BulkItemResult(
+                index=index, success=True, id=todo_id, device_id=row["device_id"]
+            )
+            notifications.setdefault(row["device_id"], []).append({
+                "id": todo_id,
+                "title": row["title"],
+                "description": row["description"],
+                "due_date": row["due_date"].isoformat() if row["due_date"] else None
+            })
+        
+        # 每个设备只发送一条合并通知
+        for device_id, items in notifications.items():
+            device_registry.invalidate(device_id)
+            mqtt_manager.send_todo_command(device_id, "create_batch", {"todos": items})
+    
+    return results
+
 @router.get("/", response_model=List[TodoSchema], dependencies=[Depends(get_api_key)])
 async def list_todos(
+    response: Response,
     skip: int = 0, 
     limit: int = 100, 
+    cursor: Optional[str] = None,
     device_id: Optional[str] = None,
     is_completed: Optional[bool] = None,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """
     获取待办事项列表
+    
+    提供cursor时使用游标分页，下一页游标通过X-Next-Cursor响应头返回
     """
     query = db.query(TodoModel)
     
@@ -59,15 +124,18 @@ async def list_todos(
     if is_completed is not None:
         query = query.filter(TodoModel.is_completed == is_completed)
     
-    todos = query.order_by(TodoModel.created_at.desc()).offset(skip).limit(limit).all()
+    todos, next_cursor = fetch_page(
+        query, [TodoModel.created_at, TodoModel.id], cursor=cursor, skip=skip, limit=limit
+    )
+    set_next_cursor(response, next_cursor)
     return todos
 
 @router.get("/{todo_id}", response_model=TodoSchema, dependencies=[Depends(get_api_key)])
-async def get_todo(todo_id: int, db: Session = Depends(get_db)):
+async def get_todo(todo_id: int, db: Session = Depends(get_read_db)):
     """
     获取待办事项详情
     """
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = fetch_todo(db, todo_id)
     if not todo:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -84,7 +152,7 @@ async def update_todo(
     """
     更新待办事项
     """
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = fetch_todo(db, todo_id)
     if not todo:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -107,6 +175,7 @@ async def update_todo(
     todo.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(todo)
+    device_registry.invalidate(todo.device_id)
     
     return todo
 
@@ -115,22 +184,24 @@ async def delete_todo(todo_id: int, db: Session = Depends(get_db)):
     """
     删除待办事项
     """
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = fetch_todo(db, todo_id)
     if not todo:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="待办事项不存在"
         )
     
+    device_id = todo.device_id
     db.delete(todo)
     db.commit()
+    device_registry.invalidate(device_id)
 
 @router.post("/{todo_id}/complete", response_model=TodoSchema, dependencies=[Depends(get_api_key)])
 async def complete_todo(todo_id: int, db: Session = Depends(get_db)):
     """
     标记待办事项为完成
     """
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = fetch_todo(db, todo_id)
     if not todo:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -143,6 +214,7 @@ async def complete_todo(todo_id: int, db: Session = Depends(get_db)):
     
     db.commit()
     db.refresh(todo)
+    device_registry.invalidate(todo.device_id)
     
     return todo
 
@@ -151,7 +223,7 @@ async def incomplete_todo(todo_id: int, db: Session = Depends(get_db)):
     """
     标记待办事项为未完成
     """
-    todo = db.query(TodoModel).filter(TodoModel.id == todo_id).first()
+    todo = fetch_todo(db, todo_id)
     if not todo:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -164,5 +236,6 @@ async def incomplete_todo(todo_id: int, db: Session = Depends(get_db)):
     
     db.commit()
     db.refresh(todo)
+    device_registry.invalidate(todo.device_id)
     
     return todo
\ No newline at end of file
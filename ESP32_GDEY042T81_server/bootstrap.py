@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from fastapi import Request
+from sqlalchemy import literal, null, select
+from sqlalchemy.orm import Session
+
+from config import settings
+from models import Todo as TodoModel, Song as SongModel
+from dependencies import get_device_with_latest_content
+from device_registry import device_registry, build_profile
+from api.contents import content_etag
+
+# 设备还没有内容时使用的默认时间设置（与内容表的默认值一致）
+DEFAULT_TIMEZONE = "Asia/Shanghai"
+DEFAULT_TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+
+class BootstrapCache:
+    """
+    设备引导数据缓存
+
+    引导数据由两次查询组装（设备+最新活跃内容、未完成待办+歌曲列表），按设备缓存，
+    设备、内容、待办或歌曲变更时通过设备注册表的失效监听器清除（包括其他worker广播的变更）。
+    断电恢复后大量设备同时引导时只有每个设备的第一次请求访问数据库。
+    """
+
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, request: Request, db: Session, device_id: str) -> Dict[str, Any]:
+        """
+        获取设备引导数据，未缓存、已过期或内容版本已变化时重新组装
+
+        Args:
+            request: 当前请求
+            db: 数据库会话
+            device_id: 设备ID
+
+        Returns:
+            引导数据字典
+        """
+        with self._lock:
+            item = self._entries.get(device_id)
+            if item is not None:
+                payload, expires_at = item
+                entry = device_registry.get(device_id)
+                if expires_at >= time.monotonic() and (
+                    entry is None or entry.current_version == payload["content_version"]
+                ):
+                    self._entries.move_to_end(device_id)
+                    self.hits += 1
+                    return payload
+                del self._entries[device_id]
+            self.misses += 1
+
+        payload = self.compute(request, db, device_id)
+
+        with self._lock:
+            self._entries[device_id] = (payload, time.monotonic() + self.ttl)
+            self._entries.move_to_end(device_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return payload
+
+    def invalidate(self, device_id: str):
+        """使设备的引导数据失效"""
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        """缓存统计信息"""
+        with self._lock:
+            size = len(self._entries)
+        return {"size": size, "hits": self.hits, "misses": self.misses}
+
+    def compute(self, request: Request, db: Session, device_id: str) -> Dict[str, Any]:
+        """组装引导数据（两次查询）"""
+        # 第一次查询：设备和最新活跃内容（设备不存在时抛出404）
+        generation = device_registry.session_generation(db, device_id)
+        device, content = get_device_with_latest_content(request, db, device_id)
+        device_registry.remember(device, content, generation)
+
+        # 第二次查询：未完成的待办事项和歌曲列表合并为一条UNION ALL
+        open_todos = select(
+            literal("todo").label("kind"),
+            TodoModel.id.label("item_id"),
+            TodoModel.title.label("name"),
+            TodoModel.due_date.label("due_date"),
+            TodoModel.created_at.label("created_at")
+        ).where(
+            TodoModel.device_id == device_id,
+            TodoModel.is_completed == False
+        ).order_by(TodoModel.created_at.desc()).limit(settings.bootstrap_todo_limit).subquery()
+        songs = select(
+            literal("song").label("kind"),
+            SongModel.song_id.label("item_id"),
+            SongModel.name.label("name"),
+            null().label("due_date"),
+            SongModel.created_at.label("created_at")
+        ).where(SongModel.device_id == device_id)
+        items = db.execute(
+            select(open_todos).union_all(songs)
+        ).all()
+
+        todos = []
+        song_list = []
+        for kind, item_id, name, due_date, created_at in sorted(items, key=lambda row: (row.kind, row.created_at)):
+            if kind == "todo":
+                todos.append({"id": item_id, "title": name, "due_date": due_date})
+            else:
+                song_list.append({"song_id": item_id, "name": name})
+
+        content_payload = None
+        if content:
+            image_url = None
+            if content.image_path:
+                image_url = f"/static/{os.path.relpath(content.image_path)}"
+            layout_config = None
+            if content.layout_config:
+                try:
+                    layout_config = json.loads(content.layout_config)
+                except json.JSONDecodeError:
+                    layout_config = None
+            content_payload = {
+                "version": content.version,
+                "title": content.title,
+                "image_url": image_url,
+                "layout_config": layout_config,
+                "created_at": content.created_at,
+                # 与最新内容二进制接口默认参数的ETag一致，设备可直接用于If-None-Match
+                "etag": content_etag(device_id, content.version, False, False, True, content.image_path)
+            }
+
+        return {
+            "device_id": device_id,
+            "name": device.name,
+            "scene": device.scene,
+            "is_active": bool(device.is_active),
+            "profile": build_profile(device.name),
+            "content_version": content.version if content else None,
+            "timezone": (content.timezone if content else None) or DEFAULT_TIMEZONE,
+            "time_format": (content.time_format if content else None) or DEFAULT_TIME_FORMAT,
+            "last_updated": content.created_at if content else None,
+            "content": content_payload,
+            "todos": todos,
+            "songs": song_list
+        }
+
+
+# 全局设备引导数据缓存实例
+bootstrap_cache = BootstrapCache(
+    ttl=settings.bootstrap_cache_ttl,
+    max_size=settings.device_registry_max_size
+)
+
+# 设备、内容、待办或歌曲变更时清除引导数据
+device_registry.add_listener(bootstrap_cache.invalidate)
@@ -1,9 +1,15 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, ForeignKey
+from sqlalchemy import create_engine, event, Column, Integer, String, DateTime, Text, Boolean, ForeignKey, Index, LargeBinary, inspect, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
+import logging
+import os
 from config import settings
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 class Device(Base):
@@ -15,12 +21,24 @@ class Device(Base):
     name = Column(String(100), nullable=True)
     scene = Column(String(100), nullable=True)
     last_online = Column(DateTime, default=datetime.utcnow)
+    online = Column(Boolean, default=False)  # 在线状态（只在上线/离线变化时写入）
+    online_changed_at = Column(DateTime, nullable=True)  # 在线状态最近一次变化的时间
     is_active = Column(Boolean, default=True)
+    push_frames = Column(Boolean, default=False)  # 通过MQTT直接推送帧缓冲（需要设备固件支持）
+    applied_version = Column(Integer, nullable=True)  # 设备上报已显示的内容版本
+    last_event = Column(String(30), nullable=True)  # 最近一次状态上报的事件
+    last_error = Column(String(500), nullable=True)  # 最近一次错误信息
+    last_error_at = Column(DateTime, nullable=True)
+    status_updated_at = Column(DateTime, nullable=True)  # 最近一次状态上报的接收时间
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # 关联内容版本
     contents = relationship("Content", back_populates="device")
+    
+    __table_args__ = (
+        Index("ix_devices_created_at_id", "created_at", "id"),
+    )
 
 class Content(Base):
     __tablename__ = "contents"
@@ -39,6 +57,11 @@ class Content(Base):
     
     # 关联设备
     device = relationship("Device", back_populates="contents")
+    
+    __table_args__ = (
+        Index("ix_contents_device_version", "device_id", "version"),
+        Index("ix_contents_created_at_id", "created_at", "id"),
+    )
 
 class Todo(Base):
     __tablename__ = "todos"
@@ -55,6 +78,11 @@ class Todo(Base):
     
     # 关联设备
     device = relationship("Device")
+    
+    __table_args__ = (
+        Index("ix_todos_created_at_id", "created_at", "id"),
+        Index("ix_todos_device_created_at_id", "device_id", "created_at", "id"),
+    )
 
 class Song(Base):
     __tablename__ = "songs"
@@ -64,20 +92,262 @@ class Song(Base):
     song_id = Column(Integer, nullable=False)  # 歌曲ID (1, 2, 3...)
     name = Column(String(200), nullable=False)  # 歌曲名称
     tempo = Column(String(10), nullable=False)  # 节拍 (存储为字符串，如 "1.2")
-    notes = Column(Text, nullable=False)  # 音符数据 (JSON格式存储)
+    notes = Column(Text, nullable=True)  # 无法打包的音符数据 (JSON格式存储，兼容旧数据)
+    notes_packed = Column(LargeBinary, nullable=True)  # 打包的音符数据 (音符编号uint8 + 时长uint16)
+    library_song_id = Column(Integer, ForeignKey("song_library.id"), nullable=True)  # 引用曲库歌曲时音符数据为空
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # 关联设备
     device = relationship("Device")
+    
+    # 关联曲库歌曲（多对一，随歌曲一起加载）
+    library_song = relationship("SongLibrary", lazy="joined")
+    
+    __table_args__ = (
+        Index("ix_songs_device_created_at_id", "device_id", "created_at", "id"),
+    )
+
+class SongLibrary(Base):
+    __tablename__ = "song_library"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(200), unique=True, nullable=False)  # 歌曲名称
+    tempo = Column(String(10), nullable=False)  # 节拍 (与songs表一致存储为字符串)
+    notes = Column(Text, nullable=True)  # 无法打包的音符数据 (JSON格式存储)
+    notes_packed = Column(LargeBinary, nullable=True)  # 打包的音符数据
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ContentArchive(Base):
+    __tablename__ = "contents_archive"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    content_id = Column(Integer, nullable=False)  # 原contents表中的ID
+    device_id = Column(String(50), nullable=False)
+    version = Column(Integer, nullable=False)
+    title = Column(String(200), nullable=True)
+    description = Column(Text, nullable=True)
+    image_path = Column(String(500), nullable=True)  # 归档后图片文件已删除，仅保留记录
+    layout_config = Column(Text, nullable=True)
+    timezone = Column(String(50), nullable=True)
+    time_format = Column(String(20), nullable=True)
+    is_active = Column(Boolean, nullable=True)
+    created_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_contents_archive_device_version", "device_id", "version"),
+    )
+
+class RetentionPolicy(Base):
+    __tablename__ = "retention_policies"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    device_id = Column(String(50), unique=True, nullable=True)  # 设备级策略
+    scene = Column(String(100), unique=True, nullable=True)  # 场景级策略
+    keep_last = Column(Integer, nullable=True)  # 保留最近N个版本
+    keep_days = Column(Integer, nullable=True)  # 保留最近X天的版本
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class TelemetryEvent(Base):
+    __tablename__ = "telemetry_events"
+    
+    id = Column(Integer, primary_key=True)
+    device_id = Column(String(50), nullable=False)
+    event = Column(String(30), nullable=False)  # 事件类型
+    content_version = Column(Integer, nullable=True)  # 设备上报的当前内容版本
+    version_lag = Column(Integer, nullable=True)  # 与服务端最新活跃版本的差距
+    message = Column(String(500), nullable=True)
+    device_timestamp = Column(Integer, nullable=True)  # 设备上报的时间戳
+    created_at = Column(DateTime, default=datetime.utcnow)  # 服务端接收时间
+    
+    __table_args__ = (
+        Index("ix_telemetry_events_device_created_at", "device_id", "created_at"),
+        Index("ix_telemetry_events_created_at", "created_at"),
+    )
+
+class TelemetryRollup(Base):
+    __tablename__ = "telemetry_rollups"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    device_id = Column(String(50), nullable=False)
+    period = Column(String(4), nullable=False)  # hour 或 day
+    bucket_start = Column(DateTime, nullable=False)
+    event_count = Column(Integer, nullable=False, default=0)
+    refresh_count = Column(Integer, nullable=False, default=0)
+    error_count = Column(Integer, nullable=False, default=0)
+    uptime_seconds = Column(Integer, nullable=False, default=0)
+    max_version_lag = Column(Integer, nullable=True)
+    last_version = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_telemetry_rollups_device_period_bucket", "device_id", "period", "bucket_start", unique=True),
+        Index("ix_telemetry_rollups_period_bucket", "period", "bucket_start"),
+    )
+
+# 判断是否为SQLite文件数据库
+def is_sqlite_file(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database not in (None, "", ":memory:")
+
+# 创建数据库引擎
+def create_db_engine(url: str, read_only: bool = False, **kwargs) -> Engine:
+    """
+    创建数据库引擎
+
+    SQLite文件数据库使用WAL模式：主库引擎只有一个连接，所有写会话排队串行写入，
+    避免并发写入时的SQLITE_BUSY；只读引擎使用连接池，WAL模式下读取不会被写入阻塞
+
+    Args:
+        url: 数据库连接URL
+        read_only: 是否为只读引擎
+        kwargs: 传递给create_engine的其他参数
+
+    Returns:
+        数据库引擎
+    """
+    if not is_sqlite_file(url):
+        return create_engine(url, **kwargs)
+    
+    os.makedirs(os.path.dirname(os.path.abspath(make_url(url).database)), exist_ok=True)
+    
+    if read_only:
+        kwargs.setdefault("pool_size", settings.sqlite_read_pool_size)
+        kwargs.setdefault("max_overflow", 0)
+    else:
+        kwargs.setdefault("pool_size", 1)
+        kwargs.setdefault("max_overflow", 0)
+        kwargs.setdefault("pool_timeout", settings.sqlite_writer_timeout)
+    
+    sqlite_engine = create_engine(
+        url,
+        poolclass=QueuePool,
+        connect_args={"check_same_thread": False, "timeout": settings.sqlite_busy_timeout / 1000},
+        **kwargs
+    )
+    
+    @event.listens_for(sqlite_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size)}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout)}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    
+    return sqlite_engine
 
 # 创建数据库连接
-engine = create_engine(settings.database_url)
+engine = create_db_engine(settings.database_url)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 只读副本连接（可选），连接取出前先探活以便及时发现失效的副本
+read_engines = [create_db_engine(url, read_only=True, pool_pre_ping=True) for url in settings.database_read_urls]
+
+# SQLite模式下未配置副本时，读请求使用同一数据库文件上的只读连接池
+if not read_engines and is_sqlite_file(settings.database_url):
+    read_engines.append(create_db_engine(settings.database_url, read_only=True))
+
 # 创建所有表
 def init_db():
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    ensure_indexes()
+    migrate_song_notes()
+
+# 为已存在的表补充新增的可空列
+def add_missing_columns():
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            logger.info(f"已为表 {table.name} 添加列 {column.name}")
+
+# 为已存在的表补建新增的索引（create_all只会为新表建索引）
+def ensure_indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+# 按当前模型重建SQLite表（SQLite不支持修改列约束）
+def rebuild_sqlite_table(table):
+    old_name = f"{table.name}_old"
+    existing = [column["name"] for column in inspect(engine).get_columns(table.name)]
+    shared = ", ".join(column.name for column in table.columns if column.name in existing)
+    
+    with engine.begin() as conn:
+        # SQLite的索引名全局唯一，先删除旧表上的索引再重建
+        for index in inspect(conn).get_indexes(table.name):
+            conn.execute(text(f"DROP INDEX IF EXISTS {index['name']}"))
+        conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+        table.create(bind=conn)
+        conn.execute(text(f"INSERT INTO {table.name} ({shared}) SELECT {shared} FROM {old_name}"))
+        conn.execute(text(f"DROP TABLE {old_name}"))
+    logger.info(f"已重建SQLite表 {table.name}")
+
+# 将旧的JSON音符数据转换为打包格式
+def migrate_song_notes(batch_size: int = 500):
+    from song_codec import pack_notes
+    import json
+    
+    columns = {column["name"]: column for column in inspect(engine).get_columns("songs")}
+    if not columns["notes"]["nullable"]:
+        if engine.dialect.name == "postgresql":
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE songs ALTER COLUMN notes DROP NOT NULL"))
+        elif engine.dialect.name == "sqlite":
+            rebuild_sqlite_table(Song.__table__)
+        else:
+            logger.warning("songs.notes 列不允许为空，跳过音符数据迁移")
+            return
+    
+    last_id = 0
+    converted = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT id, notes FROM songs "
+                    "WHERE notes_packed IS NULL AND notes IS NOT NULL AND id > :last_id "
+                    "ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": batch_size}
+            ).all()
+            if not rows:
+                break
+            
+            updates = []
+            for song_id, notes in rows:
+                try:
+                    updates.append({"id": song_id, "packed": pack_notes(json.loads(notes))})
+                except (ValueError, TypeError, AttributeError):
+                    # 无法打包的数据保留JSON格式（json.JSONDecodeError也是ValueError），不能中断启动
+                    continue
+            
+            if updates:
+                conn.execute(
+                    text("UPDATE songs SET notes_packed = :packed, notes = NULL WHERE id = :id"),
+                    updates
+                )
+            converted += len(updates)
+            last_id = rows[-1][0]
+    
+    if converted:
+        logger.info(f"已将 {converted} 首歌曲的音符数据转换为打包格式")
 
 # 获取数据库会话
 def get_db():
@@ -0,0 +1,244 @@
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import settings
+from database import engine, read_engines
+
+logger = logging.getLogger(__name__)
+
+# 调试模式下附加到响应的头
+QUERY_COUNT_HEADER = "X-DB-Query-Count"
+QUERY_TIME_HEADER = "X-DB-Time-Ms"
+SLOWEST_QUERY_HEADER = "X-DB-Slowest-Ms"
+
+# 项目源码目录，用于从调用栈中筛选出项目自己的代码
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 非请求（后台线程）查询统计使用的路由名
+BACKGROUND_ROUTE = "background"
+
+
+class RequestQueryStats:
+    """单个请求内的查询统计"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement: Optional[str] = None
+        self.shapes: Counter = Counter()
+        self.n_plus_one: List[str] = []
+
+
+# 当前请求的查询统计（请求之外为None）
+_current_stats: ContextVar[Optional[RequestQueryStats]] = ContextVar("db_query_stats", default=None)
+
+
+class DBMetrics:
+    """
+    数据库查询指标
+
+    通过SQLAlchemy的游标执行事件记录每个请求的查询次数、总耗时和最慢的语句，
+    同一请求内相同形状的语句重复超过阈值时记录N+1警告（附调用栈摘要）。
+    按路由累计的指标通过 /metrics 以Prometheus文本格式导出。
+    """
+
+    def __init__(self, n_plus_one_threshold: int):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self._routes: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._budgets: List[list] = []
+        self._engines: List[Engine] = []
+        self._route_paths: Dict[object, str] = {}
+
+    def install(self, engine: Engine):
+        """在引擎上注册查询计时事件"""
+        if engine in self._engines:
+            return
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+        self._engines.append(engine)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    def _handle_error(self, context):
+        # 语句执行失败时不会触发after_cursor_execute，丢弃对应的开始时间
+        connection = context.connection
+        if connection is not None and connection.info.get("query_start_time"):
+            connection.info["query_start_time"].pop()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+
+        for budget in self._budgets:
+            budget.append(statement)
+
+        stats = _current_stats.get()
+        if stats is None:
+            self._add(BACKGROUND_ROUTE, queries=1, db_time=elapsed)
+            return
+
+        stats.count += 1
+        stats.total_time += elapsed
+        if elapsed > stats.slowest_time:
+            stats.slowest_time = elapsed
+            stats.slowest_statement = statement
+
+        # 参数已绑定，同一形状的语句文本相同
+        stats.shapes[statement] += 1
+        if stats.shapes[statement] == self.n_plus_one_threshold + 1:
+            stats.n_plus_one.append(statement)
+            logger.warning(
+                f"疑似N+1查询：同一语句在一个请求内执行超过 {self.n_plus_one_threshold} 次\n"
+                f"语句: {shorten(statement)}\n调用栈:\n{stack_summary()}"
+            )
+
+    def begin_request(self) -> RequestQueryStats:
+        """开始记录当前请求的查询"""
+        stats = RequestQueryStats()
+        _current_stats.set(stats)
+        return stats
+
+    def end_request(self, route: str, stats: RequestQueryStats):
+        """结束记录并累计到路由指标"""
+        _current_stats.set(None)
+        self._add(
+            route,
+            requests=1,
+            queries=stats.count,
+            db_time=stats.total_time,
+            max_queries=stats.count,
+            n_plus_one=len(stats.n_plus_one)
+        )
+
+    def _add(self, route: str, requests: int = 0, queries: int = 0, db_time: float = 0.0,
+             max_queries: int = 0, n_plus_one: int = 0):
+        with self._lock:
+            metrics = self._routes.get(route)
+            if metrics is None:
+                metrics = self._routes[route] = {
+                    "requests": 0, "queries": 0, "db_time": 0.0, "max_queries": 0, "n_plus_one": 0
+                }
+            metrics["requests"] += requests
+            metrics["queries"] += queries
+            metrics["db_time"] += db_time
+            metrics["n_plus_one"] += n_plus_one
+            if max_queries > metrics["max_queries"]:
+                metrics["max_queries"] = max_queries
+
+    def route_label(self, request) -> str:
+        """
+        请求对应的路由模板（如 GET /api/devices/{device_id}），避免按实际路径产生过多指标
+        """
+        endpoint = request.scope.get("endpoint")
+        path = self._route_paths.get(endpoint)
+        if path is None:
+            path = "other"
+            for route in request.app.routes:
+                if getattr(route, "endpoint", None) is endpoint and hasattr(route, "path"):
+                    path = route.path
+                    break
+            if endpoint is not None:
+                self._route_paths[endpoint] = path
+        return f"{request.method} {path}"
+
+    def response_headers(self, stats: RequestQueryStats) -> Dict[str, str]:
+        """调试模式下附加到响应的查询统计头"""
+        return {
+            QUERY_COUNT_HEADER: str(stats.count),
+            QUERY_TIME_HEADER: f"{stats.total_time * 1000:.2f}",
+            SLOWEST_QUERY_HEADER: f"{stats.slowest_time * 1000:.2f}"
+        }
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """按路由的指标快照"""
+        with self._lock:
+            return {route: dict(metrics) for route, metrics in self._routes.items()}
+
+    def render_prometheus(self) -> str:
+        """以Prometheus文本格式导出指标"""
+        lines = [
+            "# HELP luna_db_requests_total 请求数",
+            "# TYPE luna_db_requests_total counter",
+            "# HELP luna_db_queries_total 数据库查询数",
+            "# TYPE luna_db_queries_total counter",
+            "# HELP luna_db_query_seconds_total 数据库查询总耗时",
+            "# TYPE luna_db_query_seconds_total counter",
+            "# HELP luna_db_queries_per_request_max 单个请求的最大查询数",
+            "# TYPE luna_db_queries_per_request_max gauge",
+            "# HELP luna_db_n_plus_one_total 疑似N+1查询次数",
+            "# TYPE luna_db_n_plus_one_total counter",
+        ]
+        for route, metrics in sorted(self.snapshot().items()):
+            label = f'route="{escape_label(route)}"'
+            lines.append(f"luna_db_requests_total{{{label}}} {metrics['requests']}")
+            lines.append(f"luna_db_queries_total{{{label}}} {metrics['queries']}")
+            lines.append(f"luna_db_query_seconds_total{{{label}}} {metrics['db_time']:.6f}")
+            lines.append(f"luna_db_queries_per_request_max{{{label}}} {metrics['max_queries']}")
+            lines.append(f"luna_db_n_plus_one_total{{{label}}} {metrics['n_plus_one']}")
+        return "\n".join(lines) + "\n"
+
+    @contextmanager
+    def query_budget(self, max_queries: int):
+        """
+        查询预算断言，代码块内（包括其他线程中处理的请求）执行的查询超过max_queries时抛出AssertionError
+
+        用法:
+            with db_metrics.query_budget(2):
+                client.get("/api/contents/devices/d1/content/latest")
+        """
+        statements: list = []
+        self._budgets.append(statements)
+        try:
+            yield statements
+        finally:
+            self._budgets.remove(statements)
+        if len(statements) > max_queries:
+            detail = "\n".join(f"  {shorten(statement)}" for statement in statements)
+            raise AssertionError(f"执行了 {len(statements)} 次查询，超过预算 {max_queries} 次:\n{detail}")
+
+
+def shorten(statement: str, limit: int = 300) -> str:
+    """压缩语句中的空白并截断，用于日志"""
+    statement = re.sub(r"\s+", " ", statement).strip()
+    return statement if len(statement) <= limit else statement[:limit] + "..."
+
+
+def escape_label(value: str) -> str:
+    """转义Prometheus标签值"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def stack_summary(limit: int = 6) -> str:
+    """当前调用栈中项目代码的最后几帧"""
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(PROJECT_DIR)
+        and os.path.basename(frame.filename) != "db_metrics.py"
+        and "site-packages" not in frame.filename
+    ]
+    return "".join(
+        f"  {os.path.relpath(frame.filename, PROJECT_DIR)}:{frame.lineno} in {frame.name}\n"
+        for frame in frames[-limit:]
+    ).rstrip()
+
+
+# 全局数据库查询指标实例
+db_metrics = DBMetrics(n_plus_one_threshold=settings.db_n_plus_one_threshold)
+
+# 主库和只读引擎都记录查询
+for _engine in [engine, *read_engines]:
+    db_metrics.install(_engine)
@@ -0,0 +1,187 @@
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from fastapi import Request
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+
+from config import settings
+from database import SessionLocal, read_engines
+from device_registry import device_registry
+
+logger = logging.getLogger(__name__)
+
+# 可以使用只读副本的请求方法
+READ_METHODS = {"GET", "HEAD"}
+
+
+class Replica:
+    """只读副本及其健康状态"""
+
+    def __init__(self, name: str, engine: Engine):
+        self.name = name
+        self.engine = engine
+        self.session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        self.healthy = True
+        self.checked_at = 0.0
+
+
+class ReplicaRouter:
+    """
+    读写会话路由
+
+    只读请求轮询使用健康的副本，副本全部不可用时回退到主库；
+    设备发生写入后的一段时间内，该设备的读取也走主库（读己之写）
+    """
+
+    def __init__(self, engines: List[Engine], health_check_interval: int, read_your_writes_window: int):
+        self.replicas = [
+            Replica(engine.url.render_as_string(hide_password=True), engine)
+            for engine in engines
+        ]
+        self.health_check_interval = health_check_interval
+        self.read_your_writes_window = read_your_writes_window
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._recent_writes: Dict[str, float] = {}
+
+    def check_health(self, replica: Replica) -> bool:
+        """
+        检查副本是否可用
+
+        Returns:
+            副本是否健康
+        """
+        try:
+            with replica.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            healthy = True
+        except DBAPIError as e:
+            healthy = False
+            logger.warning(f"只读副本 {replica.name} 不可用: {str(e)}")
+
+        if healthy and not replica.healthy:
+            logger.info(f"只读副本 {replica.name} 已恢复")
+        replica.healthy = healthy
+        replica.checked_at = time.monotonic()
+        return healthy
+
+    def mark_failed(self, replica: Replica):
+        """标记副本不可用，在下一次健康检查前不再使用"""
+        if replica.healthy:
+            logger.warning(f"只读副本 {replica.name} 查询失败，暂时停用")
+        replica.healthy = False
+        replica.checked_at = time.monotonic()
+
+    def choose_replica(self) -> Optional[Replica]:
+        """
+        轮询选择一个健康的副本
+
+        Returns:
+            副本，没有可用副本时返回None
+        """
+        if not self.replicas:
+            return None
+
+        start = next(self._counter)
+        now = time.monotonic()
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if now - replica.checked_at >= self.health_check_interval:
+                self.check_health(replica)
+            if replica.healthy:
+                return replica
+        return None
+
+    def mark_written(self, device_id: str):
+        """记录设备刚发生写入，窗口期内该设备的读取使用主库"""
+        with self._lock:
+            self._recent_writes[device_id] = time.monotonic() + self.read_your_writes_window
+
+    def recently_written(self, device_id: Optional[str]) -> bool:
+        """设备是否处于读己之写窗口期内"""
+        if not device_id:
+            return False
+        with self._lock:
+            expires_at = self._recent_writes.get(device_id)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._recent_writes[device_id]
+                return False
+            return True
+
+    def stats(self) -> Dict[str, object]:
+        """路由状态信息"""
+        with self._lock:
+            pinned = len(self._recent_writes)
+        return {
+            "replicas": [{"name": r.name, "healthy": r.healthy} for r in self.replicas],
+            "pinned_devices": pinned
+        }
+
+
+# 全局读写路由实例
+replica_router = ReplicaRouter(
+    read_engines,
+    health_check_interval=settings.replica_health_check_interval,
+    read_your_writes_window=settings.read_your_writes_window
+)
+
+# 设备或内容变更（包括其他worker广播的变更）后进入读己之写窗口
+device_registry.add_listener(replica_router.mark_written)
+
+
+@contextmanager
+def read_session(device_id: Optional[str] = None) -> Iterator[Session]:
+    """
+    只读数据库会话（也供后台线程使用）
+
+    使用健康的只读副本（SQLite模式下为只读连接池），未配置副本、副本不可用，
+    或设备处于读己之写窗口期内时使用主库
+
+    Args:
+        device_id: 读取涉及的设备ID
+    """
+    # 在选择副本之前记下设备的失效代数，之后的失效使读到的数据不再写入设备注册表
+    generation = device_registry.generation(device_id) if device_id else None
+    replica = None
+    if not replica_router.recently_written(device_id):
+        replica = replica_router.choose_replica()
+
+    db = replica.session_factory() if replica else SessionLocal()
+    if generation is not None:
+        db.info["registry_generations"] = {device_id: generation}
+    try:
+        yield db
+    except DBAPIError as e:
+        if replica and (e.connection_invalidated or isinstance(e, OperationalError)):
+            replica_router.mark_failed(replica)
+        raise
+    finally:
+        db.close()
+
+
+def get_read_db(request: Request):
+    """
+    只读数据库会话依赖项
+
+    GET/HEAD请求按read_session的规则路由，写请求使用主库
+    """
+    if request.method not in READ_METHODS:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+        return
+
+    device_id = request.path_params.get("device_id") or request.query_params.get("device_id")
+    with read_session(device_id) as db:
+        yield db
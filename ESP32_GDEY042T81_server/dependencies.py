@@ -0,0 +1,136 @@
+from fastapi import Depends, HTTPException, Request, status
+from sqlalchemy.orm import Session
+from typing import List, Optional, Tuple
+
+from database import get_db
+from db_router import get_read_db
+from models import Device as DeviceModel, Content as ContentModel
+import repository
+
+
+def _device_cache(request: Request) -> dict:
+    """获取挂在request.state上的设备缓存（同一请求内共享）"""
+    cache = getattr(request.state, "devices", None)
+    if cache is None:
+        cache = {}
+        request.state.devices = cache
+    return cache
+
+
+def load_device(request: Request, db: Session, device_id: str) -> Optional[DeviceModel]:
+    """
+    按device_id加载设备，同一请求内只查询一次数据库
+
+    Args:
+        request: 当前请求
+        db: 数据库会话
+        device_id: 设备ID
+
+    Returns:
+        设备对象，不存在时返回None
+    """
+    cache = _device_cache(request)
+    if device_id not in cache:
+        cache[device_id] = repository.get_device(db, device_id)
+    return cache[device_id]
+
+
+def get_device_or_404(request: Request, db: Session, device_id: str) -> DeviceModel:
+    """
+    加载设备，不存在时抛出404
+    """
+    device = load_device(request, db, device_id)
+    if not device:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="设备不存在"
+        )
+    return device
+
+
+async def require_device(device_id: str, request: Request, db: Session = Depends(get_db)) -> DeviceModel:
+    """
+    设备解析依赖项，从路径或查询参数中的device_id加载设备
+    """
+    return get_device_or_404(request, db, device_id)
+
+
+async def require_read_device(device_id: str, request: Request, db: Session = Depends(get_read_db)) -> DeviceModel:
+    """
+    只读设备解析依赖项，GET请求从只读副本加载设备
+    """
+    return get_device_or_404(request, db, device_id)
+
+
+def get_device_with_latest_content(
+    request: Request,
+    db: Session,
+    device_id: str
+) -> Tuple[DeviceModel, Optional[ContentModel]]:
+    """
+    一次查询同时获取设备和它最新的活跃内容
+
+    Returns:
+        (设备, 最新活跃内容)，设备没有活跃内容时内容为None
+    """
+    row = repository.get_device_with_latest_content(db, device_id)
+
+    if not row:
+        _device_cache(request)[device_id] = None
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="设备不存在"
+        )
+
+    device, content = row
+    _device_cache(request)[device_id] = device
+    return device, content
+
+
+def get_device_with_content(
+    request: Request,
+    db: Session,
+    device_id: str,
+    version: int
+) -> Tuple[DeviceModel, Optional[ContentModel]]:
+    """
+    一次查询同时获取设备和指定版本的内容
+
+    Returns:
+        (设备, 指定版本内容)，版本不存在时内容为None
+    """
+    row = repository.get_device_with_content(db, device_id, version)
+
+    if not row:
+        _device_cache(request)[device_id] = None
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="设备不存在"
+        )
+
+    device, content = row
+    _device_cache(request)[device_id] = device
+    return device, content
+
+
+def ensure_device_exists(request: Request, db: Session, device_id: str, rows: list) -> list:
+    """
+    列表查询的设备校验：结果非空时设备必然存在，只有空结果才额外查询设备
+
+    Returns:
+        原样返回rows
+    """
+    if not rows:
+        get_device_or_404(request, db, device_id)
+    return rows
+
+
+def get_active_devices(request: Request, db: Session) -> List[DeviceModel]:
+    """
+    获取活跃设备列表，同一请求内只查询一次（管理后台表单复用）
+    """
+    devices = getattr(request.state, "active_devices", None)
+    if devices is None:
+        devices = db.query(DeviceModel).filter(DeviceModel.is_active == True).all()
+        request.state.active_devices = devices
+    return devices
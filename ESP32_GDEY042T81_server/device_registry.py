@@ -0,0 +1,247 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Dict, Any, Callable, List
+
+from sqlalchemy.orm import Session
+
+from config import settings
+from models import Device as DeviceModel, Content as ContentModel
+from mqtt_manager import mqtt_manager
+from repository import get_device_summary
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceEntry(NamedTuple):
+    """设备注册表中缓存的设备摘要"""
+    exists: bool
+    is_active: bool = False
+    scene: Optional[str] = None
+    profile: Optional[Dict[str, Any]] = None
+    current_version: Optional[int] = None
+    push_frames: bool = False
+    current_image: Optional[str] = None
+
+
+# 设备不存在时的负缓存条目
+MISSING = DeviceEntry(exists=False)
+
+
+class DeviceRegistry:
+    """
+    进程内设备注册表缓存
+
+    缓存 device_id -> (是否存在, 是否激活, 场景, 显示配置, 当前内容版本, 是否推送帧缓冲, 当前内容图片)，
+    带TTL和容量上限。设备或内容变更时本地失效，并通过MQTT广播给其他uvicorn worker。
+    每次失效递增设备的失效代数，读取前记下代数，写入缓存时代数已变化说明读取期间发生了变更
+    （或读到的是失效前的副本数据），丢弃这次写入，避免旧数据在缓存中停留整个TTL。
+    """
+
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.worker_id = uuid.uuid4().hex
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_puts = 0
+        self._listeners: List[Callable[[str], None]] = []
+
+    def get(self, device_id: str) -> Optional[DeviceEntry]:
+        """
+        读取缓存条目
+
+        Returns:
+            缓存的设备条目，未缓存或已过期时返回None
+        """
+        with self._lock:
+            item = self._entries.get(device_id)
+            if item is None:
+                self.misses += 1
+                return None
+
+            entry, expires_at = item
+            if expires_at < time.monotonic():
+                del self._entries[device_id]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(device_id)
+            self.hits += 1
+            return entry
+
+    def generation(self, device_id: str) -> int:
+        """设备的失效代数，在读取数据库之前获取，写入缓存时传给put"""
+        with self._lock:
+            return self._generations.get(device_id, 0)
+
+    def session_generation(self, db: Session, device_id: str) -> int:
+        """
+        会话读取设备数据时对应的失效代数
+
+        只读会话在选择副本之前记下了代数（见db_router.read_session），其他会话返回当前代数，
+        因此需要在查询之前调用
+        """
+        generations = db.info.get("registry_generations")
+        if generations is not None and device_id in generations:
+            return generations[device_id]
+        return self.generation(device_id)
+
+    def put(self, device_id: str, entry: DeviceEntry, generation: Optional[int] = None) -> bool:
+        """
+        写入缓存条目，超出容量时淘汰最久未使用的条目
+
+        Args:
+            device_id: 设备ID
+            entry: 设备条目
+            generation: 读取数据之前获取的失效代数，之后设备已失效时不写入
+
+        Returns:
+            是否写入
+        """
+        with self._lock:
+            if generation is not None and self._generations.get(device_id, 0) != generation:
+                self.stale_puts += 1
+                return False
+            self._entries[device_id] = (entry, time.monotonic() + self.ttl)
+            self._entries.move_to_end(device_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def load(self, db: Session, device_id: str) -> DeviceEntry:
+        """
+        读取设备条目，未命中时用一次查询从数据库加载
+
+        Args:
+            db: 数据库会话
+            device_id: 设备ID
+
+        Returns:
+            设备条目（设备不存在时为MISSING）
+        """
+        entry = self.get(device_id)
+        if entry is not None:
+            return entry
+
+        generation = self.session_generation(db, device_id)
+        row = get_device_summary(db, device_id)
+
+        if row is None:
+            entry = MISSING
+        else:
+            is_active, scene, name, push_frames, current_version, current_image = row
+            entry = DeviceEntry(
+                exists=True,
+                is_active=bool(is_active),
+                scene=scene,
+                profile=build_profile(name),
+                current_version=current_version,
+                push_frames=bool(push_frames),
+                current_image=current_image
+            )
+
+        self.put(device_id, entry, generation)
+        return entry
+
+    def remember(self, device: DeviceModel, content: Optional[ContentModel], generation: int):
+        """
+        用已经查询到的设备和最新活跃内容刷新缓存，避免重复查询
+
+        Args:
+            device: 设备对象
+            content: 最新活跃内容
+            generation: 查询之前用session_generation获取的失效代数
+        """
+        self.put(device.device_id, DeviceEntry(
+            exists=True,
+            is_active=bool(device.is_active),
+            scene=device.scene,
+            profile=build_profile(device.name),
+            current_version=content.version if content else None,
+            push_frames=bool(device.push_frames),
+            current_image=content.image_path if content else None
+        ), generation)
+
+    def add_listener(self, callback: Callable[[str], None]):
+        """
+        注册失效监听器，本地或其他worker使设备失效时都会以device_id调用
+        """
+        self._listeners.append(callback)
+
+    def invalidate(self, device_id: str, broadcast: bool = True):
+        """
+        使设备条目失效
+
+        Args:
+            device_id: 设备ID
+            broadcast: 是否通过MQTT通知其他worker
+        """
+        with self._lock:
+            self._entries.pop(device_id, None)
+            self._generations[device_id] = self._generations.get(device_id, 0) + 1
+
+        for callback in self._listeners:
+            try:
+                callback(device_id)
+            except Exception as e:
+                logger.error(f"设备注册表失效监听器执行失败: {str(e)}")
+
+        if broadcast:
+            payload = json.dumps({"device_id": device_id, "origin": self.worker_id})
+            mqtt_manager.publish_message(settings.registry_invalidation_topic, payload)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+
+    def handle_invalidation_message(self, topic: str, payload: str):
+        """处理其他worker广播的失效消息"""
+        try:
+            data = json.loads(payload)
+        except json.JSONDecodeError:
+            logger.warning(f"无效的设备注册表失效消息: {payload}")
+            return
+
+        # 忽略自己发出的广播
+        if data.get("origin") == self.worker_id:
+            return
+
+        device_id = data.get("device_id")
+        if device_id:
+            self.invalidate(device_id, broadcast=False)
+
+    def stats(self) -> Dict[str, int]:
+        """缓存统计信息"""
+        with self._lock:
+            size = len(self._entries)
+        return {"size": size, "hits": self.hits, "misses": self.misses, "stale_puts": self.stale_puts}
+
+
+def build_profile(name: Optional[str]) -> Dict[str, Any]:
+    """构建设备显示配置"""
+    return {
+        "name": name,
+        "width": settings.ink_width,
+        "height": settings.ink_height
+    }
+
+
+# 全局设备注册表实例
+device_registry = DeviceRegistry(
+    ttl=settings.device_registry_ttl,
+    max_size=settings.device_registry_max_size
+)
+
+# 订阅跨worker失效广播
+mqtt_manager.register_topic_handler(
+    settings.registry_invalidation_topic,
+    device_registry.handle_invalidation_message
+)
@@ -0,0 +1,181 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import DateTime, String, bindparam, column, or_, update, values
+from sqlalchemy.orm.attributes import set_committed_value
+
+from config import settings
+from database import engine
+from models import Device as DeviceModel
+from mqtt_manager import mqtt_manager
+from presence import presence_tracker
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL单条UPDATE ... FROM (VALUES ...)中的最大行数
+FLUSH_CHUNK_SIZE = 1000
+
+
+class HeartbeatBuffer:
+    """
+    设备心跳写后缓冲
+
+    MQTT状态上报和HTTP轮询只在内存中记录每个设备最新的心跳时间，
+    后台线程每隔flush_interval秒用一条批量UPDATE写入devices.last_online，
+    关闭服务时再刷新一次。读取设备状态时合并尚未写入的心跳。
+    每次心跳同时更新在线状态表，只通过HTTP轮询的设备也会显示为在线。
+    """
+
+    def __init__(self, flush_interval: int, online_timeout: int):
+        self.flush_interval = flush_interval
+        self.online_timeout = online_timeout
+        self._pending: Dict[str, datetime] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.flushed_total = 0
+
+    def record(self, device_id: str, when: Optional[datetime] = None):
+        """记录设备心跳（只保留最新时间），并标记设备在线"""
+        when = when or datetime.utcnow()
+        self._remember(device_id, when)
+        presence_tracker.update(device_id, True, when)
+
+    def _remember(self, device_id: str, when: datetime):
+        with self._lock:
+            current = self._pending.get(device_id)
+            if current is None or when > current:
+                self._pending[device_id] = when
+
+    def pending(self, device_id: str) -> Optional[datetime]:
+        """获取设备尚未写入数据库的心跳时间"""
+        with self._lock:
+            return self._pending.get(device_id)
+
+    def last_online(self, device_id: str, stored: Optional[datetime]) -> Optional[datetime]:
+        """
+        合并数据库中的时间和缓冲中的心跳
+
+        Args:
+            device_id: 设备ID
+            stored: 数据库中的last_online
+
+        Returns:
+            最新的在线时间
+        """
+        pending = self.pending(device_id)
+        if pending is None:
+            return stored
+        if stored is None or pending > stored:
+            return pending
+        return stored
+
+    def is_online(self, last_online: Optional[datetime]) -> bool:
+        """根据最后在线时间判断设备是否在线"""
+        if last_online is None:
+            return False
+        return datetime.utcnow() - last_online <= timedelta(seconds=self.online_timeout)
+
+    def apply(self, devices: Iterable[DeviceModel]):
+        """
+        将缓冲中的心跳合并到设备对象上（不标记为已修改，不会被提交）
+        """
+        for device in devices:
+            merged = self.last_online(device.device_id, device.last_online)
+            if merged is not device.last_online:
+                set_committed_value(device, "last_online", merged)
+
+    def flush(self) -> int:
+        """
+        将缓冲中的心跳批量写入数据库
+
+        Returns:
+            写入的设备数量
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            rows = list(batch.items())
+            try:
+                with engine.begin() as conn:
+                    for start in range(0, len(rows), FLUSH_CHUNK_SIZE):
+                        self._write_chunk(conn, rows[start:start + FLUSH_CHUNK_SIZE])
+            except Exception as e:
+                logger.error(f"写入设备心跳失败: {str(e)}")
+                # 放回缓冲，保留较新的时间，下次刷新时重试
+                for device_id, when in rows:
+                    self._remember(device_id, when)
+                return 0
+
+            self.flushed_total += len(rows)
+            return len(rows)
+
+    def _write_chunk(self, conn, rows: list):
+        """写入一批心跳，只会把last_online向后推进"""
+        table = DeviceModel.__table__
+        if conn.dialect.name == "postgresql":
+            heartbeats = values(
+                column("device_id", String),
+                column("last_online", DateTime),
+                name="heartbeats"
+            ).data(rows)
+            conn.execute(
+                update(table)
+                .where(table.c.device_id == heartbeats.c.device_id)
+                .where(or_(table.c.last_online.is_(None), table.c.last_online < heartbeats.c.last_online))
+                .values(last_online=heartbeats.c.last_online, updated_at=table.c.updated_at)
+            )
+        else:
+            # 其他数据库不支持VALUES派生表，使用executemany
+            conn.execute(
+                update(table)
+                .where(table.c.device_id == bindparam("b_device_id"))
+                .where(or_(table.c.last_online.is_(None), table.c.last_online < bindparam("b_last_online")))
+                .values(last_online=bindparam("b_last_online"), updated_at=table.c.updated_at),
+                [{"b_device_id": device_id, "b_last_online": when} for device_id, when in rows]
+            )
+
+    def handle_device_status(self, device_id: str, status_data: dict):
+        """MQTT状态上报监听器"""
+        self.record(device_id)
+
+    def handle_device_ack(self, device_id: str, ack_data: dict):
+        """MQTT确认消息监听器"""
+        self.record(device_id)
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="heartbeat-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程并写入剩余的心跳"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+# 全局设备心跳缓冲实例
+heartbeat_buffer = HeartbeatBuffer(
+    flush_interval=settings.heartbeat_flush_interval,
+    online_timeout=settings.device_online_timeout
+)
+
+# 设备状态上报和确认消息即视为心跳
+mqtt_manager.add_status_listener(heartbeat_buffer.handle_device_status)
+mqtt_manager.add_ack_listener(heartbeat_buffer.handle_device_ack)
@@ -0,0 +1,332 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import settings
+from database import SessionLocal
+from mqtt_manager import mqtt_manager
+from schemas import MQTTCommand
+from device_registry import device_registry
+from framebuffer_cache import framebuffer_cache
+from repository import get_content_by_version
+from retention import resolve_image_file
+from api.contents import convert_to_binary_data
+
+logger = logging.getLogger(__name__)
+
+# 分片头（大端）：内容版本 u32、分片序号 u16、分片总数 u16、分片数据的CRC32 u32
+CHUNK_HEADER = struct.Struct(">IHHI")
+# 推送的帧缓冲使用二进制接口的默认转换参数 (invert, rotate, dither)
+FRAME_OPTIONS = (False, False, True)
+# 设备确认消息中的类型
+ACK_TYPE = "frame"
+
+
+class FramePushSession:
+    """等待设备确认的一次帧缓冲推送"""
+
+    __slots__ = ("version", "chunks", "started_at", "deadline", "attempts")
+
+    def __init__(self, version: int, chunks: List[Tuple[int, bytes]], started_at: float, deadline: float):
+        self.version = version
+        self.chunks = chunks
+        self.started_at = started_at
+        self.deadline = deadline
+        self.attempts = 1
+
+
+class FramePusher:
+    """
+    帧缓冲MQTT推送
+
+    开启了push_frames的设备更新内容时，不再发送update命令让设备通过HTTP下载，
+    而是把zlib压缩后的帧缓冲按ESP32 MQTT缓冲区大小分片发布到 esp32/{device_id}/frame，
+    每个分片带序号、总数和CRC32。设备收齐后在 esp32/{device_id}/ack 回复
+    {"type": "frame", "content_version": 版本, "status": "ok" | "missing" | "error", "missing": [序号]}，
+    缺片时只补发缺少的分片，超时或出错时整帧重发，多次失败后改为发送update命令。
+    帧缓冲通过帧缓冲缓存生成，压缩分片后的结果按图片缓存在内存中，同一画面推送给多台设备时只转换和压缩一次。
+    """
+
+    def __init__(self, chunk_size: int, ack_timeout: float, max_attempts: int, cache_size: int):
+        self.chunk_size = chunk_size
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+        self.cache_size = cache_size
+        self._requests: "OrderedDict[str, int]" = OrderedDict()
+        self._sessions: Dict[str, FramePushSession] = {}
+        self._frames: "OrderedDict[tuple, List[Tuple[bytes, int]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.requested_total = 0
+        self.pushed_total = 0
+        self.chunks_total = 0
+        self.bytes_total = 0
+        self.completed_total = 0
+        self.resent_chunks_total = 0
+        self.retried_total = 0
+        self.fallback_total = 0
+        self.frame_cache_hits = 0
+        self.frame_cache_misses = 0
+        self._completion_seconds = 0.0
+
+    def handle_update(self, device_id: str, content_version: int) -> bool:
+        """
+        内容更新处理函数（注册到MQTT管理器），开启了推送的设备由推送线程处理
+
+        在请求线程中调用，不查询数据库（SQLite模式下请求还持有唯一的写连接）：
+        设备注册表未缓存的设备也交给推送线程，查询后未开启推送时改为发送update命令。
+
+        Returns:
+            是否接管（已知未开启推送的设备返回False，继续发送update命令）
+        """
+        entry = device_registry.get(device_id)
+        if entry is not None and (not entry.exists or not entry.push_frames):
+            return False
+
+        with self._lock:
+            self._requests[device_id] = content_version
+            self.requested_total += 1
+        self._wake.set()
+        return True
+
+    def handle_device_ack(self, device_id: str, ack_data: Dict[str, Any]):
+        """处理设备的帧缓冲确认（MQTT网络线程中调用）"""
+        if ack_data.get("type") != ACK_TYPE:
+            return
+        with self._lock:
+            session = self._sessions.get(device_id)
+            if session is None or ack_data.get("content_version") != session.version:
+                return
+
+            result = ack_data.get("status")
+            if result == "ok":
+                del self._sessions[device_id]
+                self.completed_total += 1
+                self._completion_seconds += time.monotonic() - session.started_at
+                logger.debug(f"设备 {device_id} 已收到版本 {session.version} 的帧缓冲")
+                return
+
+            if result == "missing" and isinstance(ack_data.get("missing"), list):
+                wanted = {seq for seq in ack_data["missing"] if isinstance(seq, int)}
+                chunks = [chunk for chunk in session.chunks if chunk[0] in wanted]
+                self.resent_chunks_total += len(chunks)
+            else:
+                chunks = self._retry(device_id, session)
+                if chunks is None:
+                    return
+            session.deadline = time.monotonic() + self.ack_timeout
+        if chunks:
+            self._publish(device_id, chunks)
+
+    def _retry(self, device_id: str, session: FramePushSession) -> Optional[List[Tuple[int, bytes]]]:
+        """整帧重发，超过最大次数时改为发送update命令（调用方持有锁）"""
+        if session.attempts >= self.max_attempts:
+            del self._sessions[device_id]
+            self.fallback_total += 1
+            logger.warning(f"设备 {device_id} 多次未确认帧缓冲，改为发送更新命令")
+            self._fallback(device_id, session.version)
+            return None
+        session.attempts += 1
+        self.retried_total += 1
+        return session.chunks
+
+    def _fallback(self, device_id: str, content_version: int):
+        """发送update命令，由设备通过HTTP下载"""
+        mqtt_manager.publish_command(device_id, MQTTCommand(
+            type="update",
+            content_version=content_version,
+            timestamp=int(time.time())
+        ))
+
+    def _publish(self, device_id: str, chunks: List[Tuple[int, bytes]]):
+        mqtt_manager.publish_frame_chunks(device_id, chunks)
+        self.chunks_total += len(chunks)
+        self.bytes_total += sum(len(payload) for _, payload in chunks)
+
+    def frame_chunks(self, device_id: str, version: int, image_path: str) -> List[Tuple[bytes, int]]:
+        """
+        获取帧缓冲压缩后的分片
+
+        Returns:
+            (分片数据, CRC32) 列表
+        """
+        key = (image_path, settings.ink_width, settings.ink_height, FRAME_OPTIONS, self.chunk_size)
+        with self._lock:
+            pieces = self._frames.get(key)
+            if pieces is not None:
+                self._frames.move_to_end(key)
+                self.frame_cache_hits += 1
+                return pieces
+            self.frame_cache_misses += 1
+
+        image_file = resolve_image_file(image_path)
+        invert, rotate, dither = FRAME_OPTIONS
+        data = framebuffer_cache.get_or_build(
+            device_id,
+            version,
+            image_path,
+            FRAME_OPTIONS,
+            lambda: convert_to_binary_data(
+                image_file,
+                width=settings.ink_width,
+                height=settings.ink_height,
+                invert=invert,
+                rotate=rotate,
+                dither=dither
+            )
+        )
+        compressed = zlib.compress(data, 9)
+        pieces = [
+            (compressed[start:start + self.chunk_size], zlib.crc32(compressed[start:start + self.chunk_size]))
+            for start in range(0, len(compressed), self.chunk_size)
+        ]
+
+        with self._lock:
+            self._frames[key] = pieces
+            while len(self._frames) > self.cache_size:
+                self._frames.popitem(last=False)
+        return pieces
+
+    def push(self, device_id: str, content_version: int):
+        """生成分片并发布，设备未开启推送或内容没有图片时改为发送update命令"""
+        db = SessionLocal()
+        try:
+            entry = device_registry.load(db, device_id)
+            if not entry.exists:
+                return
+            if not entry.push_frames:
+                self._fallback(device_id, content_version)
+                return
+            content = get_content_by_version(db, device_id, content_version)
+            image_path = content.image_path if content else None
+        finally:
+            db.close()
+
+        if not image_path or not os.path.exists(resolve_image_file(image_path)):
+            self._fallback(device_id, content_version)
+            return
+
+        pieces = self.frame_chunks(device_id, content_version, image_path)
+        total = len(pieces)
+        chunks = [
+            (seq, CHUNK_HEADER.pack(content_version, seq, total, crc) + body)
+            for seq, (body, crc) in enumerate(pieces)
+        ]
+
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[device_id] = FramePushSession(content_version, chunks, now, now + self.ack_timeout)
+            self.pushed_total += 1
+        self._publish(device_id, chunks)
+        logger.debug(f"向设备 {device_id} 推送版本 {content_version} 的帧缓冲，共 {total} 个分片")
+
+    def check_timeouts(self):
+        """超时未确认的推送整帧重发"""
+        now = time.monotonic()
+        resend = []
+        with self._lock:
+            for device_id, session in list(self._sessions.items()):
+                if session.deadline > now:
+                    continue
+                chunks = self._retry(device_id, session)
+                if chunks is not None:
+                    session.deadline = now + self.ack_timeout
+                    resend.append((device_id, chunks))
+        for device_id, chunks in resend:
+            self._publish(device_id, chunks)
+
+    def stats(self) -> Dict[str, int]:
+        """推送统计信息"""
+        with self._lock:
+            return {
+                "pending_requests": len(self._requests),
+                "awaiting_ack": len(self._sessions),
+                "requested": self.requested_total,
+                "pushed": self.pushed_total,
+                "completed": self.completed_total,
+                "retried": self.retried_total,
+                "fallback": self.fallback_total,
+                "chunks": self.chunks_total,
+                "resent_chunks": self.resent_chunks_total,
+                "bytes": self.bytes_total,
+                "frame_cache_size": len(self._frames),
+                "frame_cache_hits": self.frame_cache_hits,
+                "frame_cache_misses": self.frame_cache_misses
+            }
+
+    def render_prometheus(self) -> str:
+        """以Prometheus文本格式导出推送指标"""
+        stats = self.stats()
+        lines = [
+            "# HELP luna_frame_push_total 帧缓冲推送次数（按结果）",
+            "# TYPE luna_frame_push_total counter",
+        ]
+        for result in ("requested", "pushed", "completed", "retried", "fallback"):
+            lines.append(f'luna_frame_push_total{{result="{result}"}} {stats[result]}')
+        lines += [
+            "# HELP luna_frame_push_awaiting_ack 等待设备确认的推送数",
+            "# TYPE luna_frame_push_awaiting_ack gauge",
+            f"luna_frame_push_awaiting_ack {stats['awaiting_ack']}",
+            "# HELP luna_frame_push_chunks_total 发布的分片数（包括补发）",
+            "# TYPE luna_frame_push_chunks_total counter",
+            f"luna_frame_push_chunks_total {stats['chunks']}",
+            "# HELP luna_frame_push_bytes_total 发布的分片字节数",
+            "# TYPE luna_frame_push_bytes_total counter",
+            f"luna_frame_push_bytes_total {stats['bytes']}",
+            "# HELP luna_frame_push_completion_seconds_total 推送到设备确认的总耗时",
+            "# TYPE luna_frame_push_completion_seconds_total counter",
+            f"luna_frame_push_completion_seconds_total {self._completion_seconds:.6f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """启动推送线程"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="frame-push", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止推送线程"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(1.0)
+            self._wake.clear()
+            while True:
+                with self._lock:
+                    if not self._requests:
+                        break
+                    device_id, content_version = self._requests.popitem(last=False)
+                try:
+                    self.push(device_id, content_version)
+                except Exception as e:
+                    logger.error(f"推送设备 {device_id} 帧缓冲失败: {str(e)}")
+                    self._fallback(device_id, content_version)
+            self.check_timeouts()
+
+
+# 全局帧缓冲推送实例
+frame_pusher = FramePusher(
+    chunk_size=settings.mqtt_frame_chunk_size,
+    ack_timeout=settings.mqtt_frame_ack_timeout,
+    max_attempts=settings.mqtt_frame_max_attempts,
+    cache_size=settings.mqtt_frame_cache_size
+)
+
+# 开启了推送的设备更新内容时推送帧缓冲，并接收设备的确认
+mqtt_manager.register_update_handler(frame_pusher.handle_update)
+mqtt_manager.add_ack_listener(frame_pusher.handle_device_ack)
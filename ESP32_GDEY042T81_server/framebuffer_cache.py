@@ -0,0 +1,156 @@
+import glob
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from typing import Callable, Optional, Tuple
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def image_fingerprint(image_path: Optional[str]) -> str:
+    """
+    图片路径的短指纹（上传和处理后的图片文件名唯一，更换图片即更换路径）
+
+    Args:
+        image_path: 内容图片路径
+
+    Returns:
+        12位十六进制指纹，没有图片时为"none"
+    """
+    if not image_path:
+        return "none"
+    return hashlib.md5(image_path.encode("utf-8")).hexdigest()[:12]
+
+
+class FramebufferCache:
+    """
+    墨水屏帧缓冲磁盘缓存
+
+    图片转换为墨水屏二进制数据的开销较大，转换结果按
+    (设备, 版本, 图片路径, 屏幕尺寸, 转换参数) 缓存到磁盘。
+    图片路径参与文件名，同一版本更换图片后旧文件不会被读取
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def device_dir(self, device_id: str) -> str:
+        """设备的缓存目录（设备ID中的特殊字符替换为下划线）"""
+        return os.path.join(self.cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", device_id))
+
+    def path_for(
+        self,
+        device_id: str,
+        version: int,
+        image_path: str,
+        options: Tuple[bool, bool, bool]
+    ) -> str:
+        """
+        获取缓存文件路径
+
+        Args:
+            device_id: 设备ID
+            version: 内容版本
+            image_path: 内容图片路径
+            options: 转换参数 (invert, rotate, dither)
+
+        Returns:
+            缓存文件路径
+        """
+        image_key = image_fingerprint(image_path)
+        flags = "".join(str(int(flag)) for flag in options)
+        filename = f"v{version}-{image_key}-{settings.ink_width}x{settings.ink_height}-{flags}.bin"
+        return os.path.join(self.device_dir(device_id), filename)
+
+    def get(self, device_id: str, version: int, image_path: str, options: Tuple[bool, bool, bool]) -> Optional[bytes]:
+        """读取缓存，未缓存时返回None"""
+        try:
+            with open(self.path_for(device_id, version, image_path, options), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, device_id: str, version: int, image_path: str, options: Tuple[bool, bool, bool], data: bytes):
+        """写入缓存（先写临时文件再替换，避免读到写了一半的文件）"""
+        path = self.path_for(device_id, version, image_path, options)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def get_or_build(
+        self,
+        device_id: str,
+        version: int,
+        image_path: str,
+        options: Tuple[bool, bool, bool],
+        builder: Callable[[], bytes]
+    ) -> bytes:
+        """
+        读取缓存，未缓存时调用builder生成并写入缓存
+
+        Returns:
+            帧缓冲二进制数据
+        """
+        data = self.get(device_id, version, image_path, options)
+        if data is not None:
+            return data
+
+        data = builder()
+        try:
+            self.put(device_id, version, image_path, options, data)
+        except OSError as e:
+            logger.warning(f"写入帧缓冲缓存失败: {str(e)}")
+        return data
+
+    def remove_version(self, device_id: str, version: int) -> int:
+        """
+        删除内容版本的所有缓存文件
+
+        Returns:
+            删除的文件数量
+        """
+        removed = 0
+        for path in glob.glob(os.path.join(self.device_dir(device_id), f"v{version}-*.bin")):
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def remove_device(self, device_id: str) -> int:
+        """
+        删除设备的所有缓存文件
+
+        Returns:
+            删除的文件数量
+        """
+        removed = 0
+        directory = self.device_dir(device_id)
+        for path in glob.glob(os.path.join(directory, "*.bin")):
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+        return removed
+
+
+# 全局帧缓冲缓存实例
+framebuffer_cache = FramebufferCache(settings.framebuffer_cache_dir)
@@ -0,0 +1,343 @@
+import json
+import logging
+import queue
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import DateTime, Integer, String, bindparam, column, func, or_, update, values
+
+from config import settings
+from database import engine
+from db_router import read_session
+from models import Device as DeviceModel
+from mqtt_manager import mqtt_manager
+from schemas import MQTTStatus
+from device_registry import device_registry
+from presence import presence_tracker
+from telemetry import ERROR_EVENTS
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL单条UPDATE ... FROM (VALUES ...)中的最大行数
+FLUSH_CHUNK_SIZE = 1000
+
+
+class StatusIngestionPipeline:
+    """
+    设备状态上报处理管道
+
+    MQTT网络线程只把原始消息放入有界队列（队列满时丢弃并计数），不做解析，
+    工作线程解码JSON、用MQTTStatus校验后通知状态监听器（心跳、遥测），
+    并把设备的最新事件、已应用的内容版本和最近错误合并在内存中，由刷新线程批量写入devices表。
+    设备的在线消息（esp32/{device_id}/online，保留消息和遗嘱消息）也经过该队列，更新在线状态表。
+    """
+
+    def __init__(self, queue_size: int, workers: int, flush_interval: float):
+        self.workers = workers
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[Tuple[Optional[str], str, bytes, datetime]]" = queue.Queue(maxsize=queue_size)
+        self._pending: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._flusher: Optional[threading.Thread] = None
+        self.received_total = 0
+        self.processed_total = 0
+        self.invalid_total = 0
+        self.unknown_total = 0
+        self.dropped_total = 0
+        self.flushed_total = 0
+
+    def submit(self, device_id: str, payload: bytes, kind: str = "status"):
+        """
+        MQTT网络线程调用，只入队不处理
+
+        Args:
+            device_id: 主题中的设备ID
+            payload: 原始消息内容
+            kind: 主题类型（status 或 online）
+        """
+        self._count("received_total")
+        try:
+            self._queue.put_nowait((device_id, kind, payload, datetime.utcnow()))
+        except queue.Full:
+            dropped = self._count("dropped_total")
+            if dropped % 1000 == 1:
+                logger.warning(f"设备状态队列已满，已丢弃 {dropped} 条消息")
+
+    def _count(self, counter: str, amount: int = 1) -> int:
+        """
+        增加计数（MQTT网络线程和多个工作线程同时更新，需要加锁）
+
+        Returns:
+            增加后的计数
+        """
+        with self._lock:
+            value = getattr(self, counter) + amount
+            setattr(self, counter, value)
+            return value
+
+    def parse(self, device_id: str, payload: bytes) -> Optional[MQTTStatus]:
+        """
+        解析并校验状态消息
+
+        Returns:
+            状态对象，消息无效时返回None
+        """
+        try:
+            data = json.loads(payload)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return None
+        if not isinstance(data, dict):
+            return None
+
+        # 以主题中的设备ID为准，消息中声明了不同的设备ID视为无效
+        data.setdefault("device_id", device_id)
+        try:
+            status = MQTTStatus.model_validate(data)
+        except ValidationError:
+            return None
+        if status.device_id != device_id:
+            return None
+        return status
+
+    def submit_presence(self, device_id: str, payload: bytes):
+        """在线消息处理函数（MQTT网络线程调用）"""
+        self.submit(device_id, payload, kind="online")
+
+    def is_registered(self, device_id: str) -> bool:
+        """
+        通配符订阅会收到任意设备ID的消息，只处理已注册的设备
+
+        结果由设备注册表缓存（包括不存在的设备），未命中时使用只读会话查询，不占用写连接
+        """
+        entry = device_registry.get(device_id)
+        if entry is None:
+            with read_session(device_id) as db:
+                entry = device_registry.load(db, device_id)
+        if not entry.exists:
+            self._count("unknown_total")
+            return False
+        return True
+
+    def process(self, device_id: str, payload: bytes, received_at: datetime):
+        """处理一条状态消息"""
+        status = self.parse(device_id, payload)
+        if status is None:
+            self._count("invalid_total")
+            logger.debug(f"设备 {device_id} 的状态消息无效: {payload[:200]!r}")
+            return
+        if not self.is_registered(device_id):
+            return
+
+        self.record(status, received_at)
+        mqtt_manager.handle_device_status(device_id, status.model_dump())
+        self._count("processed_total")
+
+    def process_presence(self, device_id: str, payload: bytes, received_at: datetime):
+        """处理一条在线消息"""
+        if not self.is_registered(device_id):
+            return
+        if not presence_tracker.handle_presence(device_id, payload, received_at):
+            self._count("invalid_total")
+            logger.debug(f"设备 {device_id} 的在线消息无效: {payload[:200]!r}")
+            return
+        self._count("processed_total")
+
+    def record(self, status: MQTTStatus, received_at: datetime):
+        """合并设备最新的状态（同一设备在一次刷新前只保留最新事件）"""
+        is_error = status.event in ERROR_EVENTS
+        with self._lock:
+            state = self._pending.get(status.device_id)
+            if state is None:
+                state = self._pending[status.device_id] = {
+                    "b_device_id": status.device_id,
+                    "b_status_updated_at": received_at,
+                    "b_last_event": None,
+                    "b_applied_version": None,
+                    "b_last_error": None,
+                    "b_last_error_at": None
+                }
+            if received_at < state["b_status_updated_at"]:
+                return
+            state["b_status_updated_at"] = received_at
+            state["b_last_event"] = status.event[:30]
+            if status.content_version is not None:
+                state["b_applied_version"] = status.content_version
+            if is_error:
+                state["b_last_error"] = (status.message or status.event)[:500]
+                state["b_last_error_at"] = received_at
+
+    def flush(self) -> int:
+        """
+        将合并后的设备状态批量写入数据库
+
+        Returns:
+            写入的设备数量
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            rows = list(batch.values())
+            try:
+                with engine.begin() as conn:
+                    for start in range(0, len(rows), FLUSH_CHUNK_SIZE):
+                        self._write_chunk(conn, rows[start:start + FLUSH_CHUNK_SIZE])
+            except Exception as e:
+                logger.error(f"写入设备状态失败: {str(e)}")
+                # 放回缓冲（期间收到的更新的状态优先），下次刷新时重试
+                with self._lock:
+                    for row in rows:
+                        self._pending.setdefault(row["b_device_id"], row)
+                return 0
+
+            self._count("flushed_total", len(rows))
+            return len(rows)
+
+    def _write_chunk(self, conn, rows: List[dict]):
+        """写入一批设备状态，只写入比数据库中更新的状态，未上报的字段保持原值"""
+        table = DeviceModel.__table__
+        if conn.dialect.name == "postgresql":
+            statuses = values(
+                column("device_id", String),
+                column("status_updated_at", DateTime),
+                column("last_event", String),
+                column("applied_version", Integer),
+                column("last_error", String),
+                column("last_error_at", DateTime),
+                name="statuses"
+            ).data([
+                (row["b_device_id"], row["b_status_updated_at"], row["b_last_event"],
+                 row["b_applied_version"], row["b_last_error"], row["b_last_error_at"])
+                for row in rows
+            ])
+            source = statuses.c
+            device_id = source.device_id
+            status_updated_at = source.status_updated_at
+            last_event = source.last_event
+            applied_version = source.applied_version
+            last_error = source.last_error
+            last_error_at = source.last_error_at
+            params = None
+        else:
+            # 其他数据库不支持VALUES派生表，使用executemany
+            device_id = bindparam("b_device_id")
+            status_updated_at = bindparam("b_status_updated_at", type_=DateTime)
+            last_event = bindparam("b_last_event", type_=String)
+            applied_version = bindparam("b_applied_version", type_=Integer)
+            last_error = bindparam("b_last_error", type_=String)
+            last_error_at = bindparam("b_last_error_at", type_=DateTime)
+            params = rows
+
+        stmt = update(table).where(
+            table.c.device_id == device_id
+        ).where(
+            or_(table.c.status_updated_at.is_(None), table.c.status_updated_at < status_updated_at)
+        ).values(
+            status_updated_at=status_updated_at,
+            last_event=last_event,
+            applied_version=func.coalesce(applied_version, table.c.applied_version),
+            last_error=func.coalesce(last_error, table.c.last_error),
+            last_error_at=func.coalesce(last_error_at, table.c.last_error_at),
+            updated_at=table.c.updated_at
+        )
+        if params is None:
+            conn.execute(stmt)
+        else:
+            conn.execute(stmt, params)
+
+    def stats(self) -> Dict[str, int]:
+        """管道统计信息"""
+        with self._lock:
+            return {
+                "queue_size": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "received": self.received_total,
+                "processed": self.processed_total,
+                "invalid": self.invalid_total,
+                "unknown": self.unknown_total,
+                "dropped": self.dropped_total,
+                "pending_devices": len(self._pending),
+                "flushed": self.flushed_total
+            }
+
+    def render_prometheus(self) -> str:
+        """以Prometheus文本格式导出管道指标"""
+        stats = self.stats()
+        lines = [
+            "# HELP luna_status_messages_total 设备状态消息数（按处理结果）",
+            "# TYPE luna_status_messages_total counter",
+            f'luna_status_messages_total{{result="received"}} {stats["received"]}',
+            f'luna_status_messages_total{{result="processed"}} {stats["processed"]}',
+            f'luna_status_messages_total{{result="invalid"}} {stats["invalid"]}',
+            f'luna_status_messages_total{{result="unknown"}} {stats["unknown"]}',
+            f'luna_status_messages_total{{result="dropped"}} {stats["dropped"]}',
+            "# HELP luna_status_queue_size 设备状态队列中等待处理的消息数",
+            "# TYPE luna_status_queue_size gauge",
+            f"luna_status_queue_size {stats['queue_size']}",
+            "# HELP luna_status_flushed_total 写入数据库的设备状态数",
+            "# TYPE luna_status_flushed_total counter",
+            f"luna_status_flushed_total {stats['flushed']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """启动工作线程和刷新线程，并接管MQTT状态消息"""
+        if self._threads:
+            return
+        self._stop.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"status-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._flusher = threading.Thread(target=self._flush_loop, name="status-flush", daemon=True)
+        self._flusher.start()
+        mqtt_manager.register_device_topic_handler("status", self.submit)
+        mqtt_manager.register_device_topic_handler("online", self.submit_presence)
+        logger.info(f"设备状态处理管道已启动，工作线程 {self.workers} 个")
+
+    def stop(self):
+        """停止接收新消息，处理完队列中的消息后写入剩余的状态"""
+        mqtt_manager.register_device_topic_handler("status", None)
+        mqtt_manager.register_device_topic_handler("online", None)
+        self._stop.set()
+        for _ in self._threads:
+            self._queue.put((None, "", b"", datetime.utcnow()))
+        for thread in self._threads:
+            thread.join(timeout=10)
+        self._threads = []
+        if self._flusher is not None:
+            self._flusher.join(timeout=10)
+            self._flusher = None
+        self.flush()
+
+    def _work(self):
+        while True:
+            device_id, kind, payload, received_at = self._queue.get()
+            if device_id is None:
+                break
+            try:
+                if kind == "online":
+                    self.process_presence(device_id, payload, received_at)
+                else:
+                    self.process(device_id, payload, received_at)
+            except Exception as e:
+                logger.error(f"处理设备 {device_id} 状态失败: {str(e)}")
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+# 全局设备状态处理管道实例
+status_ingestion = StatusIngestionPipeline(
+    queue_size=settings.status_queue_size,
+    workers=settings.status_workers,
+    flush_interval=settings.status_flush_interval
+)
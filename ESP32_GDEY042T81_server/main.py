@@ -1,4 +1,5 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
@@ -9,9 +10,20 @@ import os
 from config import settings
 from database import init_db
 from mqtt_manager import mqtt_manager
+from mqtt_outbound import outbound_queue
+from frame_push import frame_pusher
+from update_notifier import update_notifier
 from api import api_router
 from admin_routes import admin_router
 from auth import APIKeyMiddleware, AdminAuthMiddleware
+from pagination import NEXT_CURSOR_HEADER
+from db_router import replica_router
+from retention import retention_job
+from device_state import heartbeat_buffer
+from telemetry import telemetry_writer, telemetry_rollup_job
+from ingestion import status_ingestion
+from presence import presence_tracker
+from db_metrics import db_metrics, QUERY_COUNT_HEADER, QUERY_TIME_HEADER, SLOWEST_QUERY_HEADER
 
 # 配置日志
 logging.basicConfig(
@@ -32,9 +44,21 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"数据库初始化失败: {str(e)}")
     
-    # 连接MQTT代理
+    # 加载设备在线状态（先于MQTT连接，订阅后代理会立即投递保留的在线消息）
+    presence_tracker.start()
+    
+    # 启动设备状态上报处理管道（先于MQTT连接，避免丢失连接后立即到达的消息）
+    status_ingestion.start()
+    
+    # 启动MQTT发送队列（恢复落盘文件中未发送的命令，连接成功后发送）
+    outbound_queue.start()
+    
+    # 连接MQTT代理（asyncio模式下在当前事件循环中运行客户端）
     try:
-        mqtt_manager.connect()
+        if settings.mqtt_asyncio:
+            await mqtt_manager.start_async()
+        else:
+            mqtt_manager.connect()
         logger.info("MQTT连接已启动")
     except Exception as e:
         logger.error(f"MQTT连接失败: {str(e)}")
@@ -42,14 +66,58 @@ async def lifespan(app: FastAPI):
     # 确保静态文件目录存在
     os.makedirs(settings.static_dir, exist_ok=True)
     
+    # 启动内容保留后台任务
+    retention_job.start()
+    
+    # 启动设备心跳批量写入
+    heartbeat_buffer.start()
+    
+    # 启动遥测批量写入和汇总任务
+    telemetry_writer.start()
+    telemetry_rollup_job.start()
+    
+    # 启动帧缓冲推送
+    frame_pusher.start()
+    
+    # 启动设备更新通知防抖
+    update_notifier.start()
+    
     yield
     
     # 关闭时执行
     logger.info("正在关闭墨水屏桌面屏幕系统服务端...")
     
+    # 停止内容保留后台任务
+    retention_job.stop()
+    
+    # 停止更新通知防抖，立即发送等待中的通知
+    update_notifier.stop()
+    
+    # 停止帧缓冲推送
+    frame_pusher.stop()
+    
+    # 处理完队列中的设备状态并写入（状态监听器会继续写入心跳和遥测）
+    status_ingestion.stop()
+    
+    # 写入剩余的设备心跳
+    heartbeat_buffer.stop()
+    
+    # 写入剩余的在线状态变化
+    presence_tracker.stop()
+    
+    # 停止遥测汇总任务并写入剩余的遥测事件
+    telemetry_rollup_job.stop()
+    telemetry_writer.stop()
+    
     # 断开MQTT连接
-    mqtt_manager.disconnect()
+    if settings.mqtt_asyncio:
+        await mqtt_manager.stop_async()
+    else:
+        mqtt_manager.disconnect()
     logger.info("MQTT连接已断开")
+    
+    # 停止MQTT发送队列（配置了落盘文件时未发送的命令下次启动后继续发送）
+    outbound_queue.stop()
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -77,6 +145,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, QUERY_COUNT_HEADER, QUERY_TIME_HEADER, SLOWEST_QUERY_HEADER],
 )
 
 # 添加API Key鉴权中间件
@@ -112,9 +181,39 @@ async def root():
 async def health_check():
     return {
         "status": "healthy",
-        "mqtt_connected": mqtt_manager.connected
+        "mqtt_connected": mqtt_manager.connected,
+        "database_replicas": replica_router.stats(),
+        "status_ingestion": status_ingestion.stats(),
+        "presence": presence_tracker.stats(),
+        "mqtt_outbound": outbound_queue.stats(),
+        "frame_push": frame_pusher.stats(),
+        "update_notifier": update_notifier.stats()
     }
 
+# 指标（Prometheus文本格式）
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return (
+        db_metrics.render_prometheus()
+        + status_ingestion.render_prometheus()
+        + presence_tracker.render_prometheus()
+        + outbound_queue.render_prometheus()
+        + frame_pusher.render_prometheus()
+        + update_notifier.render_prometheus()
+    )
+
+# 中间件：记录每个请求的数据库查询
+@app.middleware("http")
+async def record_db_queries(request: Request, call_next):
+    stats = db_metrics.begin_request()
+    try:
+        response = await call_next(request)
+    finally:
+        db_metrics.end_request(db_metrics.route_label(request), stats)
+    if settings.debug:
+        response.headers.update(db_metrics.response_headers(stats))
+    return response
+
 # 中间件：记录请求日志
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
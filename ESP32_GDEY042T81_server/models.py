@@ -2,6 +2,6 @@ from sqlalchemy.orm import Session
 from database import Base
 
 # 导入所有模型以确保它们被注册到Base.metadata
-from database import Device, Content, Todo, Song
+from database import Device, Content, Todo, Song, SongLibrary, ContentArchive, RetentionPolicy, TelemetryEvent, TelemetryRollup
 
-__all__ = ["Device", "Content", "Todo", "Song"]
\ No newline at end of file
+__all__ = ["Device", "Content", "Todo", "Song", "SongLibrary", "ContentArchive", "RetentionPolicy", "TelemetryEvent", "TelemetryRollup"]
\ No newline at end of file
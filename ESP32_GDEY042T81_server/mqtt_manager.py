@@ -1,19 +1,141 @@
+import asyncio
 import json
 import logging
+import threading
 import time
-from typing import Optional, Dict, Any
+from collections import OrderedDict
+from typing import Optional, Dict, Any, AsyncIterator, Callable, List, Tuple
 import paho.mqtt.client as mqtt
 from schemas import MQTTCommand, MQTTStatus
 from config import settings
+from mqtt_outbound import outbound_queue
+from update_notifier import update_notifier
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 设备主题前缀，设备主题格式为 esp32/{device_id}/{类型}
+DEVICE_TOPIC_PREFIX = "esp32"
+# 服务端订阅的设备上行主题类型（使用通配符订阅，与设备数量无关）
+# online 为设备的在线消息：连接时发布保留消息 "online"，遗嘱消息为保留的 "offline"
+DEVICE_INBOUND_TOPICS = ("status", "ack", "online")
+# 分组命令主题：esp32/scene/{场景}/cmd 发给场景内的设备，esp32/all/cmd 发给全部设备
+GROUP_ALL = "all"
+GROUP_SCENE = "scene"
+# 与分组主题冲突，不能用作设备ID
+RESERVED_DEVICE_IDS = (GROUP_ALL, GROUP_SCENE)
+
+
+def device_command_topic(device_id: str) -> str:
+    """设备命令主题"""
+    return f"{DEVICE_TOPIC_PREFIX}/{device_id}/cmd"
+
+
+def group_command_topic(scene: Optional[str] = None) -> str:
+    """分组命令主题，scene为空时为全部设备"""
+    if scene is None:
+        return f"{DEVICE_TOPIC_PREFIX}/{GROUP_ALL}/cmd"
+    return f"{DEVICE_TOPIC_PREFIX}/{GROUP_SCENE}/{scene}/cmd"
+
+
+class AsyncioSocketAdapter:
+    """
+    把paho客户端的套接字挂到asyncio事件循环上（add_reader/add_writer），不启动paho网络线程
+    
+    paho的套接字回调可能在其他线程中触发（如发送队列线程发布消息时注册写事件），统一切换到事件循环线程执行
+    """
+    
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt.Client):
+        self.loop = loop
+        self.client = client
+        self.sock = None
+        self.reading_paused = False
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+    
+    def detach(self):
+        """移除套接字回调"""
+        self.client.on_socket_open = None
+        self.client.on_socket_close = None
+        self.client.on_socket_register_write = None
+        self.client.on_socket_unregister_write = None
+    
+    def _call(self, callback, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+    
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self._open, sock)
+    
+    def _open(self, sock):
+        self.sock = sock
+        self.reading_paused = False
+        self.loop.add_reader(sock, self.client.loop_read)
+    
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self._close, sock)
+    
+    def _close(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if self.sock is sock:
+            self.sock = None
+    
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, self.client.loop_write)
+    
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+    
+    def pause_reading(self):
+        """暂停读取（消息消费者跟不上时由TCP流控向代理施加背压）"""
+        if self.sock is not None and not self.reading_paused:
+            self.loop.remove_reader(self.sock)
+            self.reading_paused = True
+    
+    def resume_reading(self):
+        """恢复读取"""
+        if self.sock is not None and self.reading_paused:
+            self.loop.add_reader(self.sock, self.client.loop_read)
+            self.reading_paused = False
+
+
 class MQTTManager:
     def __init__(self):
         self.client = mqtt.Client()
-        self.connected = False
+        self._connected = threading.Event()
+        # asyncio模式：在事件循环中运行客户端（start_async启动）
+        self._adapter: Optional[AsyncioSocketAdapter] = None
+        self._connection_task: Optional[asyncio.Task] = None
+        # 等待投递确认的publish_async调用：消息ID -> (事件循环, Future)
+        self._deliveries: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        self._delivery_lock = threading.Lock()
+        self._awaiting = 0
+        # publish返回消息ID之前到达的确认（线程模式下on_publish可能先于publish返回）：消息ID -> 确认时间
+        # 只有在publish_async发出消息之后记录的确认才属于它（消息ID回绕后，发送队列等更早消息的同一ID不会误匹配）
+        self._early_mids: "OrderedDict[int, float]" = OrderedDict()
+        # 通过messages()异步迭代消息的订阅者队列
+        self._subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+        self.subscriber_dropped = 0
+        # 服务端内部主题的处理函数，连接成功后自动订阅
+        self.topic_handlers: Dict[str, Callable[[str, str], None]] = {}
+        # 设备状态上报的监听器
+        self.status_listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+        # 设备上行主题的处理函数，按主题类型分发，参数为(设备ID, 原始消息内容)
+        self.device_topic_handlers: Dict[str, Callable[[str, bytes], None]] = {}
+        # 设备确认消息的监听器
+        self.ack_listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+        # 内容更新的处理函数（如帧缓冲推送），返回True时不再发送update命令
+        self.update_handler: Optional[Callable[[str, int], bool]] = None
         self.setup_client()
     
     def setup_client(self):
@@ -22,15 +144,28 @@ class MQTTManager:
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
+        
+        # 命令通过发送队列发布，由队列控制同时等待确认的消息数
+        self.client.max_inflight_messages_set(settings.mqtt_outbound_max_inflight)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+        outbound_queue.bind(self._publish_raw)
+        update_notifier.bind(self.dispatch_updates)
         
         # 设置认证信息（如果有）
         if settings.mqtt_username and settings.mqtt_password:
             self.client.username_pw_set(settings.mqtt_username, settings.mqtt_password)
     
+    @property
+    def connected(self) -> bool:
+        """是否已连接到MQTT代理（可在任意线程中读取）"""
+        return self._connected.is_set()
+    
     def connect(self):
         """连接到MQTT代理"""
         try:
-            self.client.connect(settings.mqtt_broker_host, settings.mqtt_broker_port, 60)
+            # 异步连接：代理暂时不可用时由网络线程持续重连，期间的命令保留在发送队列中
+            self.client.connect_async(settings.mqtt_broker_host, settings.mqtt_broker_port, 60)
             self.client.loop_start()
             logger.info(f"正在连接到MQTT代理 {settings.mqtt_broker_host}:{settings.mqtt_broker_port}")
         except Exception as e:
@@ -39,136 +174,459 @@ class MQTTManager:
     def disconnect(self):
         """断开MQTT连接"""
         if self.connected:
-            self.client.loop_stop()
             self.client.disconnect()
             logger.info("已断开MQTT连接")
+        self.client.loop_stop()
+    
+    async def start_async(self):
+        """
+        asyncio模式：在当前事件循环中运行MQTT客户端（不启动paho网络线程），
+        由后台任务负责连接、断线重连和保活
+        """
+        loop = asyncio.get_running_loop()
+        self._adapter = AsyncioSocketAdapter(loop, self.client)
+        self._connection_task = loop.create_task(self._maintain_connection())
+        logger.info(f"正在连接到MQTT代理 {settings.mqtt_broker_host}:{settings.mqtt_broker_port}（asyncio模式）")
+    
+    async def stop_async(self):
+        """asyncio模式：断开连接并停止后台任务"""
+        if self._connection_task is not None:
+            self._connection_task.cancel()
+            try:
+                await self._connection_task
+            except asyncio.CancelledError:
+                pass
+            self._connection_task = None
+        if self._adapter is not None:
+            if self.client.socket() is not None:
+                self.client.disconnect()
+                # 等待DISCONNECT报文写出后套接字关闭
+                for _ in range(20):
+                    if self._adapter.sock is None:
+                        break
+                    await asyncio.sleep(0.05)
+            self._adapter.detach()
+            self._adapter = None
+            logger.info("已断开MQTT连接")
+    
+    async def _maintain_connection(self):
+        """连接代理（失败时指数退避重试），连接后每秒执行一次保活处理"""
+        loop = asyncio.get_running_loop()
+        delay = 1
+        first = True
+        while True:
+            if self.client.socket() is None:
+                try:
+                    # 建立TCP连接会阻塞，放到线程池中执行
+                    if first:
+                        await loop.run_in_executor(
+                            None, self.client.connect, settings.mqtt_broker_host, settings.mqtt_broker_port, 60
+                        )
+                        first = False
+                    else:
+                        await loop.run_in_executor(None, self.client.reconnect)
+                    delay = 1
+                except Exception as e:
+                    logger.error(f"连接MQTT代理失败: {str(e)}，{delay} 秒后重试")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+                    continue
+            self.client.loop_misc()
+            await asyncio.sleep(1)
     
     def on_connect(self, client, userdata, flags, rc):
         """连接回调函数"""
         if rc == 0:
-            self.connected = True
+            self._connected.set()
             logger.info("成功连接到MQTT代理")
+            
+            # 重新订阅（断线重连后订阅会丢失）：设备上行主题使用通配符，内部主题逐个订阅
+            for kind in DEVICE_INBOUND_TOPICS:
+                self.client.subscribe(f"{DEVICE_TOPIC_PREFIX}/+/{kind}")
+            for topic in self.topic_handlers:
+                self.client.subscribe(topic)
+            
+            outbound_queue.set_connected(True)
         else:
             logger.error(f"连接MQTT代理失败，返回码: {rc}")
     
     def on_disconnect(self, client, userdata, rc):
         """断开连接回调函数"""
-        self.connected = False
+        self._connected.clear()
+        outbound_queue.set_connected(False)
         logger.warning(f"与MQTT代理断开连接，返回码: {rc}")
     
+    def on_publish(self, client, userdata, mid):
+        """发布完成回调函数（QoS 1/2 为收到代理确认）"""
+        with self._delivery_lock:
+            delivery = self._deliveries.pop(mid, None)
+            if delivery is None and self._awaiting:
+                self._early_mids.pop(mid, None)
+                self._early_mids[mid] = time.monotonic()
+                while len(self._early_mids) > 1024:
+                    self._early_mids.popitem(last=False)
+        if delivery is not None:
+            loop, future = delivery
+            loop.call_soon_threadsafe(_resolve_future, future)
+            return
+        outbound_queue.acknowledge(mid)
+    
+    async def publish_async(self, topic: str, payload, qos: int = 1, timeout: Optional[float] = None) -> float:
+        """
+        直接发布消息并等待投递确认（不经过发送队列）
+        
+        Args:
+            topic: 主题
+            payload: 消息内容
+            qos: 服务质量等级，1/2 等待代理确认，0 等待写入网络
+            timeout: 等待确认的最长时间（秒），为空时一直等待
+            
+        Returns:
+            从发布到确认的耗时（秒）
+            
+        Raises:
+            ConnectionError: 未连接或发布失败
+            asyncio.TimeoutError: 超时未确认
+        """
+        if not self.connected:
+            raise ConnectionError("MQTT未连接")
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        started = time.perf_counter()
+        with self._delivery_lock:
+            self._awaiting += 1
+        mid = None
+        try:
+            # 不能持有锁调用publish（paho持有内部锁时回调on_publish），用时间区分本次消息的提前确认
+            issued_at = time.monotonic()
+            result = self.client.publish(topic, payload, qos=qos)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise ConnectionError(f"发布消息失败，错误码: {result.rc}")
+            mid = result.mid
+            with self._delivery_lock:
+                acked_at = self._early_mids.pop(mid, None)
+                if acked_at is not None and acked_at >= issued_at:
+                    future.set_result(None)
+                else:
+                    self._deliveries[mid] = (loop, future)
+            await asyncio.wait_for(future, timeout)
+            return time.perf_counter() - started
+        finally:
+            with self._delivery_lock:
+                self._awaiting -= 1
+                if mid is not None:
+                    self._deliveries.pop(mid, None)
+                if not self._awaiting:
+                    self._early_mids.clear()
+    
+    async def messages(self, maxsize: int = 1000) -> AsyncIterator[Tuple[str, bytes]]:
+        """
+        异步迭代收到的MQTT消息（服务端订阅的所有主题）
+        
+        asyncio模式下队列满时暂停读取套接字，由TCP流控向代理施加背压；
+        线程模式下队列满时丢弃消息并计数。
+        
+        用法:
+            async for topic, payload in mqtt_manager.messages():
+                ...
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize)
+        subscriber = (loop, queue)
+        self._subscribers.append(subscriber)
+        try:
+            while True:
+                item = await queue.get()
+                yield item
+                if self._adapter is not None and self._adapter.reading_paused and all(
+                    q.qsize() <= q.maxsize // 2 for _, q in self._subscribers
+                ):
+                    self._adapter.resume_reading()
+        finally:
+            self._subscribers.remove(subscriber)
+            if self._adapter is not None and not self._subscribers:
+                self._adapter.resume_reading()
+    
+    def _feed_subscribers(self, topic: str, payload: bytes):
+        """把消息交给messages()的订阅者"""
+        for loop, queue in list(self._subscribers):
+            if self._adapter is not None and self._adapter.loop is loop:
+                # asyncio模式：回调在事件循环线程中执行，队列满时暂停读取
+                self._put_or_drop(queue, (topic, payload))
+                if queue.full():
+                    self._adapter.pause_reading()
+            else:
+                loop.call_soon_threadsafe(self._put_or_drop, queue, (topic, payload))
+    
+    def _put_or_drop(self, queue: asyncio.Queue, item: Tuple[str, bytes]):
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.subscriber_dropped += 1
+    
     def on_message(self, client, userdata, msg):
         """消息接收回调函数"""
         try:
             topic = msg.topic
-            payload = msg.payload.decode("utf-8")
-            logger.info(f"收到MQTT消息 - 主题: {topic}, 内容: {payload}")
-            
-            # 解析设备状态上报
-            if "/status" in topic:
-                device_id = topic.split("/")[1]
-                status_data = json.loads(payload)
-                self.handle_device_status(device_id, status_data)
+            if self._subscribers:
+                self._feed_subscribers(topic, msg.payload)
+            
+            # 服务端内部主题
+            handler = self.topic_handlers.get(topic)
+            if handler:
+                handler(topic, msg.payload.decode("utf-8"))
+                return
+            
+            # 设备上行主题按分段路由：esp32/{device_id}/{类型}
+            segments = topic.split("/")
+            if len(segments) != 3 or segments[0] != DEVICE_TOPIC_PREFIX or not segments[1]:
+                logger.debug(f"忽略未知主题的MQTT消息: {topic}")
+                return
+            
+            _, device_id, kind = segments
+            device_handler = self.device_topic_handlers.get(kind)
+            if device_handler:
+                device_handler(device_id, msg.payload)
+            elif kind == "status":
+                # 未启用处理管道时在网络线程中直接处理
+                self.handle_device_status(device_id, json.loads(msg.payload))
+            elif kind == "ack":
+                self.handle_device_ack(device_id, json.loads(msg.payload))
                 
         except Exception as e:
             logger.error(f"处理MQTT消息失败: {str(e)}")
     
     def handle_device_status(self, device_id: str, status_data: Dict[str, Any]):
         """处理设备状态上报"""
+        logger.debug(f"设备 {device_id} 状态上报: {status_data}")
+        for listener in self.status_listeners:
+            try:
+                listener(device_id, status_data)
+            except Exception as e:
+                logger.error(f"处理设备状态失败: {str(e)}")
+    
+    def handle_device_ack(self, device_id: str, ack_data: Dict[str, Any]):
+        """处理设备确认消息"""
+        logger.debug(f"设备 {device_id} 确认: {ack_data}")
+        for listener in self.ack_listeners:
+            try:
+                listener(device_id, ack_data)
+            except Exception as e:
+                logger.error(f"处理设备确认失败: {str(e)}")
+    
+    def add_ack_listener(self, listener: Callable[[str, Dict[str, Any]], None]):
+        """
+        注册设备确认消息的监听器
+        
+        Args:
+            listener: 监听函数，参数为(设备ID, 确认数据)
+        """
+        self.ack_listeners.append(listener)
+    
+    def register_device_topic_handler(self, kind: str, handler: Optional[Callable[[str, bytes], None]]):
+        """
+        注册设备上行主题（esp32/+/{kind}）的处理函数，在MQTT网络线程中调用，应尽快返回
+        
+        Args:
+            kind: 主题类型，如 status、ack
+            handler: 处理函数，参数为(设备ID, 原始消息内容)，为None时恢复默认处理
+        """
+        if handler is None:
+            self.device_topic_handlers.pop(kind, None)
+        else:
+            self.device_topic_handlers[kind] = handler
+    
+    def register_update_handler(self, handler: Optional[Callable[[str, int], bool]]):
+        """
+        注册内容更新的处理函数，send_update_command先交给它处理
+        
+        Args:
+            handler: 处理函数，参数为(设备ID, 内容版本)，返回是否已处理；为None时恢复只发送update命令
+        """
+        self.update_handler = handler
+    
+    def _handle_update(self, device_id: str, content_version: int) -> bool:
+        """交给更新处理函数，处理失败时返回False（改为发送update命令）"""
+        if self.update_handler is None:
+            return False
         try:
-            # 这里可以更新设备状态到数据库
-            # 例如：更新最后在线时间、处理错误状态等
-            logger.info(f"设备 {device_id} 状态上报: {status_data}")
+            return self.update_handler(device_id, content_version)
         except Exception as e:
-            logger.error(f"处理设备状态失败: {str(e)}")
+            logger.error(f"处理设备 {device_id} 内容更新失败: {str(e)}")
+            return False
     
-    def publish_command(self, device_id: str, command: MQTTCommand) -> bool:
+    def add_status_listener(self, listener: Callable[[str, Dict[str, Any]], None]):
         """
-        向设备发布命令
+        注册设备状态上报的监听器
         
         Args:
-            device_id: 设备ID
-            command: 命令对象
+            listener: 监听函数，参数为(设备ID, 状态数据)
+        """
+        self.status_listeners.append(listener)
+    
+    def register_topic_handler(self, topic: str, handler: Callable[[str, str], None]):
+        """
+        注册内部主题的消息处理函数
+        
+        Args:
+            topic: 主题
+            handler: 处理函数，参数为(主题, 消息内容)
+        """
+        self.topic_handlers[topic] = handler
+        if self.connected:
+            self.client.subscribe(topic)
+    
+    def publish_message(self, topic: str, payload: str) -> bool:
+        """
+        向任意主题发布消息
+        
+        Args:
+            topic: 主题
+            payload: 消息内容
             
         Returns:
             是否发布成功
         """
         if not self.connected:
-            logger.error("MQTT未连接，无法发布命令")
+            logger.debug(f"MQTT未连接，跳过发布: {topic}")
             return False
         
         try:
-            topic = f"esp32/{device_id}/cmd"
-            payload = command.model_dump_json()
-            
             result = self.client.publish(topic, payload)
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.info(f"成功向设备 {device_id} 发布命令: {payload}")
-                return True
-            else:
-                logger.error(f"向设备 {device_id} 发布命令失败，错误码: {result.rc}")
-                return False
-                
+            return result.rc == mqtt.MQTT_ERR_SUCCESS
         except Exception as e:
-            logger.error(f"发布命令失败: {str(e)}")
+            logger.error(f"发布消息失败: {str(e)}")
             return False
     
-    def send_update_command(self, device_id: str, content_version: int) -> bool:
+    def _publish_raw(self, topic: str, payload: bytes, qos: int):
+        """发送队列使用的发布函数，返回(返回码, 消息ID)"""
+        result = self.client.publish(topic, payload, qos=qos)
+        return result.rc, result.mid
+    
+    def publish_command(self, device_id: str, command: MQTTCommand) -> bool:
         """
-        发送更新命令
+        向设备发布命令（加入发送队列，代理断开期间保留，重新连接后发送）
+        
+        同一设备同一类型的命令在发出前只保留最新的一条
         
         Args:
             device_id: 设备ID
-            content_version: 内容版本
+            command: 命令对象
             
         Returns:
-            是否发送成功
+            是否已加入发送队列
         """
-        command = MQTTCommand(
-            type="update",
-            content_version=content_version,
-            timestamp=int(time.time())
-        )
-        return self.publish_command(device_id, command)
+        topic = device_command_topic(device_id)
+        payload = command.model_dump_json()
+        queued = outbound_queue.enqueue(topic, payload, coalesce_key=f"{topic}/{command.type}")
+        logger.debug(f"向设备 {device_id} 发布命令: {payload}")
+        return queued
     
-    def subscribe_to_device_status(self, device_id: str):
+    def publish_frame_chunks(self, device_id: str, chunks: List[Tuple[int, bytes]]) -> int:
         """
-        订阅设备状态
+        向设备的帧缓冲主题 esp32/{device_id}/frame 发布分片（一次加入发送队列）
+        
+        同一序号的分片在发出前只保留最新的一条
         
         Args:
             device_id: 设备ID
+            chunks: (分片序号, 分片内容) 列表
+            
+        Returns:
+            加入发送队列的分片数
         """
-        if not self.connected:
-            logger.error("MQTT未连接，无法订阅")
-            return
+        topic = f"{DEVICE_TOPIC_PREFIX}/{device_id}/frame"
+        return outbound_queue.enqueue_many([
+            (topic, payload, f"{topic}/{seq}") for seq, payload in chunks
+        ])
+    
+    def publish_commands(self, commands: List[Tuple[str, MQTTCommand]]) -> int:
+        """
+        向多个设备发布各自的命令（一次加入发送队列，由发送线程流水线发布）
         
-        try:
-            topic = f"esp32/{device_id}/status"
-            self.client.subscribe(topic)
-            logger.info(f"已订阅设备 {device_id} 状态")
-        except Exception as e:
-            logger.error(f"订阅设备状态失败: {str(e)}")
+        Args:
+            commands: (设备ID, 命令对象) 列表
+            
+        Returns:
+            加入发送队列的命令数
+        """
+        messages = []
+        for device_id, command in commands:
+            topic = device_command_topic(device_id)
+            messages.append((topic, command.model_dump_json(), f"{topic}/{command.type}"))
+        count = outbound_queue.enqueue_many(messages)
+        logger.debug(f"向 {count} 个设备发布命令")
+        return count
     
-    def unsubscribe_from_device_status(self, device_id: str):
+    def publish_group_command(self, command: MQTTCommand, scene: Optional[str] = None) -> bool:
         """
-        取消订阅设备状态
+        通过分组主题发布命令（一次发布，所有订阅该分组的设备都会收到）
+        
+        Args:
+            command: 命令对象
+            scene: 场景，为空时发给全部设备
+            
+        Returns:
+            是否已加入发送队列
+        """
+        topic = group_command_topic(scene)
+        payload = command.model_dump_json()
+        queued = outbound_queue.enqueue(topic, payload, coalesce_key=f"{topic}/{command.type}")
+        logger.debug(f"向分组 {topic} 发布命令: {payload}")
+        return queued
+    
+    def send_update_command(self, device_id: str, content_version: int) -> bool:
+        """
+        发送更新命令（启用防抖时在窗口期结束后发送，已注册的更新处理函数接管时不发送）
         
         Args:
             device_id: 设备ID
+            content_version: 内容版本
+            
+        Returns:
+            是否已加入发送队列、等待防抖或已由更新处理函数接管
         """
-        if not self.connected:
-            logger.error("MQTT未连接，无法取消订阅")
-            return
+        return self.send_update_commands({device_id: content_version}) > 0
+    
+    def send_update_commands(self, versions: Dict[str, int]) -> int:
+        """
+        向多个设备发送各自内容版本的更新命令（启用防抖时在窗口期结束后发送）
         
-        try:
-            topic = f"esp32/{device_id}/status"
-            self.client.unsubscribe(topic)
-            logger.info(f"已取消订阅设备 {device_id} 状态")
-        except Exception as e:
-            logger.error(f"取消订阅设备状态失败: {str(e)}")
+        Args:
+            versions: 设备ID到内容版本的映射
+            
+        Returns:
+            加入发送队列、等待防抖或已由更新处理函数接管的设备数
+        """
+        if update_notifier.enabled:
+            update_notifier.notify(versions)
+            return len(versions)
+        return self.dispatch_updates(versions)
+    
+    def dispatch_updates(self, versions: Dict[str, int]) -> int:
+        """
+        立即发送更新命令（已注册的更新处理函数接管的设备不发送）
+        
+        Args:
+            versions: 设备ID到内容版本的映射
+            
+        Returns:
+            加入发送队列或已由更新处理函数接管的设备数
+        """
+        timestamp = int(time.time())
+        handled = 0
+        commands = []
+        for device_id, version in versions.items():
+            if self._handle_update(device_id, version):
+                handled += 1
+            else:
+                commands.append((device_id, MQTTCommand(type="update", content_version=version, timestamp=timestamp)))
+        return handled + self.publish_commands(commands)
     
     def send_todo_command(self, device_id: str, action: str, todo_data: Dict[str, Any]) -> bool:
         """
-        发送待办事项命令
+        发送待办事项命令（加入发送队列，每条命令都会按顺序发送，不合并）
         
         Args:
             device_id: 设备ID
@@ -176,32 +634,22 @@ class MQTTManager:
             todo_data: 待办事项数据
             
         Returns:
-            是否发送成功
+            是否已加入发送队列
         """
-        if not self.connected:
-            logger.error("MQTT未连接，无法发送待办事项命令")
-            return False
-        
-        try:
-            topic = f"esp32/{device_id}/todo"
-            payload = {
-                "type": "todo",
-                "action": action,
-                "data": todo_data,
-                "timestamp": int(time.time())
-            }
-            
-            result = self.client.publish(topic, json.dumps(payload))
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.info(f"成功向设备 {device_id} 发送待办事项命令: {action}")
-                return True
-            else:
-                logger.error(f"向设备 {device_id} 发送待办事项命令失败，错误码: {result.rc}")
-                return False
-                
-        except Exception as e:
-            logger.error(f"发送待办事项命令失败: {str(e)}")
-            return False
+        topic = f"{DEVICE_TOPIC_PREFIX}/{device_id}/todo"
+        payload = {
+            "type": "todo",
+            "action": action,
+            "data": todo_data,
+            "timestamp": int(time.time())
+        }
+        queued = outbound_queue.enqueue(topic, json.dumps(payload))
+        logger.debug(f"向设备 {device_id} 发送待办事项命令: {action}")
+        return queued
+
+def _resolve_future(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
 
 # 全局MQTT管理器实例
-mqtt_manager = MQTTManager()
\ No newline at end of file
+mqtt_manager = MQTTManager()
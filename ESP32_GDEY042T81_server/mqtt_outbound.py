@@ -0,0 +1,473 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# 投递延迟直方图的分桶上界（秒）：从入队到代理确认（QoS 0 为写入网络）
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 60.0, 300.0)
+
+
+class OutboundMessage:
+    """发送队列中的一条消息"""
+
+    __slots__ = ("key", "coalesce_key", "topic", "payload", "qos", "enqueued_at",
+                 "attempts", "next_attempt", "mid", "sent_at", "spool_id")
+
+    def __init__(self, key: str, coalesce_key: Optional[str], topic: str, payload: bytes, qos: int,
+                 enqueued_at: float, spool_id: Optional[int] = None):
+        self.key = key
+        self.coalesce_key = coalesce_key
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+        self.next_attempt = 0.0
+        self.mid: Optional[int] = None
+        self.sent_at = 0.0
+        self.spool_id = spool_id
+
+
+class OutboundQueue:
+    """
+    MQTT下行消息发送队列
+
+    命令先入队再由发送线程发布，代理断开期间的命令保留在队列中，重新连接后立即发送。
+    同一设备同一类型的命令（如多次内容更新）只保留最新的一条，已发出但未确认的旧命令不受影响。
+    通过paho的on_publish回调确认投递（QoS 1/2 为收到代理确认，QoS 0 为写入网络），
+    超时未确认或发布失败时按指数退避重试，超过有效期的消息丢弃。
+    内存中最多保留max_messages条消息；配置了SQLite落盘文件时所有待发送的消息同时写入文件，
+    超出内存上限的消息只保存在文件中，服务重启后继续发送；未配置时超出上限丢弃最旧的消息。
+    """
+
+    def __init__(self, qos: int, max_messages: int, max_inflight: int, ack_timeout: float,
+                 retry_base: float, retry_max: float, ttl: float, spool_path: Optional[str] = None):
+        self.qos = qos
+        self.max_messages = max_messages
+        self.max_inflight = max_inflight
+        self.ack_timeout = ack_timeout
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.ttl = ttl
+        self.spool_path = spool_path
+        self._pending: "OrderedDict[str, OutboundMessage]" = OrderedDict()
+        self._inflight: Dict[int, OutboundMessage] = {}
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._publish: Optional[Callable[[str, bytes, int], Tuple[int, int]]] = None
+        self._connected = False
+        self._sequence = 0
+        # 发布调用返回前到达的确认（on_publish在网络线程中可能先于publish返回）
+        self._sending = 0
+        self._early_acks: set = set()
+        self._spool: Optional[sqlite3.Connection] = None
+        self._spooled = 0
+        self.enqueued_total = 0
+        self.coalesced_total = 0
+        self.delivered_total = 0
+        self.retried_total = 0
+        self.dropped_total = 0
+        self.expired_total = 0
+        self._latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self._latency_sum = 0.0
+
+    def bind(self, publish: Callable[[str, bytes, int], Tuple[int, int]]):
+        """
+        设置实际的发布函数
+
+        Args:
+            publish: 发布函数，参数为(主题, 消息内容, QoS)，返回(返回码, 消息ID)
+        """
+        self._publish = publish
+
+    def enqueue(self, topic: str, payload: bytes, qos: Optional[int] = None,
+                coalesce_key: Optional[str] = None) -> bool:
+        """
+        将消息加入发送队列
+
+        Args:
+            topic: 主题
+            payload: 消息内容
+            qos: 服务质量等级，默认使用配置值
+            coalesce_key: 合并键，队列中已有相同合并键且尚未发出的消息时替换其内容
+
+        Returns:
+            是否已加入队列（超出内存上限且没有落盘文件时丢弃最旧的消息，新消息总是入队）
+        """
+        with self._cond:
+            self._enqueue(topic, payload, self.qos if qos is None else qos, coalesce_key, time.time())
+            self._cond.notify()
+        return True
+
+    def enqueue_many(self, messages: List[Tuple[str, bytes, Optional[str]]], qos: Optional[int] = None) -> int:
+        """
+        一次加入多条消息（只加锁一次，落盘文件在一个事务中写入），由发送线程流水线发布
+
+        Args:
+            messages: (主题, 消息内容, 合并键) 列表
+            qos: 服务质量等级，默认使用配置值
+
+        Returns:
+            加入队列的消息数
+        """
+        qos = self.qos if qos is None else qos
+        now = time.time()
+        with self._cond:
+            if self._spool is not None:
+                self._spool.execute("BEGIN")
+            try:
+                for topic, payload, coalesce_key in messages:
+                    self._enqueue(topic, payload, qos, coalesce_key, now)
+            finally:
+                if self._spool is not None:
+                    self._spool.execute("COMMIT")
+            self._cond.notify()
+        return len(messages)
+
+    def _enqueue(self, topic: str, payload, qos: int, coalesce_key: Optional[str], now: float):
+        """加入一条消息（调用方持有锁）"""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.enqueued_total += 1
+        existing = self._pending.get(coalesce_key) if coalesce_key else None
+        if existing is not None:
+            self.coalesced_total += 1
+            if existing.mid is None:
+                existing.topic, existing.payload, existing.qos = topic, payload, qos
+                self._spool_update(existing)
+                return
+            # 旧消息已发出，等待确认的同时排入新消息
+            message = OutboundMessage(coalesce_key, coalesce_key, topic, payload, qos, now, existing.spool_id)
+            self._pending[coalesce_key] = message
+            self._spool_update(message)
+            return
+
+        if coalesce_key and self._spooled and self._spool_coalesce(coalesce_key, topic, payload, qos):
+            self.coalesced_total += 1
+            return
+
+        if len(self._pending) >= self.max_messages:
+            if self._spool is not None:
+                self._spool_insert(coalesce_key, topic, payload, qos, now, loaded=False)
+                self._spooled += 1
+                return
+            self._drop_oldest()
+
+        message = OutboundMessage(coalesce_key or self._next_key(), coalesce_key, topic, payload, qos, now)
+        if self._spool is not None:
+            message.spool_id = self._spool_insert(coalesce_key, topic, payload, qos, now, loaded=True)
+        self._pending[message.key] = message
+
+    def acknowledge(self, mid: int):
+        """
+        消息投递确认（paho on_publish回调，在网络线程中调用）
+
+        Args:
+            mid: 消息ID
+        """
+        with self._cond:
+            message = self._inflight.pop(mid, None)
+            if message is None:
+                if self._sending:
+                    self._early_acks.add(mid)
+                return
+            self._delivered(message)
+
+    def set_connected(self, connected: bool):
+        """
+        代理连接状态变化，重新连接后立即发送等待重试的消息
+
+        Args:
+            connected: 是否已连接
+        """
+        with self._cond:
+            self._connected = connected
+            if connected:
+                for message in self._pending.values():
+                    if message.mid is None:
+                        message.next_attempt = 0.0
+            self._cond.notify()
+
+    def _delivered(self, message: OutboundMessage):
+        latency = time.time() - message.enqueued_at
+        self.delivered_total += 1
+        self._latency_sum += latency
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self._latency_buckets[index] += 1
+        # 发出后被新消息替换的旧消息只结束自己的投递
+        if self._pending.get(message.key) is message:
+            del self._pending[message.key]
+            self._spool_delete(message)
+            self._refill()
+        logger.debug(f"消息已投递: {message.topic}，延迟 {latency * 1000:.1f}ms")
+
+    def _retry_later(self, message: OutboundMessage, now: float):
+        message.attempts += 1
+        message.mid = None
+        message.next_attempt = now + min(self.retry_base * (2 ** (message.attempts - 1)), self.retry_max)
+        self.retried_total += 1
+
+    def _drop_oldest(self):
+        for key, message in self._pending.items():
+            if message.mid is None:
+                del self._pending[key]
+                self.dropped_total += 1
+                if self.dropped_total % 1000 == 1:
+                    logger.warning(f"MQTT发送队列已满，已丢弃 {self.dropped_total} 条消息")
+                return
+
+    def _next_key(self) -> str:
+        self._sequence += 1
+        return f"#{self._sequence}"
+
+    def _collect(self) -> Tuple[List[OutboundMessage], float]:
+        """选出可以发送的消息，同时处理确认超时和过期的消息（调用方持有锁）"""
+        now = time.monotonic()
+        wall = time.time()
+        wait = 1.0
+
+        for mid, message in list(self._inflight.items()):
+            if now - message.sent_at >= self.ack_timeout:
+                del self._inflight[mid]
+                if self._pending.get(message.key) is message:
+                    logger.debug(f"消息确认超时，稍后重试: {message.topic}")
+                    self._retry_later(message, now)
+            else:
+                wait = min(wait, message.sent_at + self.ack_timeout - now)
+
+        batch = []
+        for key, message in list(self._pending.items()):
+            if message.mid is not None:
+                continue
+            if wall - message.enqueued_at > self.ttl:
+                del self._pending[key]
+                self._spool_delete(message)
+                self.expired_total += 1
+                continue
+            if not self._connected:
+                continue
+            if len(self._inflight) + len(batch) >= self.max_inflight:
+                break
+            if message.next_attempt <= now:
+                batch.append(message)
+            else:
+                wait = min(wait, message.next_attempt - now)
+        self._refill()
+        return batch, max(wait, 0.01)
+
+    def _send(self, message: OutboundMessage):
+        """发布一条消息（不持有锁）"""
+        try:
+            rc, mid = self._publish(message.topic, message.payload, message.qos)
+        except Exception as e:
+            logger.error(f"发布消息失败: {str(e)}")
+            rc, mid = mqtt.MQTT_ERR_UNKNOWN, None
+
+        now = time.monotonic()
+        with self._cond:
+            # QoS 1/2 在未连接时由paho保留并在重新连接后发送，同样等待确认
+            accepted = rc == mqtt.MQTT_ERR_SUCCESS or (rc == mqtt.MQTT_ERR_NO_CONN and message.qos > 0)
+            if not accepted or mid is None:
+                logger.debug(f"发布消息失败，错误码: {rc}，稍后重试: {message.topic}")
+                self._retry_later(message, now)
+                return
+            message.sent_at = now
+            if mid in self._early_acks:
+                self._early_acks.discard(mid)
+                message.mid = mid
+                self._delivered(message)
+                return
+            message.mid = mid
+            self._inflight[mid] = message
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond:
+                batch, wait = self._collect()
+                if not batch:
+                    self._cond.wait(wait)
+                    continue
+                self._sending += 1
+            try:
+                for message in batch:
+                    self._send(message)
+            finally:
+                with self._cond:
+                    self._sending -= 1
+                    if not self._sending:
+                        self._early_acks.clear()
+
+    def _open_spool(self):
+        """打开落盘文件，加载上次未发送的消息"""
+        directory = os.path.dirname(self.spool_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._spool = sqlite3.connect(self.spool_path, check_same_thread=False, isolation_level=None)
+        self._spool.execute("PRAGMA journal_mode=WAL")
+        self._spool.execute(
+            "CREATE TABLE IF NOT EXISTS outbound_messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, coalesce_key TEXT UNIQUE, topic TEXT NOT NULL, "
+            "payload BLOB NOT NULL, qos INTEGER NOT NULL, enqueued_at REAL NOT NULL, "
+            "loaded INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._spool.execute("UPDATE outbound_messages SET loaded = 0")
+        self._spooled = self._spool.execute("SELECT COUNT(*) FROM outbound_messages").fetchone()[0]
+        self._refill()
+        if self._spooled or self._pending:
+            logger.info(f"从落盘文件恢复 {len(self._pending) + self._spooled} 条待发送的MQTT消息")
+
+    def _refill(self):
+        """内存队列有空位时从落盘文件加载只保存在文件中的消息（调用方持有锁）"""
+        if self._spool is None or not self._spooled or len(self._pending) >= self.max_messages:
+            return
+        limit = self.max_messages - len(self._pending)
+        rows = self._spool.execute(
+            "SELECT id, coalesce_key, topic, payload, qos, enqueued_at FROM outbound_messages "
+            "WHERE loaded = 0 ORDER BY id LIMIT ?",
+            (limit,)
+        ).fetchall()
+        for spool_id, coalesce_key, topic, payload, qos, enqueued_at in rows:
+            message = OutboundMessage(
+                coalesce_key or self._next_key(), coalesce_key, topic, bytes(payload), qos, enqueued_at, spool_id
+            )
+            self._pending[message.key] = message
+        if rows:
+            self._spool.executemany(
+                "UPDATE outbound_messages SET loaded = 1 WHERE id = ?", [(row[0],) for row in rows]
+            )
+        # 取到的行数少于空位数说明文件中已没有未加载的消息
+        self._spooled = 0 if len(rows) < limit else max(self._spooled - len(rows), 0)
+
+    def _spool_insert(self, coalesce_key: Optional[str], topic: str, payload: bytes, qos: int,
+                      enqueued_at: float, loaded: bool) -> int:
+        cursor = self._spool.execute(
+            "INSERT INTO outbound_messages (coalesce_key, topic, payload, qos, enqueued_at, loaded) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (coalesce_key, topic, payload, qos, enqueued_at, int(loaded))
+        )
+        return cursor.lastrowid
+
+    def _spool_update(self, message: OutboundMessage):
+        if self._spool is None:
+            return
+        if message.spool_id is None:
+            message.spool_id = self._spool_insert(
+                message.coalesce_key, message.topic, message.payload, message.qos, message.enqueued_at, True
+            )
+            return
+        self._spool.execute(
+            "UPDATE outbound_messages SET topic = ?, payload = ?, qos = ? WHERE id = ?",
+            (message.topic, message.payload, message.qos, message.spool_id)
+        )
+
+    def _spool_coalesce(self, coalesce_key: str, topic: str, payload: bytes, qos: int) -> bool:
+        if self._spool is None:
+            return False
+        cursor = self._spool.execute(
+            "UPDATE outbound_messages SET topic = ?, payload = ?, qos = ? WHERE coalesce_key = ? AND loaded = 0",
+            (topic, payload, qos, coalesce_key)
+        )
+        return cursor.rowcount > 0
+
+    def _spool_delete(self, message: OutboundMessage):
+        if self._spool is not None and message.spool_id is not None:
+            self._spool.execute("DELETE FROM outbound_messages WHERE id = ?", (message.spool_id,))
+
+    def stats(self) -> Dict[str, int]:
+        """队列统计信息"""
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "inflight": len(self._inflight),
+                "spooled": self._spooled,
+                "enqueued": self.enqueued_total,
+                "coalesced": self.coalesced_total,
+                "delivered": self.delivered_total,
+                "retried": self.retried_total,
+                "dropped": self.dropped_total,
+                "expired": self.expired_total
+            }
+
+    def render_prometheus(self) -> str:
+        """以Prometheus文本格式导出队列指标"""
+        stats = self.stats()
+        with self._cond:
+            buckets = list(self._latency_buckets)
+            latency_sum = self._latency_sum
+            delivered = self.delivered_total
+        lines = [
+            "# HELP luna_mqtt_outbound_queue_depth MQTT发送队列中的消息数",
+            "# TYPE luna_mqtt_outbound_queue_depth gauge",
+            f'luna_mqtt_outbound_queue_depth{{state="pending"}} {stats["pending"]}',
+            f'luna_mqtt_outbound_queue_depth{{state="inflight"}} {stats["inflight"]}',
+            f'luna_mqtt_outbound_queue_depth{{state="spooled"}} {stats["spooled"]}',
+            "# HELP luna_mqtt_outbound_messages_total MQTT发送队列消息数（按结果）",
+            "# TYPE luna_mqtt_outbound_messages_total counter",
+        ]
+        for result in ("enqueued", "coalesced", "delivered", "retried", "dropped", "expired"):
+            lines.append(f'luna_mqtt_outbound_messages_total{{result="{result}"}} {stats[result]}')
+        lines += [
+            "# HELP luna_mqtt_outbound_delivery_seconds 从入队到投递确认的延迟",
+            "# TYPE luna_mqtt_outbound_delivery_seconds histogram",
+        ]
+        for bound, count in zip(LATENCY_BUCKETS, buckets):
+            lines.append(f'luna_mqtt_outbound_delivery_seconds_bucket{{le="{bound}"}} {count}')
+        lines.append(f'luna_mqtt_outbound_delivery_seconds_bucket{{le="+Inf"}} {delivered}')
+        lines.append(f"luna_mqtt_outbound_delivery_seconds_sum {latency_sum:.6f}")
+        lines.append(f"luna_mqtt_outbound_delivery_seconds_count {delivered}")
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """打开落盘文件并启动发送线程"""
+        if self._thread is not None:
+            return
+        if self.spool_path:
+            with self._cond:
+                self._open_spool()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="mqtt-outbound", daemon=True)
+        self._thread.start()
+        logger.info(f"MQTT发送队列已启动，QoS {self.qos}")
+
+    def stop(self):
+        """停止发送线程，未发送的消息保留在落盘文件中"""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        with self._cond:
+            remaining = len(self._pending) + self._spooled
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+                self._pending.clear()
+                self._inflight.clear()
+                self._spooled = 0
+            elif remaining:
+                logger.warning(f"MQTT发送队列中还有 {remaining} 条消息未发送（未配置落盘文件）")
+
+
+# 全局MQTT发送队列实例
+outbound_queue = OutboundQueue(
+    qos=settings.mqtt_command_qos,
+    max_messages=settings.mqtt_outbound_max_messages,
+    max_inflight=settings.mqtt_outbound_max_inflight,
+    ack_timeout=settings.mqtt_outbound_ack_timeout,
+    retry_base=settings.mqtt_outbound_retry_base,
+    retry_max=settings.mqtt_outbound_retry_max,
+    ttl=settings.mqtt_outbound_ttl,
+    spool_path=settings.mqtt_outbound_spool_path
+)
@@ -0,0 +1,97 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from fastapi import HTTPException, Response, status
+from sqlalchemy import DateTime, tuple_
+from sqlalchemy.orm import Query
+
+# 下一页游标的响应头
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    将排序键的值编码为不透明游标
+
+    Args:
+        values: 排序键的值列表
+
+    Returns:
+        URL安全的游标字符串
+    """
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, keys: list) -> List[Any]:
+    """
+    解析游标为排序键的值
+
+    Args:
+        cursor: 游标字符串
+        keys: 排序键列（用于还原值类型）
+
+    Returns:
+        排序键的值列表
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError("游标长度不匹配")
+        return [
+            datetime.fromisoformat(value) if isinstance(key.type, DateTime) else value
+            for key, value in zip(keys, values)
+        ]
+    except (ValueError, TypeError, UnicodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="无效的分页游标"
+        )
+
+
+def fetch_page(
+    query: Query,
+    keys: list,
+    cursor: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100
+) -> Tuple[list, Optional[str]]:
+    """
+    按排序键降序分页查询，提供游标时使用keyset分页，否则兼容offset分页
+
+    Args:
+        query: 已添加过滤条件的查询
+        keys: 排序键列，需要能唯一确定一行（例如 created_at, id）
+        cursor: 上一页返回的游标
+        skip: offset分页的偏移量（提供游标时忽略）
+        limit: 每页数量
+
+    Returns:
+        (当前页数据, 下一页游标)，没有下一页时游标为None
+    """
+    if cursor:
+        values = decode_cursor(cursor, keys)
+        query = query.filter(tuple_(*keys) < tuple_(*values))
+
+    query = query.order_by(*[key.desc() for key in keys])
+
+    if not cursor and skip:
+        query = query.offset(skip)
+
+    # 多取一行用于判断是否还有下一页
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([getattr(last, key.key) for key in keys])
+
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    """在响应头中返回下一页游标"""
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
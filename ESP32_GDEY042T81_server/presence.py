@@ -0,0 +1,318 @@
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import Boolean, DateTime, bindparam, or_, select, update
+
+from config import settings
+from database import engine
+from models import Device as DeviceModel
+
+logger = logging.getLogger(__name__)
+
+# 在线消息的内容（不区分大小写），空消息为清除保留消息，视为离线
+ONLINE_PAYLOADS = ("1", "online", "true")
+OFFLINE_PAYLOADS = ("", "0", "offline", "false")
+
+
+def parse_presence(payload: bytes) -> Optional[bool]:
+    """
+    解析在线消息
+
+    设备连接时向 esp32/{device_id}/online 发布保留消息 "online"，并把遗嘱消息设置为保留的 "offline"，
+    也接受 {"online": true} 格式。
+
+    Returns:
+        是否在线，消息无效时返回None
+    """
+    try:
+        text = payload.decode("utf-8").strip().lower()
+    except UnicodeDecodeError:
+        return None
+    if text in ONLINE_PAYLOADS:
+        return True
+    if text in OFFLINE_PAYLOADS:
+        return False
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(data, dict) and isinstance(data.get("online"), bool):
+        return data["online"]
+    return None
+
+
+class PresenceState:
+    """设备的在线状态"""
+
+    __slots__ = ("online", "last_seen", "changed_at", "via_lwt")
+
+    def __init__(self, online: bool, last_seen: Optional[datetime], changed_at: Optional[datetime], via_lwt: bool):
+        self.online = online
+        self.last_seen = last_seen
+        self.changed_at = changed_at
+        self.via_lwt = via_lwt
+
+
+class PresenceTracker:
+    """
+    设备在线状态表
+
+    启动时从devices表加载一次，之后由状态处理管道的在线消息（保留消息和遗嘱消息）
+    和设备心跳（状态上报、确认消息和HTTP轮询）在内存中更新，在线状态查询不访问数据库。
+    只有在线/离线发生变化时才记录，由后台线程批量写入devices.online和devices.online_changed_at。
+    没有发布过在线消息的设备（旧固件）超过device_online_timeout没有消息时视为离线。
+    """
+
+    def __init__(self, flush_interval: float, online_timeout: int):
+        self.flush_interval = flush_interval
+        self.online_timeout = online_timeout
+        self._states: Dict[str, PresenceState] = {}
+        self._transitions: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.transitions_total = 0
+        self.flushed_total = 0
+
+    def load(self):
+        """从数据库加载所有设备的在线状态"""
+        table = DeviceModel.__table__
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(table.c.device_id, table.c.online, table.c.online_changed_at, table.c.last_online)
+            ).all()
+        with self._lock:
+            for device_id, online, changed_at, last_online in rows:
+                # 重启后保留消息会重新投递，在此之前沿用数据库中的状态
+                self._states.setdefault(
+                    device_id, PresenceState(bool(online), last_online, changed_at, False)
+                )
+        logger.info(f"已加载 {len(rows)} 个设备的在线状态")
+
+    def update(self, device_id: str, online: bool, when: Optional[datetime] = None, via_lwt: bool = False):
+        """
+        更新设备的在线状态
+
+        Args:
+            device_id: 设备ID
+            online: 是否在线
+            when: 消息接收时间
+            via_lwt: 是否来自在线消息（否则为心跳，只更新状态表中已注册的设备）
+        """
+        when = when or datetime.utcnow()
+        with self._lock:
+            state = self._states.get(device_id)
+            if state is None:
+                if not via_lwt:
+                    return
+                state = self._states[device_id] = PresenceState(False, None, None, via_lwt)
+            if online:
+                if state.last_seen is None or when > state.last_seen:
+                    state.last_seen = when
+            elif state.changed_at is not None and when < state.changed_at:
+                # 晚到的旧离线消息
+                return
+            if via_lwt:
+                state.via_lwt = True
+            if state.online != online:
+                self._transition(device_id, state, online, when)
+
+    def _transition(self, device_id: str, state: PresenceState, online: bool, when: datetime):
+        """记录状态变化（调用方持有锁）"""
+        state.online = online
+        state.changed_at = when
+        self.transitions_total += 1
+        self._transitions[device_id] = {
+            "b_device_id": device_id,
+            "b_online": online,
+            "b_online_changed_at": when
+        }
+        logger.debug(f"设备 {device_id} {'上线' if online else '离线'}")
+
+    def handle_presence(self, device_id: str, payload: bytes, received_at: datetime) -> bool:
+        """
+        处理在线消息（状态处理管道的工作线程中调用，设备已确认存在）
+
+        Returns:
+            消息是否有效
+        """
+        online = parse_presence(payload)
+        if online is None:
+            return False
+        self.update(device_id, online, received_at, via_lwt=True)
+        return True
+
+    def add(self, device_id: str):
+        """新注册的设备（离线）"""
+        with self._lock:
+            self._states.setdefault(device_id, PresenceState(False, None, None, False))
+
+    def remove(self, device_id: str):
+        """删除的设备"""
+        with self._lock:
+            self._states.pop(device_id, None)
+            self._transitions.pop(device_id, None)
+
+    def is_online(self, device_id: str) -> Optional[bool]:
+        """
+        获取设备是否在线
+
+        Returns:
+            是否在线，设备不在状态表中时返回None
+        """
+        with self._lock:
+            state = self._states.get(device_id)
+            return state.online if state is not None else None
+
+    def snapshot(self, online: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        在线状态汇总
+
+        Args:
+            online: 只返回在线（True）或离线（False）的设备，为空时返回全部
+
+        Returns:
+            在线、离线设备数和各设备的状态
+        """
+        with self._lock:
+            online_count = sum(1 for state in self._states.values() if state.online)
+            total = len(self._states)
+            devices = [
+                {
+                    "device_id": device_id,
+                    "online": state.online,
+                    "last_seen": state.last_seen,
+                    "changed_at": state.changed_at
+                }
+                for device_id, state in self._states.items()
+                if online is None or state.online == online
+            ]
+        devices.sort(key=lambda item: item["device_id"])
+        return {
+            "online": online_count,
+            "offline": total - online_count,
+            "total": total,
+            "devices": devices
+        }
+
+    def expire(self) -> int:
+        """
+        没有发布过在线消息的设备超时未活动时标记为离线
+
+        Returns:
+            标记为离线的设备数
+        """
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.online_timeout)
+        expired = 0
+        with self._lock:
+            for device_id, state in self._states.items():
+                if state.online and not state.via_lwt and (state.last_seen is None or state.last_seen < cutoff):
+                    self._transition(device_id, state, False, now)
+                    expired += 1
+        return expired
+
+    def flush(self) -> int:
+        """
+        将状态变化批量写入数据库
+
+        Returns:
+            写入的设备数量
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._transitions = self._transitions, {}
+            if not batch:
+                return 0
+
+            rows: List[dict] = list(batch.values())
+            table = DeviceModel.__table__
+            try:
+                with engine.begin() as conn:
+                    conn.execute(
+                        update(table)
+                        .where(table.c.device_id == bindparam("b_device_id"))
+                        .where(or_(
+                            table.c.online_changed_at.is_(None),
+                            table.c.online_changed_at <= bindparam("b_online_changed_at")
+                        ))
+                        .values(
+                            online=bindparam("b_online", type_=Boolean),
+                            online_changed_at=bindparam("b_online_changed_at", type_=DateTime),
+                            updated_at=table.c.updated_at
+                        ),
+                        rows
+                    )
+            except Exception as e:
+                logger.error(f"写入设备在线状态失败: {str(e)}")
+                # 放回缓冲（期间发生的更新的变化优先），下次刷新时重试
+                with self._lock:
+                    for row in rows:
+                        if row["b_device_id"] in self._states:
+                            self._transitions.setdefault(row["b_device_id"], row)
+                return 0
+
+            self.flushed_total += len(rows)
+            return len(rows)
+
+    def stats(self) -> Dict[str, int]:
+        """在线状态统计信息"""
+        with self._lock:
+            online_count = sum(1 for state in self._states.values() if state.online)
+            return {
+                "online": online_count,
+                "offline": len(self._states) - online_count,
+                "pending_transitions": len(self._transitions),
+                "transitions": self.transitions_total,
+                "flushed": self.flushed_total
+            }
+
+    def render_prometheus(self) -> str:
+        """以Prometheus文本格式导出在线状态指标"""
+        stats = self.stats()
+        lines = [
+            "# HELP luna_devices_presence 设备数（按在线状态）",
+            "# TYPE luna_devices_presence gauge",
+            f'luna_devices_presence{{state="online"}} {stats["online"]}',
+            f'luna_devices_presence{{state="offline"}} {stats["offline"]}',
+            "# HELP luna_presence_transitions_total 设备在线状态变化次数",
+            "# TYPE luna_presence_transitions_total counter",
+            f"luna_presence_transitions_total {stats['transitions']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """加载在线状态并启动后台刷新线程"""
+        if self._thread is not None:
+            return
+        try:
+            self.load()
+        except Exception as e:
+            logger.error(f"加载设备在线状态失败: {str(e)}")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="presence-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程并写入剩余的状态变化"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.expire()
+            self.flush()
+
+
+# 全局设备在线状态实例
+presence_tracker = PresenceTracker(
+    flush_interval=settings.presence_flush_interval,
+    online_timeout=settings.device_online_timeout
+)
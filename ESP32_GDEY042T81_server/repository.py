@@ -0,0 +1,123 @@
+from typing import Optional
+
+from sqlalchemy import and_, func, lambda_stmt, select
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from models import Device as DeviceModel, Content as ContentModel, Todo as TodoModel
+
+# 高频查询集中在这里，使用lambda_stmt缓存语句结构：
+# 语句只在第一次调用时构建和分析，之后每次调用只提取闭包中的参数值作为绑定参数，
+# 跳过Query对象的构建和缓存键的生成。只需要列值的查询直接返回Row，不经过identity map。
+
+
+def get_device(db: Session, device_id: str) -> Optional[DeviceModel]:
+    """
+    按device_id获取设备
+
+    Returns:
+        设备对象，不存在时返回None
+    """
+    stmt = lambda_stmt(lambda: select(DeviceModel).where(DeviceModel.device_id == device_id).limit(1))
+    return db.execute(stmt).scalars().first()
+
+
+def get_device_with_latest_content(db: Session, device_id: str) -> Optional[Row]:
+    """
+    一次查询获取设备和它最新的活跃内容
+
+    Returns:
+        (设备, 最新活跃内容) 行，设备不存在时返回None，没有活跃内容时内容为None
+    """
+    stmt = lambda_stmt(lambda: select(DeviceModel, ContentModel).outerjoin(
+        ContentModel,
+        and_(
+            ContentModel.device_id == DeviceModel.device_id,
+            ContentModel.is_active == True
+        )
+    ).where(
+        DeviceModel.device_id == device_id
+    ).order_by(ContentModel.version.desc()).limit(1))
+    return db.execute(stmt).first()
+
+
+def get_device_with_content(db: Session, device_id: str, version: int) -> Optional[Row]:
+    """
+    一次查询获取设备和指定版本的内容
+
+    Returns:
+        (设备, 指定版本内容) 行，设备不存在时返回None，版本不存在时内容为None
+    """
+    stmt = lambda_stmt(lambda: select(DeviceModel, ContentModel).outerjoin(
+        ContentModel,
+        and_(
+            ContentModel.device_id == DeviceModel.device_id,
+            ContentModel.version == version
+        )
+    ).where(
+        DeviceModel.device_id == device_id
+    ).limit(1))
+    return db.execute(stmt).first()
+
+
+def get_content_by_version(db: Session, device_id: str, version: int) -> Optional[ContentModel]:
+    """
+    获取设备指定版本的内容
+
+    Returns:
+        内容对象，不存在时返回None
+    """
+    stmt = lambda_stmt(lambda: select(ContentModel).where(
+        ContentModel.device_id == device_id,
+        ContentModel.version == version
+    ).limit(1))
+    return db.execute(stmt).scalars().first()
+
+
+def get_todo(db: Session, todo_id: int) -> Optional[TodoModel]:
+    """
+    按ID获取待办事项
+
+    Returns:
+        待办事项对象，不存在时返回None
+    """
+    stmt = lambda_stmt(lambda: select(TodoModel).where(TodoModel.id == todo_id).limit(1))
+    return db.execute(stmt).scalars().first()
+
+
+def get_max_version(db: Session, device_id: str) -> int:
+    """
+    获取设备当前最大的内容版本号（包括未激活的版本）
+
+    Returns:
+        最大版本号，没有内容时返回0
+    """
+    stmt = lambda_stmt(lambda: select(func.max(ContentModel.version)).where(ContentModel.device_id == device_id))
+    return db.execute(stmt).scalar() or 0
+
+
+def get_device_summary(db: Session, device_id: str) -> Optional[Row]:
+    """
+    获取设备注册表需要的摘要列（不加载设备对象）
+
+    Returns:
+        (is_active, scene, name, push_frames, current_version, current_image) 行，
+        设备不存在时返回None，没有活跃内容时版本和图片为None
+    """
+    stmt = lambda_stmt(lambda: select(
+        DeviceModel.is_active,
+        DeviceModel.scene,
+        DeviceModel.name,
+        DeviceModel.push_frames,
+        ContentModel.version,
+        ContentModel.image_path
+    ).outerjoin(
+        ContentModel,
+        and_(
+            ContentModel.device_id == DeviceModel.device_id,
+            ContentModel.is_active == True
+        )
+    ).where(
+        DeviceModel.device_id == device_id
+    ).order_by(ContentModel.version.desc()).limit(1))
+    return db.execute(stmt).first()
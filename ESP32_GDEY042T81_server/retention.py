@@ -0,0 +1,255 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from config import settings
+from database import SessionLocal
+from models import Device as DeviceModel, Content as ContentModel, ContentArchive as ContentArchiveModel, RetentionPolicy as RetentionPolicyModel
+from framebuffer_cache import framebuffer_cache
+from stats import dashboard_stats
+
+logger = logging.getLogger(__name__)
+
+# 归档时从contents复制到contents_archive的列
+ARCHIVE_COLUMNS = [
+    "device_id", "version", "title", "description", "image_path", "layout_config",
+    "timezone", "time_format", "is_active", "created_at"
+]
+
+
+def resolve_image_file(image_path: str) -> str:
+    """将内容中保存的图片路径转换为文件路径（与二进制接口的规则一致）"""
+    if image_path.startswith("static/"):
+        return image_path
+    if image_path.startswith("/"):
+        return image_path[1:]
+    return os.path.join(settings.static_dir, image_path)
+
+
+class RetentionJob:
+    """
+    内容版本保留任务
+
+    按设备策略 > 场景策略 > 全局默认的顺序确定保留策略，将超出保留范围的旧版本
+    分批移动到contents_archive表，并删除对应的图片文件和帧缓冲缓存。
+    每批之间暂停，避免长时间占用数据库；设备当前的最新活跃版本始终保留。
+    """
+
+    def __init__(self, interval: int, batch_size: int, batch_pause: float):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.last_run: Optional[Dict[str, object]] = None
+        self._stop = threading.Event()
+        self._run_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动后台线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="content-retention", daemon=True)
+        self._thread.start()
+        logger.info(f"内容保留任务已启动，执行间隔 {self.interval} 秒")
+
+    def stop(self):
+        """停止后台线程，正在执行的批次完成后退出"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"内容保留任务执行失败: {str(e)}")
+
+    def run_once(self) -> Dict[str, object]:
+        """
+        执行一轮保留任务（同一时间只允许一轮在执行）
+
+        Returns:
+            执行结果统计
+        """
+        if not self._run_lock.acquire(blocking=False):
+            return {"skipped": True, "reason": "任务正在执行"}
+
+        started = time.monotonic()
+        archived = 0
+        devices = 0
+        db = SessionLocal()
+        try:
+            device_policies, scene_policies = self.load_policies(db)
+
+            last_id = 0
+            while not self._stop.is_set():
+                rows = db.query(DeviceModel.id, DeviceModel.device_id, DeviceModel.scene).filter(
+                    DeviceModel.id > last_id
+                ).order_by(DeviceModel.id).limit(500).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+
+                for row in rows:
+                    policy = self.resolve_policy(row.device_id, row.scene, device_policies, scene_policies)
+                    if policy is None:
+                        continue
+                    count = self.archive_device(db, row.device_id, *policy)
+                    # 结束当前事务，及时归还连接（SQLite模式下写连接只有一个）
+                    db.commit()
+                    if count:
+                        devices += 1
+                        archived += count
+        finally:
+            db.close()
+            self._run_lock.release()
+
+        if archived:
+            dashboard_stats.invalidate()
+            logger.info(f"内容保留任务已归档 {devices} 个设备的 {archived} 个内容版本")
+
+        self.last_run = {
+            "archived": archived,
+            "devices": devices,
+            "duration": round(time.monotonic() - started, 3),
+            "finished_at": datetime.utcnow().isoformat()
+        }
+        return self.last_run
+
+    def load_policies(self, db: Session) -> Tuple[Dict[str, tuple], Dict[str, tuple]]:
+        """
+        加载所有保留策略
+
+        Returns:
+            (设备ID -> 策略, 场景 -> 策略)，策略为 (keep_last, keep_days)
+        """
+        device_policies = {}
+        scene_policies = {}
+        for policy in db.query(RetentionPolicyModel).all():
+            value = (policy.keep_last, policy.keep_days)
+            if policy.device_id:
+                device_policies[policy.device_id] = value
+            elif policy.scene:
+                scene_policies[policy.scene] = value
+        return device_policies, scene_policies
+
+    def resolve_policy(
+        self,
+        device_id: str,
+        scene: Optional[str],
+        device_policies: Dict[str, tuple],
+        scene_policies: Dict[str, tuple]
+    ) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        """
+        确定设备适用的保留策略
+
+        Returns:
+            (keep_last, keep_days)，没有任何保留限制时返回None
+        """
+        policy = device_policies.get(device_id)
+        if policy is None and scene:
+            policy = scene_policies.get(scene)
+        if policy is None:
+            policy = (settings.content_retention_keep_last, settings.content_retention_keep_days)
+
+        if policy[0] is None and policy[1] is None:
+            return None
+        return policy
+
+    def archive_device(self, db: Session, device_id: str, keep_last: Optional[int], keep_days: Optional[int]) -> int:
+        """
+        归档设备超出保留范围的内容版本
+
+        同时设置keep_last和keep_days时，只有同时超出两者的版本才会被归档
+
+        Returns:
+            归档的版本数量
+        """
+        query = db.query(ContentModel.id, ContentModel.version, ContentModel.image_path).filter(
+            ContentModel.device_id == device_id
+        )
+
+        if keep_last is not None:
+            # 第N新的版本号，比它旧的版本超出保留数量
+            threshold = db.query(ContentModel.version).filter(
+                ContentModel.device_id == device_id
+            ).order_by(ContentModel.version.desc()).offset(keep_last - 1).limit(1).scalar()
+            if threshold is None:
+                return 0
+            query = query.filter(ContentModel.version < threshold)
+
+        if keep_days is not None:
+            query = query.filter(ContentModel.created_at < datetime.utcnow() - timedelta(days=keep_days))
+
+        # 当前显示的最新活跃版本始终保留
+        latest_active = db.query(ContentModel.version).filter(
+            ContentModel.device_id == device_id,
+            ContentModel.is_active == True
+        ).order_by(ContentModel.version.desc()).limit(1).scalar()
+        if latest_active is not None:
+            query = query.filter(ContentModel.version != latest_active)
+
+        archived = 0
+        while not self._stop.is_set():
+            rows = query.order_by(ContentModel.version).limit(self.batch_size).all()
+            if not rows:
+                break
+
+            self.archive_rows(db, device_id, rows)
+            archived += len(rows)
+
+            if len(rows) < self.batch_size:
+                break
+            # 批次之间暂停，给在线请求让出数据库
+            self._stop.wait(self.batch_pause)
+
+        return archived
+
+    def archive_rows(self, db: Session, device_id: str, rows: List[tuple]):
+        """在一个事务内将一批内容移动到归档表，提交后删除文件"""
+        ids = [row.id for row in rows]
+
+        source = select(
+            ContentModel.id,
+            *[getattr(ContentModel, column) for column in ARCHIVE_COLUMNS]
+        ).where(ContentModel.id.in_(ids))
+        db.execute(insert(ContentArchiveModel).from_select(["content_id"] + ARCHIVE_COLUMNS, source))
+        db.execute(delete(ContentModel).where(ContentModel.id.in_(ids)))
+        db.commit()
+
+        for row in rows:
+            framebuffer_cache.remove_version(device_id, row.version)
+
+        # 只删除不再被任何内容引用的图片文件
+        image_paths = {row.image_path for row in rows if row.image_path}
+        if image_paths:
+            still_used = {
+                path for (path,) in db.query(ContentModel.image_path).filter(
+                    ContentModel.image_path.in_(image_paths)
+                ).distinct()
+            }
+            db.commit()
+            for image_path in image_paths - still_used:
+                try:
+                    os.unlink(resolve_image_file(image_path))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"删除图片文件失败 {image_path}: {str(e)}")
+
+
+# 全局内容保留任务实例
+retention_job = RetentionJob(
+    interval=settings.content_retention_interval,
+    batch_size=settings.content_retention_batch_size,
+    batch_pause=settings.content_retention_batch_pause
+)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 
 # 设备相关模型
@@ -15,11 +15,18 @@ class DeviceUpdate(BaseModel):
     name: Optional[str] = None
     scene: Optional[str] = None
     is_active: Optional[bool] = None
+    push_frames: Optional[bool] = None
 
 class Device(DeviceBase):
     id: int
     last_online: datetime
     is_active: bool
+    push_frames: Optional[bool] = False
+    applied_version: Optional[int] = None
+    last_event: Optional[str] = None
+    last_error: Optional[str] = None
+    last_error_at: Optional[datetime] = None
+    status_updated_at: Optional[datetime] = None
     created_at: datetime
     updated_at: datetime
     
@@ -58,12 +65,37 @@ class Content(ContentBase):
         from_attributes = True
 
 # 响应模型
+class BootstrapContent(BaseModel):
+    version: int
+    title: Optional[str] = None
+    image_url: Optional[str] = None
+    layout_config: Optional[Dict[str, Any]] = None
+    created_at: datetime
+    etag: str = Field(..., description="最新内容二进制数据的ETag")
+
+class BootstrapTodo(BaseModel):
+    id: int
+    title: str
+    due_date: Optional[datetime] = None
+
+class BootstrapSong(BaseModel):
+    song_id: int
+    name: str
+
 class BootstrapResponse(BaseModel):
     device_id: str
+    name: Optional[str] = None
+    scene: Optional[str] = None
+    is_active: bool = True
+    profile: Dict[str, Any] = Field(default_factory=dict, description="显示配置")
     content_version: Optional[int] = None
     timezone: str
     time_format: str
     last_updated: Optional[datetime] = None
+    server_time: datetime
+    content: Optional[BootstrapContent] = None
+    todos: List[BootstrapTodo] = []
+    songs: List[BootstrapSong] = []
 
 class ContentResponse(BaseModel):
     version: int
@@ -75,6 +107,15 @@ class ContentResponse(BaseModel):
     time_format: str
     created_at: datetime
 
+# 批量写入结果
+class BulkItemResult(BaseModel):
+    index: int = Field(..., description="请求中的序号")
+    success: bool = Field(..., description="是否写入成功")
+    id: Optional[int] = None
+    device_id: Optional[str] = None
+    version: Optional[int] = None
+    error: Optional[str] = None
+
 # MQTT消息模型
 class MQTTCommand(BaseModel):
     type: str = Field(..., description="命令类型")
@@ -88,6 +129,37 @@ class MQTTStatus(BaseModel):
     device_id: str = Field(..., description="设备ID")
     message: Optional[str] = None
 
+class CommandPush(BaseModel):
+    type: str = Field("update", description="命令类型")
+    content_version: Optional[int] = Field(None, description="为空且命令类型为update时每个设备发送各自的最新版本")
+    scene: Optional[str] = Field(None, description="发给场景内的设备")
+    device_ids: Optional[List[str]] = Field(None, description="发给指定的设备")
+    all_devices: bool = Field(False, description="发给全部设备")
+    wait: bool = Field(False, description="直接发布并等待代理确认（不经过发送队列和帧缓冲推送）")
+
+class CommandPushResult(BaseModel):
+    mode: str  # group：一次分组发布，per_device：逐设备发布
+    topic: Optional[str] = None  # 分组发布的主题
+    target_count: int
+    publish_count: int
+    skipped: List[str] = []  # 不存在、已停用或没有内容的设备
+    resolve_ms: float  # 查询目标设备耗时
+    fanout_ms: float  # 加入发送队列耗时（wait时为发布到全部确认的耗时）
+    delivery_ms: Optional[float] = None  # wait时单条消息的最长确认耗时
+
+# 设备在线状态相关模型
+class DevicePresence(BaseModel):
+    device_id: str
+    online: bool
+    last_seen: Optional[datetime] = None  # 最近一次收到设备消息的时间
+    changed_at: Optional[datetime] = None  # 最近一次上线或离线的时间
+
+class PresenceSummary(BaseModel):
+    online: int
+    offline: int
+    total: int
+    devices: List[DevicePresence]
+
 # 待办事项相关模型
 class TodoBase(BaseModel):
     title: str = Field(..., description="待办事项标题")
@@ -132,8 +204,68 @@ class SongUpdate(BaseModel):
 class Song(SongBase):
     id: int
     device_id: str
+    library_song_id: Optional[int] = None
     created_at: datetime
     updated_at: datetime
     
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+# 曲库相关模型
+class SongLibraryCreate(BaseModel):
+    name: str = Field(..., description="歌曲名称")
+    tempo: float = Field(..., description="节拍")
+    notes: list = Field(..., description="音符数据")
+
+class SongLibrary(SongLibraryCreate):
+    id: int
+    created_at: datetime
+    updated_at: datetime
+
+class SongAssign(BaseModel):
+    device_ids: List[str] = Field(..., description="设备ID列表")
+    song_id: int = Field(..., description="在设备上的歌曲ID")
+
+# 内容保留策略相关模型
+class RetentionPolicyCreate(BaseModel):
+    device_id: Optional[str] = Field(None, description="设备ID（设备级策略）")
+    scene: Optional[str] = Field(None, description="场景（场景级策略）")
+    keep_last: Optional[int] = Field(None, ge=1, description="保留最近N个版本")
+    keep_days: Optional[int] = Field(None, ge=1, description="保留最近X天的版本")
+
+class RetentionPolicy(RetentionPolicyCreate):
+    id: int
+    created_at: datetime
+    updated_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+# 设备遥测相关模型
+class TelemetryEvent(BaseModel):
+    event: str
+    content_version: Optional[int] = None
+    version_lag: Optional[int] = None
+    message: Optional[str] = None
+    device_timestamp: Optional[int] = None
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class TelemetryBucket(BaseModel):
+    bucket_start: datetime
+    device_count: Optional[int] = None  # 仅全部设备汇总时返回
+    event_count: int
+    refresh_count: int
+    error_count: int
+    uptime_seconds: int
+    max_version_lag: Optional[int] = None
+    last_version: Optional[int] = None
+
+class TelemetrySeries(BaseModel):
+    device_id: Optional[str] = None
+    period: str
+    start: datetime
+    end: datetime
+    buckets: List[TelemetryBucket]
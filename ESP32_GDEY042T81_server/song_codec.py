@@ -0,0 +1,195 @@
+import json
+import struct
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+# 音符名称表，索引即打包后的音符编号（0为休止符）
+NOTE_NAMES = ["REST"] + [
+    f"{name}{octave}"
+    for octave in range(9)
+    for name in ["C", "CS", "D", "DS", "E", "F", "FS", "G", "GS", "A", "AS", "B"]
+]
+NOTE_INDEX = {name: index for index, name in enumerate(NOTE_NAMES)}
+
+# 每个音符打包为 (音符编号 uint8, 时长毫秒 uint16)
+NOTE_STRUCT = struct.Struct("<BH")
+MAX_DURATION_MS = 0xFFFF
+
+
+def normalize_note_name(name: str) -> str:
+    """统一音符名称写法，例如 c#4 -> CS4（编译设备格式时使用，存储时不改写客户端的写法）"""
+    return name.strip().upper().replace("#", "S")
+
+
+def pack_notes(notes: list) -> bytes:
+    """
+    将音符列表打包为紧凑的二进制格式
+
+    只打包解包后与原数据完全相同的音符：名称必须是标准写法（如 CS4，c#4 不打包），时长必须是整数，
+    否则由调用方保留JSON文本，保证读取时返回客户端写入的原样数据。
+
+    Args:
+        notes: 音符列表，每项为 (音符名称, 时长毫秒)
+
+    Returns:
+        打包后的二进制数据
+
+    Raises:
+        ValueError: 不是音符列表、音符名称不是标准写法或时长不是范围内的整数
+    """
+    if not isinstance(notes, list):
+        raise ValueError(f"无效的音符列表: {notes!r}")
+
+    buffer = bytearray()
+    for note in notes:
+        if not isinstance(note, (list, tuple)) or len(note) != 2:
+            raise ValueError(f"无效的音符: {note}")
+
+        name, duration = note
+        if not isinstance(name, str):
+            raise ValueError(f"无效的音符名称: {name}")
+
+        index = NOTE_INDEX.get(name)
+        if index is None:
+            raise ValueError(f"未知的音符名称: {name}")
+
+        if isinstance(duration, bool) or not isinstance(duration, int):
+            raise ValueError(f"无效的音符时长: {duration}")
+        if not 0 <= duration <= MAX_DURATION_MS:
+            raise ValueError(f"音符时长超出范围: {duration}")
+
+        buffer += NOTE_STRUCT.pack(index, int(duration))
+    return bytes(buffer)
+
+
+def unpack_notes(data: bytes) -> List[list]:
+    """
+    解包二进制音符数据
+
+    Returns:
+        音符列表，每项为 [音符名称, 时长毫秒]
+    """
+    return [[NOTE_NAMES[index], duration] for index, duration in NOTE_STRUCT.iter_unpack(data)]
+
+
+def encode_song_notes(notes: list) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    选择音符的存储形式：能打包时使用二进制，否则回退为JSON文本
+
+    Returns:
+        (notes_packed, notes) 两者只有一个非空
+    """
+    try:
+        return pack_notes(notes), None
+    except ValueError:
+        return None, json.dumps(notes)
+
+
+class SongCache:
+    """
+    歌曲派生数据缓存，键为 (来源, ID, 更新时间)，歌曲更新后旧条目自然失效
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: tuple):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+# 全局歌曲解析缓存实例
+song_notes_cache = SongCache()
+
+
+def song_source(song) -> Tuple[object, tuple]:
+    """
+    获取保存音符数据的对象及其缓存键
+
+    引用曲库的歌曲使用曲库歌曲的数据，因此同一首曲库歌曲在所有设备间共享缓存
+
+    Returns:
+        (数据来源对象, 缓存键)
+    """
+    if not hasattr(song, "library_song"):
+        # 曲库歌曲本身
+        return song, ("library", song.id, song.updated_at)
+    if song.library_song is not None:
+        return song.library_song, ("library", song.library_song.id, song.library_song.updated_at)
+    return song, ("song", song.id, song.updated_at)
+
+
+def parse_song(song) -> Tuple[float, List[list]]:
+    """
+    获取歌曲解析后的节拍和音符，命中缓存时不再解析
+
+    Args:
+        song: 歌曲或曲库歌曲模型对象
+
+    Returns:
+        (节拍, 音符列表)
+    """
+    source, key = song_source(song)
+    cached = song_notes_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if source.notes_packed is not None:
+        notes = unpack_notes(source.notes_packed)
+    else:
+        try:
+            notes = json.loads(source.notes) if source.notes else []
+        except json.JSONDecodeError:
+            notes = []
+
+    parsed = (float(source.tempo), notes)
+    song_notes_cache.put(key, parsed)
+    return parsed
+
+
+def set_song_notes(song, notes: list):
+    """写入歌曲音符，自动选择存储形式"""
+    song.notes_packed, song.notes = encode_song_notes(notes)
+
+
+def detach_library_song(song):
+    """
+    将引用曲库的歌曲转为设备独立副本，修改设备歌曲前调用，避免影响其他设备
+    """
+    library_song = song.library_song
+    if library_song is None:
+        return
+    song.tempo = library_song.tempo
+    song.notes = library_song.notes
+    song.notes_packed = library_song.notes_packed
+    song.library_song = None
+    song.library_song_id = None
+
+
+def song_to_dict(song) -> dict:
+    """将歌曲模型转换为API响应格式"""
+    tempo, notes = parse_song(song)
+    return {
+        "id": song.id,
+        "device_id": song.device_id,
+        "song_id": song.song_id,
+        "name": song.name,
+        "tempo": tempo,
+        "notes": notes,
+        "library_song_id": song.library_song_id,
+        "created_at": song.created_at,
+        "updated_at": song.updated_at
+    }
@@ -0,0 +1,94 @@
+import hashlib
+import struct
+from typing import List, Tuple
+
+from song_codec import SongCache, NOTE_INDEX, normalize_note_name, parse_song, song_source
+
+# 播放缓冲区格式：
+#   头部 (8字节): 魔数 b"LS", 格式版本 uint8, 保留 uint8, 音符数量 uint16, 节拍x100 uint16
+#   正文: 每个音符 (频率Hz uint16, 时长毫秒 uint16)，小端序，频率0表示休止
+HEADER_STRUCT = struct.Struct("<2sBBHH")
+STEP_STRUCT = struct.Struct("<HH")
+MAGIC = b"LS"
+FORMAT_VERSION = 1
+MAX_UINT16 = 0xFFFF
+
+
+def note_frequency(name: str) -> int:
+    """
+    计算音符频率（十二平均律，A4 = 440Hz）
+
+    Returns:
+        频率Hz，休止符或未知音符返回0
+    """
+    index = NOTE_INDEX.get(normalize_note_name(name), 0)
+    if index == 0:
+        return 0
+    # 音符编号1对应C0，即MIDI音高12
+    midi = index + 11
+    return int(round(440.0 * 2 ** ((midi - 69) / 12.0)))
+
+
+def compile_notes(notes: List[list], tempo: float) -> bytes:
+    """
+    将音符列表和节拍编译为蜂鸣器可直接播放的二进制时间表
+
+    Args:
+        notes: 音符列表，每项为 [音符名称, 时长毫秒]
+        tempo: 节拍系数，播放时长 = 时长 x 节拍
+
+    Returns:
+        播放缓冲区二进制数据
+    """
+    body = bytearray()
+    count = 0
+    for note in notes:
+        # JSON格式回退存储的数据可能不规范，跳过无法识别的音符
+        if not isinstance(note, (list, tuple)) or len(note) != 2:
+            continue
+        name, duration = note
+        try:
+            scaled = int(round(float(duration) * tempo))
+        except (TypeError, ValueError):
+            continue
+
+        frequency = note_frequency(name) if isinstance(name, str) else 0
+        body += STEP_STRUCT.pack(min(frequency, MAX_UINT16), max(0, min(scaled, MAX_UINT16)))
+        count += 1
+
+    header = HEADER_STRUCT.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        0,
+        min(count, MAX_UINT16),
+        max(0, min(int(round(tempo * 100)), MAX_UINT16))
+    )
+    return header + bytes(body)
+
+
+# 编译结果缓存，按歌曲版本记忆（曲库歌曲在所有设备间共享）
+compiled_song_cache = SongCache(max_size=512)
+
+
+def compile_song(song) -> Tuple[bytes, str]:
+    """
+    获取歌曲的播放缓冲区和ETag，同一歌曲版本只编译一次，
+    引用同一首曲库歌曲的设备复用同一份编译结果
+
+    Args:
+        song: 歌曲模型对象
+
+    Returns:
+        (播放缓冲区, ETag)
+    """
+    _, key = song_source(song)
+    cached = compiled_song_cache.get(key)
+    if cached is not None:
+        return cached
+
+    tempo, notes = parse_song(song)
+    payload = compile_notes(notes, tempo)
+    etag = f'"{hashlib.md5(payload).hexdigest()}"'
+
+    compiled_song_cache.put(key, (payload, etag))
+    return payload, etag
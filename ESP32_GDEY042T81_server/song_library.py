@@ -0,0 +1,113 @@
+from typing import Dict, List
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from models import Song as SongModel, SongLibrary as SongLibraryModel
+from song_codec import set_song_notes
+
+# 预定义歌曲数据（键为分配到设备上的歌曲ID）
+DEFAULT_LIBRARY_SONGS = {
+    1: {
+        "name": "Super Mario Theme",
+        "tempo": 1.2,
+        "notes": [['E5', 100], ['E5', 100], ['REST', 100], ['E5', 100],
+                 ['REST', 100], ['C5', 100], ['E5', 100], ['REST', 100],
+                 ['G5', 100], ['REST', 300], ['G4', 100], ['REST', 300],
+                 ['C5', 150], ['REST', 50], ['G4', 150], ['REST', 150],
+                 ['E4', 150], ['REST', 100], ['A4', 100], ['B4', 100],
+                 ['AS4', 50], ['A4', 100], ['G4', 100], ['E5', 100], ['G5', 100],
+                 ['A5', 100], ['F5', 100], ['G5', 100], ['REST', 50],
+                 ['E5', 100], ['C5', 100], ['D5', 100], ['B4', 100]]
+    },
+    2: {
+        "name": "Star Wars - Imperial March",
+        "tempo": 1.0,
+        "notes": [['A3', 500], ['A3', 500], ['A3', 500], ['F3', 350], ['C4', 150],
+                 ['A3', 500], ['F3', 350], ['C4', 150], ['A3', 1000],
+                 ['E4', 500], ['E4', 500], ['E4', 500], ['F4', 350], ['C4', 150],
+                 ['GS3', 500], ['F3', 350], ['C4', 150], ['A3', 1000]]
+    }
+}
+
+
+def create_library_song(db: Session, name: str, tempo: float, notes: list) -> SongLibraryModel:
+    """
+    创建曲库歌曲（不提交事务）
+    """
+    library_song = SongLibraryModel(name=name, tempo=str(tempo))
+    set_song_notes(library_song, notes)
+    db.add(library_song)
+    db.flush()
+    return library_song
+
+
+def ensure_default_library(db: Session) -> Dict[int, SongLibraryModel]:
+    """
+    确保预定义歌曲已存在于曲库中（不提交事务）
+
+    Returns:
+        设备歌曲ID -> 曲库歌曲
+    """
+    names = [song_data["name"] for song_data in DEFAULT_LIBRARY_SONGS.values()]
+    existing = {
+        library_song.name: library_song
+        for library_song in db.query(SongLibraryModel).filter(SongLibraryModel.name.in_(names)).all()
+    }
+
+    library = {}
+    for song_id, song_data in DEFAULT_LIBRARY_SONGS.items():
+        library_song = existing.get(song_data["name"])
+        if library_song is None:
+            library_song = create_library_song(db, song_data["name"], song_data["tempo"], song_data["notes"])
+        library[song_id] = library_song
+    return library
+
+
+def assign_library_songs(
+    db: Session,
+    device_ids: List[str],
+    assignments: Dict[int, SongLibraryModel]
+) -> List[SongModel]:
+    """
+    将曲库歌曲分配给多个设备（不提交事务）
+
+    一次查询找出已被占用的歌曲ID，一次批量插入分配记录，
+    分配记录只引用曲库歌曲，不复制音符数据
+
+    Args:
+        db: 数据库会话
+        device_ids: 设备ID列表（调用方保证设备存在）
+        assignments: 设备歌曲ID -> 曲库歌曲
+
+    Returns:
+        新创建的设备歌曲列表
+    """
+    if not device_ids or not assignments:
+        return []
+
+    taken = set(db.query(SongModel.device_id, SongModel.song_id).filter(
+        SongModel.device_id.in_(device_ids),
+        SongModel.song_id.in_(list(assignments.keys()))
+    ).all())
+
+    rows = []
+    for device_id in dict.fromkeys(device_ids):
+        for song_id, library_song in assignments.items():
+            if (device_id, song_id) in taken:
+                continue
+            rows.append({
+                "device_id": device_id,
+                "song_id": song_id,
+                "name": library_song.name,
+                "tempo": library_song.tempo,
+                "library_song_id": library_song.id
+            })
+
+    if not rows:
+        return []
+
+    return db.scalars(
+        insert(SongModel).returning(SongModel, sort_by_parameter_order=True),
+        rows
+    ).all()
@@ -0,0 +1,121 @@
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import case, func, select, true
+from sqlalchemy.orm import Session
+
+from config import settings
+from models import Device as DeviceModel, Content as ContentModel, Todo as TodoModel, Song as SongModel
+
+
+def row_to_dict(obj) -> Dict[str, Any]:
+    """将模型对象转换为普通字典，缓存快照不持有会话中的对象"""
+    return {column.key: getattr(obj, column.key) for column in obj.__table__.columns}
+
+
+class DashboardStats:
+    """
+    管理后台首页统计服务
+
+    所有计数由一条聚合查询得出，结果连同最近记录缓存为快照，TTL内直接复用
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, db: Session) -> Dict[str, Any]:
+        """
+        获取统计快照，过期时重新计算
+
+        Args:
+            db: 数据库会话
+
+        Returns:
+            统计快照字典
+        """
+        with self._lock:
+            if self._snapshot is not None and self._expires_at > time.monotonic():
+                return self._snapshot
+
+            self._snapshot = self.compute(db)
+            self._expires_at = time.monotonic() + self.ttl
+            return self._snapshot
+
+    def invalidate(self):
+        """使快照失效，下次访问时重新计算"""
+        with self._lock:
+            self._snapshot = None
+
+    def compute(self, db: Session) -> Dict[str, Any]:
+        """计算统计快照"""
+        device_counts = select(
+            func.count(DeviceModel.id).label("device_count"),
+            func.coalesce(func.sum(case((DeviceModel.is_active == True, 1), else_=0)), 0).label("active_device_count")
+        ).subquery()
+        content_counts = select(
+            func.count(ContentModel.id).label("content_count")
+        ).subquery()
+        todo_counts = select(
+            func.count(TodoModel.id).label("todo_count"),
+            func.coalesce(func.sum(case((TodoModel.is_completed == True, 1), else_=0)), 0).label("completed_todo_count")
+        ).subquery()
+        song_counts = select(
+            func.count(SongModel.id).label("song_count")
+        ).subquery()
+
+        # 每个子查询都只返回一行，交叉连接后一条查询得到全部计数
+        counts = db.execute(select(
+            device_counts.c.device_count,
+            device_counts.c.active_device_count,
+            content_counts.c.content_count,
+            todo_counts.c.todo_count,
+            todo_counts.c.completed_todo_count,
+            song_counts.c.song_count
+        ).select_from(
+            device_counts
+            .join(content_counts, true())
+            .join(todo_counts, true())
+            .join(song_counts, true())
+        )).one()
+
+        # 获取最近上线的设备
+        recent_devices = db.query(DeviceModel).order_by(DeviceModel.last_online.desc()).limit(5).all()
+
+        # 获取最近创建的待办事项
+        recent_todos = db.query(TodoModel, DeviceModel).join(
+            DeviceModel, TodoModel.device_id == DeviceModel.device_id
+        ).order_by(TodoModel.created_at.desc()).limit(5).all()
+
+        # 获取最近创建的歌曲
+        recent_songs = db.query(SongModel, DeviceModel).join(
+            DeviceModel, SongModel.device_id == DeviceModel.device_id
+        ).order_by(SongModel.created_at.desc()).limit(5).all()
+
+        return {
+            "device_count": counts.device_count,
+            "active_device_count": int(counts.active_device_count),
+            "content_count": counts.content_count,
+            "todo_count": counts.todo_count,
+            "completed_todo_count": int(counts.completed_todo_count),
+            "pending_todo_count": counts.todo_count - int(counts.completed_todo_count),
+            "song_count": counts.song_count,
+            "recent_devices": [row_to_dict(device) for device in recent_devices],
+            "recent_todos": [
+                {"todo": row_to_dict(todo), "device": row_to_dict(device)}
+                for todo, device in recent_todos
+            ],
+            "recent_songs": [
+                {"song": row_to_dict(song), "device": row_to_dict(device)}
+                for song, device in recent_songs
+            ],
+            "last_update": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+
+# 全局统计服务实例
+dashboard_stats = DashboardStats(ttl=settings.dashboard_stats_ttl)
@@ -0,0 +1,471 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional
+
+from sqlalchemy import delete, func, insert, select
+
+from config import settings
+from database import engine
+from models import Content as ContentModel, TelemetryEvent as TelemetryEventModel, TelemetryRollup as TelemetryRollupModel
+from mqtt_manager import mqtt_manager
+
+logger = logging.getLogger(__name__)
+
+# 设备状态上报中的事件类型约定（status消息的event字段）
+# 表示完成了一次屏幕刷新/内容更新的事件
+REFRESH_EVENTS = {"refresh", "refreshed", "updated", "update"}
+# 表示发生错误的事件
+ERROR_EVENTS = {"error", "failed", "fail"}
+
+# 汇总周期
+PERIOD_HOUR = "hour"
+PERIOD_DAY = "day"
+
+# 清理原始事件时每批删除的行数
+PURGE_BATCH_SIZE = 5000
+
+
+def floor_hour(when: datetime) -> datetime:
+    """取整到小时"""
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(when: datetime) -> datetime:
+    """取整到天"""
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class TelemetryWriter:
+    """
+    遥测事件批量写入器
+
+    MQTT状态上报只追加到内存队列，后台线程按批（executemany）写入telemetry_events表。
+    同一批中带内容版本的事件，用一条聚合查询计算与服务端最新活跃版本的差距。
+    队列有上限，写入跟不上时丢弃最旧的事件并计数。
+    """
+
+    def __init__(self, batch_size: int, flush_interval: int, max_pending: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: Deque[dict] = deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.written_total = 0
+        self.dropped_total = 0
+
+    def record(self, device_id: str, event: str, content_version: Optional[int] = None,
+               message: Optional[str] = None, device_timestamp: Optional[int] = None,
+               when: Optional[datetime] = None):
+        """追加一条遥测事件"""
+        row = {
+            "device_id": device_id,
+            "event": (event or "unknown")[:30],
+            "content_version": content_version,
+            "version_lag": None,
+            "message": message[:500] if message else None,
+            "device_timestamp": device_timestamp,
+            "created_at": when or datetime.utcnow()
+        }
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped_total += 1
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def handle_device_status(self, device_id: str, status_data: dict):
+        """MQTT状态上报监听器"""
+        content_version = status_data.get("content_version")
+        device_timestamp = status_data.get("timestamp")
+        message = status_data.get("message")
+        self.record(
+            device_id,
+            str(status_data.get("event") or status_data.get("status") or "status"),
+            content_version=content_version if isinstance(content_version, int) else None,
+            message=str(message) if message is not None else None,
+            device_timestamp=device_timestamp if isinstance(device_timestamp, int) else None
+        )
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """
+        将队列中的事件批量写入数据库
+
+        Returns:
+            写入的事件数量
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    break
+                try:
+                    with engine.begin() as conn:
+                        self._fill_version_lag(conn, batch)
+                        conn.execute(insert(TelemetryEventModel), batch)
+                except Exception as e:
+                    logger.error(f"写入遥测事件失败: {str(e)}")
+                    # 放回队列头部，下次刷新时重试（队列满时较旧的事件会被丢弃）
+                    with self._lock:
+                        self._pending.extendleft(reversed(batch))
+                    break
+                written += len(batch)
+        self.written_total += written
+        return written
+
+    def _fill_version_lag(self, conn, batch: List[dict]):
+        """计算一批事件的版本差距（每个设备最新活跃版本 - 设备上报的版本）"""
+        device_ids = {row["device_id"] for row in batch if row["content_version"] is not None}
+        if not device_ids:
+            return
+        latest = dict(conn.execute(
+            select(ContentModel.device_id, func.max(ContentModel.version))
+            .where(ContentModel.device_id.in_(device_ids), ContentModel.is_active == True)
+            .group_by(ContentModel.device_id)
+        ).all())
+        for row in batch:
+            current = latest.get(row["device_id"])
+            if row["content_version"] is not None and current is not None:
+                row["version_lag"] = max(current - row["content_version"], 0)
+
+    def start(self):
+        """启动后台写入线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="telemetry-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台线程并写入剩余的事件"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class TelemetryRollupJob:
+    """
+    遥测汇总任务
+
+    定期将原始事件汇总为每个设备的小时数据（事件数、刷新次数、错误次数、在线时长、最大版本差距），
+    再由小时数据汇总出天数据。每次从最后一个已汇总的小时之前的小时开始重新计算（写入缓冲中晚到的上一小时事件也会被汇总），
+    结果按桶整体替换，可重复执行。
+    超过保留期的原始事件会被分批删除，汇总数据长期保留。
+    """
+
+    def __init__(self, interval: int, uptime_gap: int, raw_retention_days: int, late_seconds: int = 0):
+        self.interval = interval
+        self.uptime_gap = uptime_gap
+        self.raw_retention_days = raw_retention_days
+        # 事件写入数据库的最长延迟（写入缓冲的刷新间隔），重新汇总至少覆盖上一个小时
+        self.late_seconds = max(late_seconds, 3600)
+        self.last_run: Optional[Dict[str, object]] = None
+        self._stop = threading.Event()
+        self._run_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动后台线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="telemetry-rollup", daemon=True)
+        self._thread.start()
+        logger.info(f"遥测汇总任务已启动，执行间隔 {self.interval} 秒")
+
+    def stop(self):
+        """停止后台线程"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"遥测汇总任务执行失败: {str(e)}")
+
+    def run_once(self, now: Optional[datetime] = None) -> Dict[str, object]:
+        """
+        执行一轮汇总（同一时间只允许一轮在执行）
+
+        Returns:
+            执行结果统计
+        """
+        if not self._run_lock.acquire(blocking=False):
+            return {"skipped": True, "reason": "任务正在执行"}
+
+        started = time.monotonic()
+        now = now or datetime.utcnow()
+        hours = 0
+        try:
+            start_hour = self.resume_point()
+            if start_hour is not None:
+                current_hour = floor_hour(now)
+                hour = start_hour
+                days = set()
+                while hour <= current_hour and not self._stop.is_set():
+                    self.rollup_hour(hour)
+                    days.add(floor_day(hour))
+                    hours += 1
+                    hour += timedelta(hours=1)
+                for day in sorted(days):
+                    self.rollup_day(day)
+            purged = self.purge_raw(now)
+        finally:
+            self._run_lock.release()
+
+        self.last_run = {
+            "hours": hours,
+            "purged": purged,
+            "duration": round(time.monotonic() - started, 3),
+            "finished_at": datetime.utcnow().isoformat()
+        }
+        return self.last_run
+
+    def resume_point(self) -> Optional[datetime]:
+        """
+        确定本轮汇总的起始小时：从最后一个已汇总的小时（可能当时尚未结束）往前回溯late_seconds，
+        至少重新汇总上一个已结束的小时，没有汇总数据时从最早的原始事件开始
+
+        Returns:
+            起始小时，没有任何事件时返回None
+        """
+        with engine.connect() as conn:
+            last_bucket = conn.execute(
+                select(func.max(TelemetryRollupModel.bucket_start))
+                .where(TelemetryRollupModel.period == PERIOD_HOUR)
+            ).scalar()
+            if last_bucket is not None:
+                return floor_hour(last_bucket - timedelta(seconds=self.late_seconds))
+            first_event = conn.execute(select(func.min(TelemetryEventModel.created_at))).scalar()
+        return floor_hour(first_event) if first_event is not None else None
+
+    def rollup_hour(self, bucket_start: datetime):
+        """计算一个小时桶内每个设备的汇总数据并替换已有结果"""
+        bucket_end = bucket_start + timedelta(hours=1)
+        events = TelemetryEventModel.__table__
+        rows = {}
+        with engine.begin() as conn:
+            result = conn.execute(
+                select(events.c.device_id, events.c.event, events.c.content_version,
+                       events.c.version_lag, events.c.created_at)
+                .where(events.c.created_at >= bucket_start, events.c.created_at < bucket_end)
+                .order_by(events.c.device_id, events.c.created_at)
+                .execution_options(yield_per=2000)
+            )
+            previous = None
+            for event in result:
+                row = rows.get(event.device_id)
+                if row is None:
+                    row = rows[event.device_id] = {
+                        "device_id": event.device_id,
+                        "period": PERIOD_HOUR,
+                        "bucket_start": bucket_start,
+                        "event_count": 0,
+                        "refresh_count": 0,
+                        "error_count": 0,
+                        "uptime_seconds": 0,
+                        "max_version_lag": None,
+                        "last_version": None,
+                        "updated_at": datetime.utcnow()
+                    }
+                    previous = None
+                row["event_count"] += 1
+                if event.event in REFRESH_EVENTS:
+                    row["refresh_count"] += 1
+                elif event.event in ERROR_EVENTS:
+                    row["error_count"] += 1
+                # 相邻两次上报间隔不超过uptime_gap时视为一直在线
+                if previous is not None:
+                    gap = (event.created_at - previous).total_seconds()
+                    if gap <= self.uptime_gap:
+                        row["uptime_seconds"] += int(gap)
+                previous = event.created_at
+                if event.version_lag is not None:
+                    row["max_version_lag"] = max(row["max_version_lag"] or 0, event.version_lag)
+                if event.content_version is not None:
+                    row["last_version"] = event.content_version
+
+            self._replace_bucket(conn, PERIOD_HOUR, bucket_start, list(rows.values()))
+
+    def rollup_day(self, day: datetime):
+        """由小时汇总数据计算一天的汇总并替换已有结果"""
+        rollups = TelemetryRollupModel.__table__
+        with engine.begin() as conn:
+            hourly = rollups.alias("hourly")
+            result = conn.execute(
+                select(
+                    hourly.c.device_id,
+                    func.sum(hourly.c.event_count),
+                    func.sum(hourly.c.refresh_count),
+                    func.sum(hourly.c.error_count),
+                    func.sum(hourly.c.uptime_seconds),
+                    func.max(hourly.c.max_version_lag)
+                )
+                .where(
+                    hourly.c.period == PERIOD_HOUR,
+                    hourly.c.bucket_start >= day,
+                    hourly.c.bucket_start < day + timedelta(days=1)
+                )
+                .group_by(hourly.c.device_id)
+            ).all()
+
+            # 当天最后上报的版本取最后一个有版本的小时
+            last_versions = {}
+            for device_id, last_version in conn.execute(
+                select(hourly.c.device_id, hourly.c.last_version)
+                .where(
+                    hourly.c.period == PERIOD_HOUR,
+                    hourly.c.bucket_start >= day,
+                    hourly.c.bucket_start < day + timedelta(days=1),
+                    hourly.c.last_version.is_not(None)
+                )
+                .order_by(hourly.c.bucket_start)
+            ):
+                last_versions[device_id] = last_version
+
+            updated_at = datetime.utcnow()
+            rows = [
+                {
+                    "device_id": device_id,
+                    "period": PERIOD_DAY,
+                    "bucket_start": day,
+                    "event_count": int(event_count or 0),
+                    "refresh_count": int(refresh_count or 0),
+                    "error_count": int(error_count or 0),
+                    "uptime_seconds": int(uptime_seconds or 0),
+                    "max_version_lag": max_version_lag,
+                    "last_version": last_versions.get(device_id),
+                    "updated_at": updated_at
+                }
+                for device_id, event_count, refresh_count, error_count, uptime_seconds, max_version_lag in result
+            ]
+            self._replace_bucket(conn, PERIOD_DAY, day, rows)
+
+    def _replace_bucket(self, conn, period: str, bucket_start: datetime, rows: List[dict]):
+        """在同一事务内删除并重新写入一个时间桶的汇总数据"""
+        rollups = TelemetryRollupModel.__table__
+        conn.execute(
+            delete(rollups).where(rollups.c.period == period, rollups.c.bucket_start == bucket_start)
+        )
+        if rows:
+            conn.execute(insert(rollups), rows)
+
+    def purge_raw(self, now: datetime) -> int:
+        """
+        分批删除超过保留期的原始事件（最后一个已汇总小时之前的事件才会删除）
+
+        Returns:
+            删除的事件数量
+        """
+        events = TelemetryEventModel.__table__
+        cutoff = now - timedelta(days=self.raw_retention_days)
+        with engine.connect() as conn:
+            last_bucket = conn.execute(
+                select(func.max(TelemetryRollupModel.bucket_start))
+                .where(TelemetryRollupModel.period == PERIOD_HOUR)
+            ).scalar()
+        if last_bucket is None:
+            return 0
+        cutoff = min(cutoff, last_bucket)
+
+        purged = 0
+        while not self._stop.is_set():
+            with engine.begin() as conn:
+                ids = select(events.c.id).where(events.c.created_at < cutoff).limit(PURGE_BATCH_SIZE)
+                count = conn.execute(delete(events).where(events.c.id.in_(ids.scalar_subquery()))).rowcount
+            purged += count
+            if count < PURGE_BATCH_SIZE:
+                break
+        return purged
+
+
+def query_rollups(conn_or_session, device_id: Optional[str], period: str,
+                  start: datetime, end: datetime) -> List[dict]:
+    """
+    读取汇总数据
+
+    Args:
+        conn_or_session: 数据库连接或会话
+        device_id: 设备ID，为None时按时间桶汇总全部设备
+        period: hour 或 day
+        start: 开始时间（包含）
+        end: 结束时间（不包含）
+
+    Returns:
+        按时间排序的汇总数据
+    """
+    rollups = TelemetryRollupModel.__table__
+    conditions = [rollups.c.period == period, rollups.c.bucket_start >= start, rollups.c.bucket_start < end]
+
+    if device_id is not None:
+        result = conn_or_session.execute(
+            select(
+                rollups.c.bucket_start, rollups.c.event_count, rollups.c.refresh_count,
+                rollups.c.error_count, rollups.c.uptime_seconds, rollups.c.max_version_lag,
+                rollups.c.last_version
+            )
+            .where(rollups.c.device_id == device_id, *conditions)
+            .order_by(rollups.c.bucket_start)
+        )
+        return [dict(row._mapping) for row in result]
+
+    result = conn_or_session.execute(
+        select(
+            rollups.c.bucket_start,
+            func.count(rollups.c.device_id).label("device_count"),
+            func.sum(rollups.c.event_count).label("event_count"),
+            func.sum(rollups.c.refresh_count).label("refresh_count"),
+            func.sum(rollups.c.error_count).label("error_count"),
+            func.sum(rollups.c.uptime_seconds).label("uptime_seconds"),
+            func.max(rollups.c.max_version_lag).label("max_version_lag")
+        )
+        .where(*conditions)
+        .group_by(rollups.c.bucket_start)
+        .order_by(rollups.c.bucket_start)
+    )
+    return [
+        {key: int(value) if key != "bucket_start" and value is not None else value
+         for key, value in row._mapping.items()}
+        for row in result
+    ]
+
+
+# 全局遥测写入器和汇总任务实例
+telemetry_writer = TelemetryWriter(
+    batch_size=settings.telemetry_batch_size,
+    flush_interval=settings.telemetry_flush_interval,
+    max_pending=settings.telemetry_max_pending
+)
+telemetry_rollup_job = TelemetryRollupJob(
+    interval=settings.telemetry_rollup_interval,
+    uptime_gap=settings.telemetry_uptime_gap,
+    raw_retention_days=settings.telemetry_raw_retention_days,
+    late_seconds=settings.telemetry_flush_interval
+)
+
+# 设备状态上报写入遥测
+mqtt_manager.add_status_listener(telemetry_writer.handle_device_status)
@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix="luna-tests-")
+
+# 在导入应用之前配置：单机SQLite模式、不可达的MQTT代理、临时静态目录，环境变量优先于 .env
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}"
+os.environ["MQTT_BROKER_HOST"] = "127.0.0.1"
+os.environ["MQTT_BROKER_PORT"] = "1"
+os.environ["MQTT_ASYNCIO"] = "false"
+os.environ["STATIC_DIR"] = TEST_DIR
+os.environ["FRAMEBUFFER_CACHE_DIR"] = os.path.join(TEST_DIR, "framebuffers")
+os.environ["UPDATE_DEBOUNCE_MS"] = "0"
+os.environ["DEBUG"] = "false"
+
+sys.path.insert(0, SERVER_DIR)
+os.chdir(SERVER_DIR)
+
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+from config import settings
+from db_metrics import db_metrics
+
+
+@pytest.fixture(scope="session")
+def client():
+    """启动完整应用（包括lifespan中的后台任务）的测试客户端"""
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def headers():
+    return {"X-API-Key": settings.secret_key}
+
+
+@pytest.fixture
+def query_budget():
+    """
+    查询预算断言
+
+    用法:
+        with query_budget(1):
+            client.get(...)
+    """
+    return db_metrics.query_budget
+
+
+@pytest.fixture(scope="session")
+def image_path():
+    """静态目录中的测试图片（相对static_dir的路径）"""
+    name = "test-image.png"
+    Image.new("RGB", (settings.ink_width, settings.ink_height), "white").save(os.path.join(TEST_DIR, name))
+    return name
+
+
+@pytest.fixture
+def make_device(client, headers):
+    """注册一个新设备，返回设备ID"""
+    def create(**fields):
+        device_id = f"t-{uuid.uuid4().hex[:12]}"
+        response = client.post(
+            "/api/devices/",
+            json={"device_id": device_id, "name": "测试设备", "secret": "secret", **fields},
+            headers=headers
+        )
+        assert response.status_code == 201, response.text
+        return device_id
+    return create
+
+
+@pytest.fixture
+def make_content(client, headers):
+    """为设备创建一个内容版本，返回版本号"""
+    def create(device_id, **fields):
+        response = client.post(
+            f"/api/contents/devices/{device_id}/content",
+            json={"device_id": device_id, "title": "测试内容", "layout_config": "{}", **fields},
+            headers=headers
+        )
+        assert response.status_code == 201, response.text
+        return response.json()["version"]
+    return create
@@ -0,0 +1,67 @@
+"""管理后台列表页面的查询次数与行数无关（设备信息随列表一次加载，没有N+1查询）"""
+import pytest
+
+from config import settings
+from mqtt_manager import mqtt_manager
+
+
+@pytest.fixture(autouse=True)
+def no_frame_push(monkeypatch):
+    """内容更新不交给帧缓冲推送线程（推送线程中的查询会计入同一预算）"""
+    monkeypatch.setattr(mqtt_manager, "update_handler", None)
+
+
+@pytest.fixture(scope="module")
+def admin(client):
+    """登录管理后台（会话保存在测试客户端的cookie中）"""
+    response = client.post(
+        "/admin/login",
+        data={"username": settings.admin_username, "password": settings.admin_password},
+        follow_redirects=False
+    )
+    assert response.status_code == 303
+    return client
+
+
+def count_queries(admin, query_budget, url):
+    with query_budget(100) as statements:
+        response = admin.get(url)
+    assert response.status_code == 200, response.text
+    return len(statements)
+
+
+def add_todo(client, headers, device_id, index):
+    response = client.post("/api/todos/", json={"device_id": device_id, "title": f"待办{index}"}, headers=headers)
+    assert response.status_code == 201, response.text
+
+
+def add_song(client, headers, device_id, index):
+    response = client.post(
+        f"/api/devices/{device_id}/songs",
+        json={"song_id": 1000 + index, "name": f"歌曲{index}", "tempo": 120, "notes": [["C4", 250], ["REST", 250]]},
+        headers=headers
+    )
+    assert response.status_code == 200, response.text
+
+
+@pytest.mark.parametrize("page, budget, add", [
+    ("contents", 3, lambda client, headers, make_content, device_id, index: make_content(device_id)),
+    ("todos", 2, lambda client, headers, make_content, device_id, index: add_todo(client, headers, device_id, index)),
+    ("songs", 2, lambda client, headers, make_content, device_id, index: add_song(client, headers, device_id, index)),
+])
+def test_admin_list_query_count_is_constant(admin, client, headers, query_budget, make_device, make_content, page, budget, add):
+    devices = [make_device() for _ in range(2)]
+    add(client, headers, make_content, devices[0], 0)
+    # 预热（连接检测、后台线程中的设备注册表加载不计入比较）
+    admin.get(f"/admin/{page}")
+
+    single = count_queries(admin, query_budget, f"/admin/{page}")
+    single_device = count_queries(admin, query_budget, f"/admin/{page}?device_id={devices[0]}")
+
+    # 多个设备、多行数据
+    for index in range(1, 6):
+        add(client, headers, make_content, devices[index % 2], index)
+
+    assert count_queries(admin, query_budget, f"/admin/{page}") == single
+    assert count_queries(admin, query_budget, f"/admin/{page}?device_id={devices[0]}") == single_device
+    assert single <= budget and single_device <= budget
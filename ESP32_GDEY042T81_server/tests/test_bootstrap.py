@@ -0,0 +1,43 @@
+"""设备引导数据"""
+import os
+
+from PIL import Image
+
+from config import settings
+
+
+def bootstrap_etag(client, headers, device_id):
+    response = client.get(f"/api/devices/{device_id}/bootstrap", headers=headers)
+    assert response.status_code == 200
+    return response.json()["content"]["etag"]
+
+
+def test_bootstrap_etag_follows_image_replacement(client, headers, make_device, make_content, image_path):
+    device_id = make_device()
+    version = make_content(device_id, image_path=image_path)
+    url = f"/api/contents/public/devices/{device_id}/content/latest/binary"
+
+    old_etag = bootstrap_etag(client, headers, device_id)
+    response = client.get(url, headers={"If-None-Match": old_etag})
+    assert response.status_code == 304
+
+    replacement = "test-image-bootstrap.png"
+    Image.new("RGB", (settings.ink_width, settings.ink_height), "black").save(
+        os.path.join(settings.static_dir, replacement)
+    )
+    response = client.put(
+        f"/api/contents/devices/{device_id}/content/{version}",
+        headers=headers,
+        json={"image_path": replacement}
+    )
+    assert response.status_code == 200
+
+    new_etag = bootstrap_etag(client, headers, device_id)
+    assert new_etag != old_etag
+
+    # 引导数据中的ETag与二进制接口一致，设备可直接用于If-None-Match
+    response = client.get(url, headers={"If-None-Match": old_etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] == new_etag
+    response = client.get(url, headers={"If-None-Match": new_etag})
+    assert response.status_code == 304
@@ -0,0 +1,23 @@
+"""命令推送"""
+from database import engine
+from mqtt_manager import mqtt_manager
+
+
+def test_wait_releases_db_connection_before_waiting(client, headers, make_device, monkeypatch):
+    device_id = make_device()
+    checked_out = []
+
+    async def publish_async(topic, payload, qos=1, timeout=None):
+        # 等待代理确认期间请求不再占用连接（SQLite模式下写连接只有一个）
+        checked_out.append(engine.pool.checkedout())
+        return 0.001
+
+    monkeypatch.setattr(mqtt_manager, "publish_async", publish_async)
+    response = client.post(
+        "/api/commands/push",
+        json={"type": "reboot", "device_ids": [device_id], "wait": True},
+        headers=headers
+    )
+    assert response.status_code == 200, response.text
+    assert response.json()["publish_count"] == 1
+    assert checked_out == [0]
@@ -0,0 +1,17 @@
+"""配置校验"""
+import pytest
+from pydantic import ValidationError
+
+from config import Settings
+
+
+@pytest.mark.parametrize("field", ["content_retention_keep_last", "content_retention_keep_days"])
+@pytest.mark.parametrize("value", [0, -1])
+def test_retention_limits_must_be_positive(field, value):
+    with pytest.raises(ValidationError):
+        Settings(**{field: value})
+
+
+def test_retention_limits_accept_positive_or_empty():
+    assert Settings(content_retention_keep_last=1).content_retention_keep_last == 1
+    assert Settings(content_retention_keep_last=None).content_retention_keep_last is None
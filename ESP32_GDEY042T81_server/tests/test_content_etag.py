@@ -0,0 +1,41 @@
+"""内容二进制接口的ETag"""
+import os
+
+from PIL import Image
+
+from config import settings
+
+
+def test_replacing_image_in_place_changes_etag(client, headers, make_device, make_content, image_path):
+    device_id = make_device()
+    version = make_content(device_id, image_path=image_path)
+    url = f"/api/contents/public/devices/{device_id}/content/latest/binary"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    old_etag = response.headers["etag"]
+
+    # 命中设备注册表时直接返回304
+    response = client.get(url, headers={"If-None-Match": old_etag})
+    assert response.status_code == 304
+
+    # 同一版本更换图片
+    replacement = "test-image-replaced.png"
+    Image.new("RGB", (settings.ink_width, settings.ink_height), "black").save(
+        os.path.join(settings.static_dir, replacement)
+    )
+    response = client.put(
+        f"/api/contents/devices/{device_id}/content/{version}",
+        headers=headers,
+        json={"image_path": replacement}
+    )
+    assert response.status_code == 200
+
+    response = client.get(url, headers={"If-None-Match": old_etag})
+    assert response.status_code == 200
+    new_etag = response.headers["etag"]
+    assert new_etag != old_etag
+
+    # 新ETag由设备注册表缓存的图片路径重新得到
+    response = client.get(url, headers={"If-None-Match": new_etag})
+    assert response.status_code == 304
@@ -0,0 +1,47 @@
+"""设备注册表缓存"""
+import repository
+from db_router import read_session
+from device_registry import device_registry, MISSING
+
+
+def test_put_after_invalidation_is_dropped():
+    device_id = "t-registry-put"
+    generation = device_registry.generation(device_id)
+    device_registry.invalidate(device_id, broadcast=False)
+
+    assert not device_registry.put(device_id, MISSING, generation)
+    assert device_registry.get(device_id) is None
+
+
+def test_read_session_records_generation_before_query(client, make_device):
+    device_id = make_device()
+    with read_session(device_id) as db:
+        # 会话打开之后、查询之前发生的变更
+        device_registry.invalidate(device_id, broadcast=False)
+        entry = device_registry.load(db, device_id)
+    assert entry.exists
+    assert device_registry.get(device_id) is None
+
+
+def test_public_binary_does_not_cache_read_raced_by_invalidation(
+    client, make_device, make_content, image_path, monkeypatch
+):
+    device_id = make_device()
+    make_content(device_id, image_path=image_path)
+    original = repository.get_device_with_latest_content
+
+    def read_then_invalidate(db, device_id):
+        # 读取完成后、写入缓存之前内容被更新
+        row = original(db, device_id)
+        device_registry.invalidate(device_id, broadcast=False)
+        return row
+
+    monkeypatch.setattr(repository, "get_device_with_latest_content", read_then_invalidate)
+    response = client.get(f"/api/contents/public/devices/{device_id}/content/latest/binary")
+    assert response.status_code == 200
+    assert device_registry.get(device_id) is None
+
+    monkeypatch.setattr(repository, "get_device_with_latest_content", original)
+    response = client.get(f"/api/contents/public/devices/{device_id}/content/latest/binary")
+    assert response.status_code == 200
+    assert device_registry.get(device_id).current_version is not None
@@ -0,0 +1,55 @@
+"""设备状态处理管道"""
+import threading
+
+from database import engine
+from db_router import replica_router
+from device_registry import device_registry
+from ingestion import StatusIngestionPipeline
+
+
+def test_counters_are_consistent_under_concurrent_submit():
+    pipeline = StatusIngestionPipeline(queue_size=100, workers=1, flush_interval=60)
+    threads_count, per_thread = 8, 5000
+
+    def submit():
+        for _ in range(per_thread):
+            pipeline.submit("t-device", b"{}")
+
+    threads = [threading.Thread(target=submit) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = pipeline.stats()
+    assert stats["received"] == threads_count * per_thread
+    assert stats["dropped"] == stats["received"] - stats["queue_size"]
+
+
+def test_invalid_messages_are_counted(client):
+    pipeline = StatusIngestionPipeline(queue_size=10, workers=1, flush_interval=60)
+    for payload in (b"not json", b"[]", b'{"event": "boot", "timestamp": 1, "device_id": "other"}'):
+        pipeline.process("t-device", payload, None)
+    assert pipeline.stats()["invalid"] == 3
+
+
+def test_registration_check_does_not_wait_for_writer(client, make_device, monkeypatch):
+    # 读己之写窗口内的设备按设计读主库
+    monkeypatch.setattr(replica_router, "read_your_writes_window", 0)
+    pipeline = StatusIngestionPipeline(queue_size=10, workers=1, flush_interval=60)
+    device_id = make_device()
+    device_registry.clear()
+    results = {}
+
+    def check():
+        for checked_id in (device_id, "t-unknown-device"):
+            results[checked_id] = pipeline.is_registered(checked_id)
+
+    # SQLite模式下写连接只有一个，工作线程的存在性检查不能排在写入之后
+    with engine.connect():
+        thread = threading.Thread(target=check)
+        thread.start()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    assert results == {device_id: True, "t-unknown-device": False}
@@ -0,0 +1,65 @@
+"""publish_async的投递确认"""
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from mqtt_manager import mqtt_manager
+
+
+class FakeClient:
+    """返回固定消息ID的客户端，可选在publish返回前回调on_publish（模拟线程模式下的提前确认）"""
+
+    def __init__(self, mid, ack_inline=False):
+        self.mid = mid
+        self.ack_inline = ack_inline
+
+    def publish(self, topic, payload, qos=0):
+        if self.ack_inline:
+            mqtt_manager.on_publish(None, None, self.mid)
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=self.mid)
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    connected = threading.Event()
+    connected.set()
+    monkeypatch.setattr(mqtt_manager, "_connected", connected)
+
+    def install(mid, ack_inline=False):
+        monkeypatch.setattr(mqtt_manager, "client", FakeClient(mid, ack_inline))
+    return install
+
+
+def test_stale_ack_with_same_mid_does_not_resolve(fake_client):
+    fake_client(4242)
+
+    async def scenario():
+        # 另一个publish_async等待期间，发送队列中消息ID相同的旧消息（回绕前）被确认
+        with mqtt_manager._delivery_lock:
+            mqtt_manager._awaiting += 1
+        try:
+            mqtt_manager.on_publish(None, None, 4242)
+            task = asyncio.ensure_future(mqtt_manager.publish_async("esp32/t/cmd", b"x", qos=1, timeout=2))
+            await asyncio.sleep(0.05)
+            assert not task.done()
+
+            # 本次消息的确认
+            mqtt_manager.on_publish(None, None, 4242)
+            assert await task >= 0
+        finally:
+            with mqtt_manager._delivery_lock:
+                mqtt_manager._awaiting -= 1
+
+    asyncio.run(scenario())
+
+
+def test_ack_before_publish_returns_resolves(fake_client):
+    fake_client(4343, ack_inline=True)
+
+    async def scenario():
+        return await mqtt_manager.publish_async("esp32/t/cmd", b"x", qos=1, timeout=1)
+
+    assert asyncio.run(scenario()) >= 0
@@ -0,0 +1,80 @@
+"""设备在线状态"""
+import time
+from types import SimpleNamespace
+
+from mqtt_manager import mqtt_manager
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def presence_of(client, headers, device_id):
+    devices = client.get("/api/devices/presence", headers=headers).json()["devices"]
+    return next(item for item in devices if item["device_id"] == device_id)
+
+
+def test_http_poll_marks_device_online(client, headers, make_device, make_content):
+    device_id = make_device()
+    make_content(device_id)
+    assert client.get(f"/api/devices/{device_id}/status", headers=headers).json()["online"] is False
+    assert presence_of(client, headers, device_id)["online"] is False
+
+    # 只通过HTTP轮询、从不发布MQTT在线消息的设备
+    response = client.post(f"/api/devices/{device_id}/bootstrap", headers=headers)
+    assert response.status_code == 200
+
+    status = client.get(f"/api/devices/{device_id}/status", headers=headers).json()
+    assert status["online"] is True
+    assert status["last_online"] is not None
+    entry = presence_of(client, headers, device_id)
+    assert entry["online"] is True
+    assert entry["last_seen"] is not None
+
+
+def test_latest_content_poll_marks_device_online(client, headers, make_device, make_content):
+    device_id = make_device()
+    make_content(device_id)
+
+    response = client.get(f"/api/contents/devices/{device_id}/content/latest", headers=headers)
+    assert response.status_code == 200
+    assert client.get(f"/api/devices/{device_id}/status", headers=headers).json()["online"] is True
+
+
+def test_online_and_last_will_messages(client, headers, make_device):
+    device_id = make_device()
+
+    def publish(payload):
+        mqtt_manager.on_message(None, None, SimpleNamespace(topic=f"esp32/{device_id}/online", payload=payload))
+
+    publish(b"online")
+    assert wait_until(lambda: presence_of(client, headers, device_id)["online"] is True)
+
+    # 遗嘱消息
+    publish(b"offline")
+    assert wait_until(lambda: presence_of(client, headers, device_id)["online"] is False)
+    assert client.get(f"/api/devices/{device_id}/status", headers=headers).json()["online"] is False
+
+
+def test_unregistered_device_is_not_tracked(client, headers):
+    mqtt_manager.on_message(None, None, SimpleNamespace(topic="esp32/t-unknown/online", payload=b"online"))
+    mqtt_manager.on_message(None, None, SimpleNamespace(topic="esp32/t-unknown/ack", payload=b'{"type": "update"}'))
+    time.sleep(0.2)
+    devices = client.get("/api/devices/presence", headers=headers).json()["devices"]
+    assert all(item["device_id"] != "t-unknown" for item in devices)
+
+
+def test_presence_is_answered_from_memory(client, headers, query_budget, make_device):
+    make_device()
+
+    with query_budget(0):
+        response = client.get("/api/devices/presence?online=false", headers=headers)
+    assert response.status_code == 200
+    summary = response.json()
+    assert summary["total"] == summary["online"] + summary["offline"]
+    assert all(item["online"] is False for item in summary["devices"])
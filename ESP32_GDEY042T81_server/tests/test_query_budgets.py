@@ -0,0 +1,65 @@
+"""设备轮询热点接口的查询预算"""
+import pytest
+
+from mqtt_manager import mqtt_manager
+
+
+@pytest.fixture(autouse=True)
+def no_frame_push(monkeypatch):
+    """内容更新不交给帧缓冲推送线程（推送线程中的查询会计入同一预算）"""
+    monkeypatch.setattr(mqtt_manager, "update_handler", None)
+
+
+def test_bootstrap_query_budget(client, headers, query_budget, make_device, make_content, image_path):
+    device_id = make_device()
+    make_content(device_id, image_path=image_path)
+
+    with query_budget(3):
+        response = client.post(f"/api/devices/{device_id}/bootstrap", headers=headers)
+    assert response.status_code == 200
+
+    # 引导数据已缓存
+    with query_budget(0):
+        response = client.get(f"/api/devices/{device_id}/bootstrap", headers=headers)
+    assert response.status_code == 200
+
+
+def test_latest_content_query_budget(client, headers, query_budget, make_device, make_content):
+    device_id = make_device()
+    version = make_content(device_id)
+
+    with query_budget(1):
+        response = client.get(f"/api/contents/devices/{device_id}/content/latest", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["version"] == version
+
+
+def test_latest_binary_query_budget(client, headers, query_budget, make_device, make_content, image_path):
+    device_id = make_device()
+    make_content(device_id, image_path=image_path)
+
+    for _ in range(2):
+        with query_budget(1):
+            response = client.get(f"/api/contents/devices/{device_id}/content/latest/binary", headers=headers)
+        assert response.status_code == 200
+        assert len(response.content) > 0
+
+
+def test_device_status_query_budget(client, headers, query_budget, make_device):
+    device_id = make_device()
+
+    with query_budget(1):
+        response = client.get(f"/api/devices/{device_id}/status", headers=headers)
+    assert response.status_code == 200
+
+
+def test_query_budget_exceeded(client, headers, query_budget, make_device):
+    device_id = make_device()
+
+    try:
+        with query_budget(0):
+            client.get(f"/api/devices/{device_id}/status", headers=headers)
+    except AssertionError as e:
+        assert "超过预算" in str(e)
+    else:
+        raise AssertionError("超过查询预算时应当失败")
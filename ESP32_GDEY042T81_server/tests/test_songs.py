@@ -0,0 +1,75 @@
+"""歌曲音符存储"""
+import json
+
+import pytest
+from sqlalchemy import text
+
+from database import engine, migrate_song_notes
+from song_codec import encode_song_notes, pack_notes, unpack_notes
+
+
+def test_canonical_notes_are_packed():
+    notes = [["CS4", 250], ["REST", 100], ["E5", 65535]]
+    packed, raw = encode_song_notes(notes)
+    assert raw is None
+    assert unpack_notes(packed) == notes
+
+
+@pytest.mark.parametrize("notes", [
+    [["c#4", 250]],  # 非标准写法
+    [["e5", 250]],
+    [["C4", 250.0]],  # 浮点时长
+    [["C4", 250], ["X9", 100]],  # 未知音符
+])
+def test_non_canonical_notes_keep_original_text(notes):
+    packed, raw = encode_song_notes(notes)
+    assert packed is None
+    assert json.loads(raw) == notes
+
+
+@pytest.mark.parametrize("notes", [5, {"a": 1}, "C4", [5], [None]])
+def test_pack_rejects_non_note_lists(notes):
+    with pytest.raises(ValueError):
+        pack_notes(notes)
+
+
+def test_song_round_trips_client_notes(client, headers, make_device):
+    device_id = make_device()
+    notes = [["c#4", 250], ["e5", 125], ["REST", 100]]
+    response = client.post(
+        f"/api/devices/{device_id}/songs",
+        json={"song_id": 1, "name": "测试", "tempo": 120, "notes": notes},
+        headers=headers
+    )
+    assert response.status_code == 200, response.text
+
+    response = client.get(f"/api/devices/{device_id}/songs/1", headers=headers)
+    assert response.json()["notes"] == notes
+
+
+def test_migration_skips_malformed_rows(client, make_device):
+    device_id = make_device()
+    rows = {"5": None, '{"a": 1}': None, '[["C4", 1], 3]': None, "not json": None, '[["C4", 100]]': None}
+    with engine.begin() as conn:
+        for index, notes in enumerate(rows):
+            rows[notes] = conn.execute(
+                text(
+                    "INSERT INTO songs (device_id, song_id, name, tempo, notes) "
+                    "VALUES (:device_id, :song_id, 'legacy', '1.0', :notes) RETURNING id"
+                ),
+                {"device_id": device_id, "song_id": 100 + index, "notes": notes}
+            ).scalar()
+
+    migrate_song_notes()
+
+    with engine.connect() as conn:
+        stored = {
+            row.id: (row.notes, row.notes_packed)
+            for row in conn.execute(text("SELECT id, notes, notes_packed FROM songs WHERE device_id = :d"), {"d": device_id})
+        }
+    for notes, song_pk in rows.items():
+        if notes == '[["C4", 100]]':
+            assert stored[song_pk][0] is None
+            assert unpack_notes(stored[song_pk][1]) == [["C4", 100]]
+        else:
+            assert stored[song_pk] == (notes, None)
@@ -0,0 +1,42 @@
+"""遥测汇总"""
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select
+
+from database import engine
+from models import TelemetryEvent as TelemetryEventModel, TelemetryRollup as TelemetryRollupModel
+from telemetry import PERIOD_HOUR, TelemetryRollupJob, floor_hour
+
+
+def add_event(device_id, created_at):
+    with engine.begin() as conn:
+        conn.execute(insert(TelemetryEventModel).values(device_id=device_id, event="refresh", created_at=created_at))
+
+
+def hour_count(device_id, bucket_start):
+    with engine.connect() as conn:
+        return conn.execute(
+            select(TelemetryRollupModel.event_count).where(
+                TelemetryRollupModel.device_id == device_id,
+                TelemetryRollupModel.period == PERIOD_HOUR,
+                TelemetryRollupModel.bucket_start == bucket_start
+            )
+        ).scalar()
+
+
+def test_late_events_for_previous_hour_are_rolled_up(client):
+    job = TelemetryRollupJob(interval=300, uptime_gap=600, raw_retention_days=30, late_seconds=5)
+    device_id = f"t-{uuid.uuid4().hex[:12]}"
+    now = floor_hour(datetime.utcnow()) + timedelta(minutes=10)
+    previous_hour = floor_hour(now) - timedelta(hours=1)
+
+    add_event(device_id, previous_hour + timedelta(minutes=20))
+    add_event(device_id, now - timedelta(minutes=5))
+    job.run_once(now=now)
+    assert hour_count(device_id, previous_hour) == 1
+
+    # 写入缓冲在上一小时汇总之后才写入的事件
+    add_event(device_id, previous_hour + timedelta(minutes=59))
+    job.run_once(now=now + timedelta(minutes=5))
+    assert hour_count(device_id, previous_hour) == 2
@@ -0,0 +1,53 @@
+"""按ID访问待办事项的接口"""
+
+
+def add_todo(client, headers, device_id, title="待办"):
+    response = client.post(
+        "/api/todos/", headers=headers, json={"device_id": device_id, "title": title}
+    )
+    assert response.status_code == 201
+    return response.json()
+
+
+def test_get_todo(client, headers, make_device):
+    todo = add_todo(client, headers, make_device())
+    response = client.get(f"/api/todos/{todo['id']}", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["title"] == "待办"
+
+
+def test_get_missing_todo(client, headers):
+    response = client.get("/api/todos/999999999", headers=headers)
+    assert response.status_code == 404
+
+
+def test_update_todo(client, headers, make_device):
+    todo = add_todo(client, headers, make_device())
+    response = client.put(
+        f"/api/todos/{todo['id']}", headers=headers, json={"title": "已修改", "is_completed": True}
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert body["title"] == "已修改"
+    assert body["is_completed"] is True
+    assert body["completed_at"] is not None
+
+
+def test_complete_and_incomplete_todo(client, headers, make_device):
+    todo = add_todo(client, headers, make_device())
+    response = client.post(f"/api/todos/{todo['id']}/complete", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["is_completed"] is True
+
+    response = client.post(f"/api/todos/{todo['id']}/incomplete", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["is_completed"] is False
+    assert response.json()["completed_at"] is None
+
+
+def test_delete_todo(client, headers, make_device):
+    todo = add_todo(client, headers, make_device())
+    response = client.delete(f"/api/todos/{todo['id']}", headers=headers)
+    assert response.status_code == 204
+    response = client.get(f"/api/todos/{todo['id']}", headers=headers)
+    assert response.status_code == 404
@@ -0,0 +1,162 @@
+import heapq
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateNotifier:
+    """
+    设备内容更新通知防抖
+
+    每次通知都会让设备整屏刷新（约4秒并消耗电量），短时间内连续的内容变更只需要通知一次。
+    设备收到更新通知后在窗口期内没有新的变更时才发送，窗口期内的新变更替换待发送的版本并重新计时，
+    但从第一次变更起最多延迟max_delay，保证持续变更的设备也能及时刷新。到期的设备合并为一批发送。
+    """
+
+    def __init__(self, window: float, max_delay: float):
+        self.window = window
+        self.max_delay = max_delay
+        # device_id -> [待发送的版本, 第一次变更时间, 计划发送时间]
+        self._pending: Dict[str, list] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._dispatch: Optional[Callable[[Dict[str, int]], None]] = None
+        self.requested_total = 0
+        self.suppressed_total = 0
+        self.sent_total = 0
+        self.max_delay_total = 0
+
+    @property
+    def enabled(self) -> bool:
+        """是否启用防抖（窗口大于0且发送线程已启动）"""
+        return self.window > 0 and self._thread is not None
+
+    def bind(self, dispatch: Callable[[Dict[str, int]], None]):
+        """
+        设置实际发送更新通知的函数
+
+        Args:
+            dispatch: 发送函数，参数为设备ID到内容版本的映射
+        """
+        self._dispatch = dispatch
+
+    def notify(self, versions: Dict[str, int]):
+        """
+        记录设备的内容更新，窗口期结束后发送
+
+        Args:
+            versions: 设备ID到内容版本的映射
+        """
+        now = time.monotonic()
+        with self._cond:
+            for device_id, version in versions.items():
+                self.requested_total += 1
+                state = self._pending.get(device_id)
+                if state is None:
+                    due_at = now + self.window
+                    self._pending[device_id] = [version, now, due_at]
+                else:
+                    # 合并到待发送的通知，只发送最后的版本
+                    self.suppressed_total += 1
+                    due_at = min(now + self.window, state[1] + self.max_delay)
+                    state[0] = version
+                    state[2] = due_at
+                heapq.heappush(self._heap, (due_at, device_id))
+            self._cond.notify()
+
+    def _collect(self, flush_all: bool = False) -> Tuple[Dict[str, int], float]:
+        """取出到期的通知（调用方持有锁），返回(到期的通知, 距离下一个到期的时间)"""
+        now = time.monotonic()
+        due: Dict[str, int] = {}
+        while self._heap and (flush_all or self._heap[0][0] <= now):
+            due_at, device_id = heapq.heappop(self._heap)
+            state = self._pending.get(device_id)
+            # 计划时间已被后续变更推迟的旧堆条目
+            if state is None or (state[2] != due_at and not flush_all):
+                continue
+            del self._pending[device_id]
+            due[device_id] = state[0]
+            if state[2] - state[1] >= self.max_delay:
+                self.max_delay_total += 1
+        wait = self._heap[0][0] - now if self._heap else 1.0
+        return due, min(max(wait, 0.001), 1.0)
+
+    def _send(self, due: Dict[str, int]):
+        if not due:
+            return
+        self.sent_total += len(due)
+        try:
+            self._dispatch(due)
+        except Exception as e:
+            logger.error(f"发送设备更新通知失败: {str(e)}")
+
+    def stats(self) -> Dict[str, int]:
+        """防抖统计信息"""
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "requested": self.requested_total,
+                "suppressed": self.suppressed_total,
+                "sent": self.sent_total,
+                "max_delay_reached": self.max_delay_total
+            }
+
+    def render_prometheus(self) -> str:
+        """以Prometheus文本格式导出防抖指标"""
+        stats = self.stats()
+        lines = [
+            "# HELP luna_update_notifications_total 设备更新通知数（按结果）",
+            "# TYPE luna_update_notifications_total counter",
+            f'luna_update_notifications_total{{result="requested"}} {stats["requested"]}',
+            f'luna_update_notifications_total{{result="suppressed"}} {stats["suppressed"]}',
+            f'luna_update_notifications_total{{result="sent"}} {stats["sent"]}',
+            f'luna_update_notifications_total{{result="max_delay_reached"}} {stats["max_delay_reached"]}',
+            "# HELP luna_update_notifications_pending 等待防抖窗口结束的设备数",
+            "# TYPE luna_update_notifications_pending gauge",
+            f"luna_update_notifications_pending {stats['pending']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """启动发送线程（窗口为0时不启用防抖）"""
+        if self._thread is not None or self.window <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="update-notifier", daemon=True)
+        self._thread.start()
+        logger.info(f"设备更新通知防抖已启用，窗口 {self.window * 1000:.0f}ms，最长延迟 {self.max_delay * 1000:.0f}ms")
+
+    def stop(self):
+        """停止发送线程，立即发送所有待发送的通知"""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        with self._cond:
+            due, _ = self._collect(flush_all=True)
+        self._send(due)
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond:
+                due, wait = self._collect()
+                if not due:
+                    self._cond.wait(wait)
+                    continue
+            self._send(due)
+
+
+# 全局设备更新通知防抖实例
+update_notifier = UpdateNotifier(
+    window=settings.update_debounce_ms / 1000,
+    max_delay=settings.update_max_delay_ms / 1000
+)